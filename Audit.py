@@ -1,4 +1,7 @@
-import xml.etree.cElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 '''xml.etree.cElementTree is imported to parse the xml file'''
 import pprint
 '''
@@ -8,6 +11,9 @@ types of tags and returns the counts as a dictionary
 from collections import defaultdict
 import re
 
+import compressed
+import pbf_reader
+
 #this is a test of github
 OSMFILE = "RaleighStreetData.osm"
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
@@ -98,62 +104,310 @@ def is_state(elem):
     '''
     return elem.attrib['k'] == 'addr:state'
 
-def count_tags(filename):
+def merge_set_dict(merged, result):
+    '''adds the sets in result to the sets in merged key by key'''
+    for key, values in result.items():
+        merged[key] |= values
+
+def merge_counts(merged, result):
+    '''adds the counts in result to the counts in merged'''
+    for key, count in result.items():
+        merged[key] = merged.get(key, 0) + count
+
+class UnmergeableAudit(TypeError):
+    '''raised when two audit results can't be merged into one'''
+
+def merge_values(merged, result):
     '''
-    function reads in an xml file and parses through the lines
-    counting each type of node and storing it into a dictionary
-    it uses a try except block incase the node has not yet been
-    put in the tag_count_dict to avoid a KeyException error
+    merges a result into another of the same shape and returns it, sets
+    are unioned, lists extended, numbers added and dictionaries merged key
+    by key.  UnmergeableAudit is raised for anything else
+    '''
+    if result is None:
+        return merged
+    if merged is None:
+        return result
+    if isinstance(merged, set):
+        merged |= result
+        return merged
+    if isinstance(merged, list):
+        merged.extend(result)
+        return merged
+    if isinstance(merged, (int, float)) and not isinstance(merged, bool):
+        return merged + result
+    if isinstance(merged, dict):
+        for key, value in result.items():
+            merged[key] = merge_values(merged[key], value) if key in merged else value
+        return merged
+    raise UnmergeableAudit('{0} results can not be merged'.format(type(merged).__name__))
+
+class Auditor(object):
     '''
-    tag_count_dict = {}
-    tree = ET.parse(filename)
-    for element in tree.iter():
-        for key in element.attrib.keys():
-            if key == 'k':
-                try:
-                    tag_count_dict[element.attrib[key]] += 1
-                except KeyError:
-                    tag_count_dict[element.attrib[key]] = 1
+    base class for the auditors run by run_audit, an auditor gets the key
+    and value of every tag whose key it matches and builds up its result as
+    the file is streamed.  parents is the set of element types whose tags the
+    auditor looks at, None means tags on any element
+    '''
+    name = None
+    parents = ('node', 'way')
+    # bump when the auditor changes so cached results from audit_cache are
+    # not used any more
+    version = 1
+
+    def __init__(self):
+        self.result = self.new_result()
+
+    def new_result(self):
+        '''returns the empty result the auditor starts from'''
+        return None
+
+    def merge(self, result):
+        '''
+        adds the result of the same auditor run over another part of the
+        file, audit_cache uses it to put chunk results together.  the
+        default handles results built from sets, lists, numbers and
+        dictionaries with merge_values, auditors with other results have
+        to override it or raise UnmergeableAudit
+        '''
+        try:
+            self.result = merge_values(self.result, result)
+        except UnmergeableAudit:
+            raise UnmergeableAudit('{0} auditor results can not be merged'.format(self.name))
+
+    def matches(self, key):
+        '''returns True if the auditor wants tags with this key'''
+        return False
+
+    def update(self, key, value):
+        '''adds one tag to the result'''
+        pass
+
+
+class StreetAuditor(Auditor):
+    '''collects street names whose ending isn't in EXPECTED'''
+    name = 'street'
+
+    def new_result(self):
+        return defaultdict(set)
+
+    def matches(self, key):
+        return key == 'addr:street'
+
+    def update(self, key, value):
+        audit_street_type(self.result, value)
+
+    def merge(self, result):
+        merge_set_dict(self.result, result)
+
+
+class ZipAuditor(Auditor):
+    '''collects zipcodes that aren't in EXPECTED_ZIPCODES'''
+    name = 'zip'
+
+    def new_result(self):
+        return set()
+
+    def matches(self, key):
+        return key == 'addr:postcode'
+
+    def update(self, key, value):
+        audit_zip_type(self.result, value)
+
+    def merge(self, result):
+        self.result |= result
+
+
+class StateAuditor(Auditor):
+    '''collects state values that aren't in EXPECTED_STATE'''
+    name = 'state'
+
+    def new_result(self):
+        return set()
+
+    def matches(self, key):
+        return key == 'addr:state'
+
+    def update(self, key, value):
+        audit_state(self.result, value)
+
+    def merge(self, result):
+        self.result |= result
+
+
+class TigerAuditor(Auditor):
+    '''collects every value seen for each TIGER key'''
+    name = 'tiger'
+
+    def new_result(self):
+        return defaultdict(set)
+
+    def matches(self, key):
+        return key[0:5] == 'tiger'
+
+    def update(self, key, value):
+        audit_tiger(self.result, key, value)
+
+    def merge(self, result):
+        merge_set_dict(self.result, result)
 
 
-    return tag_count_dict
+class CityAuditor(Auditor):
+    '''counts how many times each city name is used'''
+    name = 'city'
 
-def audit(osmfile):
+    def new_result(self):
+        return {}
+
+    def matches(self, key):
+        return key == 'addr:city'
+
+    def update(self, key, value):
+        audit_city(self.result, value)
+
+    def merge(self, result):
+        merge_counts(self.result, result)
+
+
+class TagCountAuditor(Auditor):
+    '''counts how many times each tag key is used on any element'''
+    name = 'tag_count'
+    parents = None
+
+    def new_result(self):
+        return {}
+
+    def matches(self, key):
+        return True
+
+    def update(self, key, value):
+        try:
+            self.result[key] += 1
+        except KeyError:
+            self.result[key] = 1
+
+    def merge(self, result):
+        merge_counts(self.result, result)
+
+
+AUDITORS = {}
+
+def register_auditor(auditor_class):
+    '''
+    adds an Auditor subclass to the auditors run_audit can run by name,
+    returns the class so it can be used as a decorator
+    '''
+    AUDITORS[auditor_class.name] = auditor_class
+    return auditor_class
+
+for _auditor in (StreetAuditor, ZipAuditor, StateAuditor, TigerAuditor,
+                 CityAuditor, TagCountAuditor):
+    register_auditor(_auditor)
+
+DEFAULT_AUDITORS = ('street', 'zip', 'state', 'tiger', 'city', 'tag_count')
+
+def make_auditors(auditors):
+    '''
+    turns a list of registered auditor names, Auditor classes or Auditor
+    instances into a list of Auditor instances
+    '''
+    made = []
+    for auditor in auditors:
+        if isinstance(auditor, str):
+            auditor = AUDITORS[auditor]
+        if isinstance(auditor, type):
+            auditor = auditor()
+        made.append(auditor)
+    return made
+
+def run_audit(osmfile, auditors=DEFAULT_AUDITORS, workers=None, cache_dir=None):
+    '''
+    streams the xml file once and feeds every tag to the auditors that
+    match its key, each node, way and relation is cleared once it has been
+    read so memory stays flat however large the file is.  .bz2, .gz and .xz
+    files are decompressed as they are read.  with a cache_dir results are
+    kept there and reused for unchanged files, see audit_cache.  returns a
+    dictionary of auditor name to result
+    '''
+    if cache_dir is not None:
+        import audit_cache
+        return audit_cache.cached_audit(osmfile, auditors, cache_dir, workers=workers)
+    auditors = make_auditors(auditors)
+    if pbf_reader.is_pbf(osmfile):
+        return audit_elements(pbf_reader.iter_elements(osmfile, workers=workers),
+                              auditors)
+    if compressed.is_compressed(osmfile):
+        stream = compressed.open_input(osmfile, workers)
+        try:
+            return audit_stream(stream, auditors)
+        finally:
+            stream.close()
+    return audit_stream(osmfile, auditors)
+
+def audit_stream(osmfile, auditors):
+    '''
+    runs the auditors over an xml file or an open binary stream of one,
+    see run_audit
+    '''
+    parent = None
+    context = ET.iterparse(osmfile, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ('node', 'way', 'relation'):
+                parent = elem.tag
+        elif elem.tag == 'tag':
+            key = elem.attrib.get('k')
+            if key is None:
+                continue
+            for auditor in auditors:
+                if (auditor.parents is None or parent in auditor.parents) \
+                        and auditor.matches(key):
+                    auditor.update(key, elem.attrib.get('v'))
+        elif elem.tag in ('node', 'way', 'relation'):
+            parent = None
+            root.clear()
+    return dict((auditor.name, auditor.result) for auditor in auditors)
+
+def audit_elements(elements, auditors):
+    '''
+    runs the auditors over elements that are already built, this is used
+    for .osm.pbf input where the reader hands back whole elements
+    '''
+    for elem in elements:
+        for tag in elem.iter('tag'):
+            key = tag.attrib['k']
+            for auditor in auditors:
+                if (auditor.parents is None or elem.tag in auditor.parents) \
+                        and auditor.matches(key):
+                    auditor.update(key, tag.attrib['v'])
+    return dict((auditor.name, auditor.result) for auditor in auditors)
+
+def count_tags(filename, cache_dir=None):
+    '''
+    function reads in an xml file and parses through the lines
+    counting each type of node and storing it into a dictionary
+    '''
+    return run_audit(filename, ('tag_count',), cache_dir=cache_dir)['tag_count']
+
+def audit(osmfile, cache_dir=None):
     '''
     this function takes in the xml file and takes a look at the tags
     with street, zipcode, and state values and compares them against an expected
     and returns the values that don't fall in those values
     '''
-    state_set = set()
-    tiger_types = defaultdict(set)
-    zipcode_set = set()
-    street_types = defaultdict(set)
-    city_set = {}
-    with open(osmfile, 'r') as osm_file:
-        for event, elem in ET.iterparse(osm_file, events=("start",)):
-            if elem.tag == "node" or elem.tag == "way":
-                for tag in elem.iter("tag"):
-                    if is_street_name(tag):
-                        audit_street_type(street_types, tag.attrib['v'])
-                    elif is_post_code(tag):
-                        audit_zip_type(zipcode_set, tag.attrib['v'])
-                    elif is_state(tag):
-                        audit_state(state_set, tag.attrib['v'])
-                    elif is_tiger_data(tag):
-                        audit_tiger(tiger_types, tag.attrib['k'], tag.attrib['v'])
-                    elif is_city(tag):
-                        audit_city(city_set, tag.attrib['v'])
-
-
-    osm_file.close()
-    return street_types, zipcode_set, state_set, tiger_types, city_set
+    results = run_audit(osmfile, ('street', 'zip', 'state', 'tiger', 'city'),
+                        cache_dir=cache_dir)
+    return (results['street'], results['zip'], results['state'],
+            results['tiger'], results['city'])
+
 def main():
 
-    TAGS = audit(OSMFILE)
+    results = run_audit(OSMFILE)
+    TAGS = (results['street'], results['zip'], results['state'],
+            results['tiger'], results['city'])
     pprint.pprint(TAGS)
-    next_tags = count_tags(OSMFILE)
+    next_tags = results['tag_count']
     pprint.pprint(next_tags)
 
 if __name__== '__main__':
     main()
-
@@ -1,13 +1,37 @@
 import csv
 import sqlite3
 import codecs
+import json
+import os
 import pprint
 import re
-import xml.etree.cElementTree as ET
-
-import cerberus
-
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+import address_search
+import bulk_loader
+import columnar
+import compressed
+import fast_parser
+import fast_validator
+import filters
+import metrics
+import node_store
+import normalize
+import parallel
+import pbf_reader
+import pipeline
+import post_load
+import records
 import schema
+import shards
+import spatial
+import tag_dictionary
+import way_geometry
+# split_key lives in records so query_service can use it without this module
+from records import LOWER_COLON, PROBLEMCHARS, split_key
 
 OSM_PATH = "RaleighStreetData"
 
@@ -17,8 +41,7 @@ WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
 
-LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
-PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+DB_PATH = 'Street_Data.db'
 
 SCHEMA = schema.schema
 
@@ -66,6 +89,9 @@ CITY_MAPPINGS = {'Apex, NC': 'Apex', 'Ralegh': 'Raleigh', 'Ralegih': 'Raleigh',
                  'wake Forest': 'Wake Forest', ' Raleigh': 'Raleigh',
                  'raleigh': 'Raleigh'}
 
+NORMALIZER = normalize.TagNormalizer(CITY_MAPPINGS, STATE_MAPPINGS,
+                                     ZIPCODE_MAPPINGS, MAPPING)
+
 # Make sure the fields order in the csvs matches the column order
 # in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version',
@@ -75,6 +101,9 @@ WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
+# the TIGER tags the addr:street value is built from
+TIGER_STREET_KEYS = frozenset(['name_base', 'name_type', 'name_direction_suffix'])
+
 def shape_dict(child_dict):
     '''
     this function takes in the shape element dictionary and cleans the data
@@ -83,187 +112,233 @@ def shape_dict(child_dict):
     the same for city, and state data as well by using mapping dictionaries.
     For zipcodes it removes the last four digits and
     strips of lettering and white space
-    '''
 
-    if child_dict['type'] == 'addr':
-        if child_dict['key'] == 'city':
-            try:
-                child_dict['value'] = CITY_MAPPINGS[child_dict['value']]
-            except KeyError:
-                pass
-        elif child_dict['key'] == 'state':
-            try:
-                child_dict['value'] = STATE_MAPPINGS[child_dict['value']]
-            except KeyError:
-                pass
-        elif child_dict['key'] == 'postcode':
-            try:
-                child_dict['value'] = ZIPCODE_MAPPINGS[child_dict['value']]
-            except KeyError:
-                child_dict['value'] = child_dict['value'][0:5]
-        elif child_dict['key'] == 'street':
-            street_split = child_dict['value'].split()
-            for index in range(len(street_split)):
-                try:
-                    street_split[index] = MAPPING[street_split[index]]
-                except KeyError:
-                    pass
-            child_dict['value'] = ' '.join(street_split)
+    the rules are looked up in the NORMALIZER dispatch table, which caches
+    the values it has already cleaned
+    '''
 
+    rule = NORMALIZER.rules.get((child_dict['type'], child_dict['key']))
+    if rule is not None:
+        child_dict['value'] = rule(child_dict['value'])
 
     return child_dict
 
+def tiger_records(tiger_tags):
+    """
+    Build the addr:postcode and addr:street Tags from an element's TIGER
+    Tags, the street is the name parts joined in the order they appear
+    """
+    street_name = []
+    zip_code = ''
+    for tag in tiger_tags:
+        if tag.key in TIGER_STREET_KEYS:
+            street_name.append(tag.value)
+        elif tag.key == 'zip_left':
+            zip_code = tag.value
+    element_id = tiger_tags[0].id
+    return (records.Tag(element_id, 'postcode', zip_code, 'addr'),
+            records.Tag(element_id, 'street', ' '.join(street_name), 'addr'))
+
 def shape_tiger_dict(tiger_list):
     '''
     this function takes in a list holding the TIGER data tags and shapes
     them to fit the normal OSM data of a street address and postcode schemas of
     the other data tags
     '''
-    tiger_post_code = {}
-    tiger_street_addr = {}
-    street_name = []
-    zip_code = ''
-    tiger_post_code['id'] = tiger_list[0]['id']
-    tiger_street_addr['id'] = tiger_list[0]['id']
-    tiger_post_code['type'] = 'addr'
-    tiger_street_addr['type'] = 'addr'
-    tiger_post_code['key'] = 'postcode'
-    tiger_street_addr['key'] = 'street'
-    for dictionary in tiger_list:
-        if dictionary['key'] == 'name_base':
-            street_name.append(dictionary['value'])
-        if dictionary['key'] == 'name_type':
-            street_name.append(dictionary['value'])
-        if dictionary['key'] == 'name_direction_suffix':
-            street_name.append(dictionary['value'])
-        if dictionary['key'] == 'zip_left':
-            zip_code = dictionary['value']
-    tiger_post_code['value'] = zip_code
-    tiger_street_addr['value'] = ' '.join(street_name)
-
-    return (tiger_post_code, tiger_street_addr)
+    return tuple(records.row_dict(tag) for tag in tiger_records(
+        [records.Tag(dictionary['id'], dictionary['key'], dictionary['value'],
+                     dictionary['type']) for dictionary in tiger_list]))
+
+def shape_tags(element_id, tag_attribs):
+    """
+    Shape the attributes of a node or way's tag children into Tag records,
+    the TIGER tags are also gathered up into a street and postcode tag
+    """
+    rules = NORMALIZER.rules
+    tags = []
+    tiger_tags = []
+    for child_attrib in tag_attribs:
+        key, tag_type = split_key(child_attrib['k'])
+        value = child_attrib.get('v')
+        # the cleaning rules from shape_dict, without building a dict
+        rule = rules.get((tag_type, key))
+        if rule is not None:
+            value = rule(value)
+        tag = records.Tag(element_id, key, value, tag_type)
+        if tag_type == 'tiger':
+            tiger_tags.append(tag)
+        if key != 'PASS':
+            tags.append(tag)
+
+    if tiger_tags:
+        for tag in tiger_records(tiger_tags):
+            rule = rules.get((tag.type, tag.key))
+            if rule is not None:
+                tag = tag._replace(value=rule(tag.value))
+            tags.append(tag)
+    return tags
+
+def shape_record(tag, attrib, children, node_attr_fields=NODE_FIELDS,
+    way_attr_fields=WAY_FIELDS):
+    """
+    Shape a node or way given its tag, its attributes and a list of
+    (tag, attributes) pairs for its children in document order into a
+    records.ShapedNode or records.ShapedWay.  This lets the expat parser
+    shape elements without building an Element first.  Only the attributes
+    in node_attr_fields or way_attr_fields are kept, the others are None
+    """
+    #this code I wrote from the original problem set however I added the 'type'
+    # check to gather the tiger data into the list so that it could be cleaned
+    if tag == 'node':
+        # the default fields are all of the record's, which needs no filtering
+        node = records.from_attribs(
+            records.Node, attrib, None if node_attr_fields is NODE_FIELDS else node_attr_fields)
+        return records.ShapedNode(node, shape_tags(
+            node.id, [child_attrib for child_tag, child_attrib in children
+                      if child_tag == 'tag']))
+
+    elif tag == 'way':
+        way = records.from_attribs(
+            records.Way, attrib, None if way_attr_fields is WAY_FIELDS else way_attr_fields)
+        # position is the nd's index among all of the way's children
+        way_nodes = [records.WayNode(way.id, child_attrib['ref'], position)
+                     for position, (child_tag, child_attrib) in enumerate(children)
+                     if child_tag == 'nd']
+        return records.ShapedWay(way, way_nodes, shape_tags(
+            way.id, [child_attrib for child_tag, child_attrib in children
+                     if child_tag == 'tag']))
+
+def shape_element_record(element, node_attr_fields=NODE_FIELDS,
+    way_attr_fields=WAY_FIELDS):
+    """Shape a node or way XML element into records, see shape_record"""
+    return shape_record(element.tag, element.attrib,
+                        [(child.tag, child.attrib) for child in element],
+                        node_attr_fields, way_attr_fields)
+
+def shape_attribs(tag, attrib, children, node_attr_fields=NODE_FIELDS,
+    way_attr_fields=WAY_FIELDS):
+    """
+    shape_record returning the dictionaries code written before the
+    records module expects
+    """
+    return records.as_dict(shape_record(tag, attrib, children, node_attr_fields,
+                                        way_attr_fields))
 
 def shape_element(element, node_attr_fields=NODE_FIELDS,
     way_attr_fields=WAY_FIELDS,
     problem_chars=PROBLEMCHARS, default_tag_type='regular'):
     """Clean and shape node or way XML element to Python dict"""
-    #this code I wrote from the original problem set however I added the 'type'
-    # check to gather the tiger data into the list so that it could be cleaned
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []
-    if element.tag == 'node':
-        for key in element.attrib:
-            if key in node_attr_fields:
-                node_attribs[key] = element.attrib[key]
-        tiger_dict = []
-        for child in element.findall('tag'):
-            node_dict = {}
-            child_dict = child.attrib
-            node_dict['id'] = node_attribs['id']
-            for key in child_dict:
-                if key =='v':
-                    node_dict['value']=child_dict['v']
-                if key == 'k':
-                    if LOWER_COLON.search(child_dict[key]):
-                        split_key_value = child_dict[key].split(':', 1)
-                        node_dict['key'] = split_key_value[1]
-                        node_dict['type'] = split_key_value[0]
-                    if PROBLEMCHARS.search(child_dict[key]):
-                        node_dict['key']='PASS'
-                    if not LOWER_COLON.search(child_dict[key]):
-                        node_dict['key'] = child_dict['k']
-                        node_dict['type'] = 'regular'
-            if node_dict['type'] == 'tiger':
-                tiger_dict.append(node_dict)
-
-            node_dict = shape_dict(node_dict)
-            if node_dict['key'] == 'PASS':
-                pass
-            else:
-                tags.append(node_dict)
-
-        if tiger_dict:
-            for dictionary in shape_tiger_dict(tiger_dict):
-
-                tags.append(shape_dict(dictionary))
-
-
-    elif element.tag == 'way':
-        for key in element.attrib:
-            if key in WAY_FIELDS:
-                way_attribs[key] = element.attrib[key]
-
-        for child in element.findall('nd'):
-            nd_dict = {}
-            nd_dict['id']= way_attribs['id']
-            nd_dict['node_id']= child.attrib['ref']
-            nd_dict['position'] = element.getchildren().index(child)
-            way_nodes.append(nd_dict)
-        tiger_dict = []
-        for child in element.findall('tag'):
-
-            node_dict = {}
-            child_dict = child.attrib
-            node_dict['id']=way_attribs['id']
-            for key in child_dict:
-                if key =='v':
-                    node_dict['value']=child_dict['v']
-                if key == 'k':
-                    if LOWER_COLON.search(child_dict[key]):
-                        split_key_value = child_dict[key].split(':', 1)
-                        node_dict['key'] = split_key_value[1]
-                        node_dict['type'] = split_key_value[0]
-                    if PROBLEMCHARS.search(child_dict[key]):
-                        node_dict['key']='PASS'
-                    if not LOWER_COLON.search(child_dict[key]):
-                        node_dict['key'] = child_dict['k']
-                        node_dict['type'] = 'regular'
-            if node_dict['type'] == 'tiger':
-                tiger_dict.append(node_dict)
-            node_dict = shape_dict(node_dict)
-            if node_dict['key'] == 'PASS':
-                pass
-            else:
-                tags.append(node_dict)
-
-
-        if tiger_dict != []:
-            dict_tuple = shape_tiger_dict(tiger_dict)
-            street_dict = dict_tuple[1]
-            for dictionary in dict_tuple:
-                tig_dict = shape_dict(dictionary)
-                tags.append(tig_dict)
-
-    if element.tag == 'node':
-        return {'node': node_attribs, 'node_tags': tags}
-    elif element.tag == 'way':
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+    return records.as_dict(shape_element_record(element, node_attr_fields,
+                                                way_attr_fields))
 
 
 # ================================================== #
 #               Helper Functions from problem set    #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
-
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
-
-
-def validate_element(element, validator, schema=SCHEMA):
-    """Raise ValidationError if element does not match schema"""
+def get_element(osm_file, tags=('node', 'way', 'relation'), workers=None,
+                element_filter=None):
+    """
+    Yield element if it is the right type of tag, and when an ElementFilter
+    is given only if the filter accepts it
+    """
+    # .osm.pbf files are decoded across workers processes
+    if pbf_reader.is_pbf(osm_file):
+        for elem in pbf_reader.iter_elements(osm_file, tags, workers):
+            if element_filter is None or element_filter.accept(
+                    elem.tag, elem.attrib, ((child.tag, child.attrib) for child in elem)):
+                yield elem
+        return
+    # .bz2, .gz and .xz extracts are decompressed as they are parsed
+    source = osm_file
+    if compressed.is_compressed(osm_file):
+        source = compressed.open_input(osm_file, workers)
+
+    try:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                if element_filter is None or element_filter.accept(
+                        elem.tag, elem.attrib, ((child.tag, child.attrib) for child in elem)):
+                    yield elem
+                root.clear()
+    finally:
+        if source is not osm_file:
+            source.close()
+
+
+def shaped_elements(file_in, workers=1, chunk_size=parallel.DEFAULT_CHUNK_SIZE,
+                    parser='expat', element_filter=None, normalizer_stats=None,
+                    progress=None):
+    """
+    Yield (tag, shaped element) pairs for every node and way in file_in,
+    the shaped elements are records.ShapedNode and records.ShapedWay,
+    with more than one worker the file is split into byte ranges that are
+    shaped in a process pool and handed back in file order, their tag and
+    way node rows are plain tuples in column order rather than records,
+    .osm.pbf blobs are decoded in parallel and shaped here.  parser is
+    'expat' to shape straight from the parser callbacks or 'etree' to build
+    an Element for each node and way with get_element first, both give the
+    same output.  compressed files are parsed here while workers processes
+    decompress them.  elements an ElementFilter rejects are never shaped.
+    the NORMALIZER cache stats of worker processes are added to
+    normalizer_stats when it is a dictionary, and progress is called with
+    the bytes of each range handed back, see parallel.shape_file
+    """
+    if pbf_reader.is_pbf(file_in):
+        return ((element.tag, shape_element_record(element))
+                for element in get_element(file_in, ('node', 'way'), workers,
+                                           element_filter))
+    if compressed.is_compressed(file_in):
+        return shaped_stream(compressed.open_input(file_in, workers), parser,
+                             element_filter)
+    if workers is None or workers > 1:
+        return parallel.shape_file(file_in, workers, chunk_size, parser,
+                                   element_filter, normalizer_stats, progress)
+    if parser == 'expat':
+        shape = shape_record
+        if element_filter is not None:
+            shape = element_filter.wrap(shape_record)
+        return fast_parser.iter_shaped(file_in, shape)
+    return ((element.tag, shape_element_record(element))
+            for element in get_element(file_in, ('node', 'way'),
+                                       element_filter=element_filter))
+
+
+def shaped_stream(stream, parser='expat', element_filter=None):
+    """Yield (tag, shaped element) pairs from an open stream then close it"""
+    try:
+        for shaped in shaped_elements(stream, workers=1, parser=parser,
+                                      element_filter=element_filter):
+            yield shaped
+    finally:
+        stream.close()
+
+
+def validate_element(element, validator, schema=SCHEMA, rejects=None):
+    """
+    Raise ValidationError if element does not match schema, when a rejects
+    file is given the element and its errors are written to it as a line of
+    json instead and False is returned.  records are checked directly by
+    the validator's generated record checks, only an invalid one is turned
+    into the dictionaries records.as_dict gives to collect its errors
+    """
+    if isinstance(element, (records.ShapedNode, records.ShapedWay)):
+        if validator.validate_record(element):
+            return True
+        element = records.as_dict(element)
     if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
+        if rejects is not None:
+            rejects.write(json.dumps({'element': element,
+                                      'errors': validator.errors}, default=str))
+            rejects.write('\n')
+            return False
+        field, errors = next(iter(validator.errors.items()))
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
         error_string = pprint.pformat(errors)
 
         raise Exception(message_string.format(field, error_string))
+    return True
 
 
 class UnicodeDictWriter(csv.DictWriter, object):
@@ -279,18 +354,163 @@ class UnicodeDictWriter(csv.DictWriter, object):
             self.writerow(row)
 
 
+def write_csv_element(csv_writers, tag, el):
+    """
+    Write a shaped element to the csv writers, keyed by table name, the
+    records are already in column order so they are written as they are
+    """
+    if tag == 'node': #this is code from the problem set
+        csv_writers['nodes'].writerow(el.node)
+        csv_writers['nodes_tags'].writerows(el.node_tags)
+    elif tag == 'way':
+        csv_writers['ways'].writerow(el.way)
+        csv_writers['ways_nodes'].writerows(el.way_nodes)
+        csv_writers['ways_tags'].writerows(el.way_tags)
+
+
+def load_element(loader, tag, el, import_metrics, locations=None, indexer=None,
+                 geometry=None, parquet=None, interned_tags=None, shard_writer=None):
+    """
+    Add a shaped element's rows to the bulk loader along with its spatial
+    index entry, geometry, parquet and shard rows when those are being
+    built, the tags go through interned_tags when it is a TagDictionary
+    """
+    tag_rows = loader if interned_tags is None else interned_tags
+    if tag == 'node':
+        node = el.node
+        loader.add('nodes', node)
+        tag_rows.add_many('nodes_tags', el.node_tags)
+        import_metrics.lap('sqlite')
+        if locations is not None:
+            locations.add(node.id, node.lat, node.lon)
+        if indexer is not None:
+            indexer.add_node(node)
+        import_metrics.lap('spatial')
+        if parquet is not None:
+            parquet.add('nodes', node)
+            parquet.add_many('nodes_tags', el.node_tags)
+            import_metrics.lap('parquet')
+        if shard_writer is not None:
+            shard_writer.add_node(el)
+            import_metrics.lap('shards')
+
+    elif tag == 'way':
+        way = el.way
+        loader.add('ways', way)
+        tag_rows.add_many('ways_tags', el.way_tags)
+        loader.add_many('ways_nodes', el.way_nodes)
+        import_metrics.lap('sqlite')
+        coords = []
+        if locations is not None:
+            coords = locations.resolve_way(
+                way.id, [node_id for _, node_id, _ in el.way_nodes])
+            if indexer is not None:
+                indexer.add_way(way, coords)
+            if geometry is not None:
+                geometry.add_way(way, coords)
+        import_metrics.lap('spatial')
+        if parquet is not None:
+            parquet.add('ways', way)
+            parquet.add_many('ways_tags', el.way_tags)
+            parquet.add_many('ways_nodes', el.way_nodes)
+            import_metrics.lap('parquet')
+        if shard_writer is not None:
+            shard_writer.add_way(el, coords)
+            import_metrics.lap('shards')
+
+
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
+def process_map(file_in, validate, db_path=DB_PATH,
+                batch_size=bulk_loader.DEFAULT_BATCH_SIZE, fast_import=False,
+                workers=1, rejects_path=None, parquet_dir=None,
+                spatial_index=True, way_geometries=True, optimize=True,
+                vacuum=False, node_store_path=None, parser='expat',
+                metrics_stream=None, metrics_interval=metrics.DEFAULT_INTERVAL,
+                pipelined=False, bbox=None, polygon=None, keys=None,
+                tag_types=None, intern_tags=False, intern_values=None,
+                address_index=True, shard_dir=None,
+                shard_precision=shards.DEFAULT_PRECISION):
     """
     Iteratively process each XML element and write to csv(s)
     and insert them into an sql database as well after creating the appropriate
     tables in the database
+
+    db_path          sqlite database the tables are created in
+    batch_size       rows per executemany batch and transaction
+    fast_import      turn off the journal and syncing while the load runs
+    workers          parse and shape the file across this many processes,
+                     None for one per core
+    parser           'expat' shapes straight from the parser callbacks,
+                     'etree' builds an Element per node and way first
+    rejects_path     write elements that fail validation here as json
+                     lines and skip them instead of stopping the import
+    parquet_dir      also write the five tables here as typed parquet files,
+                     values that don't fit their column type are written as
+                     null and counted in the parquet_coerce_errors stat
+    spatial_index    build the R*Tree of node points and way boxes used by
+                     the spatial module
+    way_geometries   store each way's packed coordinates, length and box
+                     in way_geometry
+    optimize         build the secondary indexes and run ANALYZE once the
+                     rows are in
+    vacuum           compact the database file after optimizing
+    node_store_path  save the node location store here so it can be
+                     reopened memory mapped with node_store.NodeStore.open
+    metrics_stream   file to write a json line of progress, stage timings,
+                     counters and rss to every metrics_interval seconds,
+                     the final summary is returned under 'metrics' either way
+    pipelined        write the csvs and load sqlite in their own threads fed
+                     from the parser through bounded queues
+    bbox             (min_lat, min_lon, max_lat, max_lon), only nodes inside it
+                     and ways using any of them are imported
+    polygon          list of (lat, lon) points to use instead of or with bbox
+    keys             only import elements with a tag key in this list, shell
+                     style patterns like 'addr:*' can be used
+    tag_types        only import elements with a tag of one of these types
+    intern_tags      store tag keys and types once in lookup tables and make
+                     nodes_tags and ways_tags views, see tag_dictionary
+    intern_values    with intern_tags, also intern values seen this many times
+    address_index    build the address_search full text index after the load
+    shard_dir        also write one database per geohash tile and a
+                     manifest.json to this directory, see shards
+    shard_precision  geohash length of the shard tiles
+
+    the cache hits, misses and hit rate of every NORMALIZER cleaning rule
+    during the import are returned under 'normalizer'
     """
 
 
-    connection = sqlite3.connect('Street_Data.db')
+    normalizer_before = NORMALIZER.stats()
+    # the shaping done in worker processes is counted here
+    worker_normalizer = {}
+
+    element_filter = None
+    if bbox or polygon or keys or tag_types:
+        element_filter = filters.ElementFilter(bbox, polygon, keys, tag_types)
+
+    import_metrics = metrics.ImportMetrics(stream=metrics_stream,
+                                           interval=metrics_interval)
+    source = file_in
+    parse_workers = workers
+    parse_progress = None
+    # progress comes from how far into the file the serial parsers have read,
+    # for compressed files how much of the compressed file has been used
+    if compressed.is_compressed(file_in):
+        import_metrics.total_bytes = os.path.getsize(file_in)
+        source = import_metrics.track_reader(compressed.open_input(file_in, workers))
+        parse_workers = 1
+    elif isinstance(file_in, str) and not pbf_reader.is_pbf(file_in) and workers == 1:
+        import_metrics.total_bytes = os.path.getsize(file_in)
+        source = import_metrics.track_file(file_in)
+    elif isinstance(file_in, str) and not pbf_reader.is_pbf(file_in):
+        # the parallel parser counts the byte ranges it has handed back
+        import_metrics.total_bytes = os.path.getsize(file_in)
+        parse_progress = import_metrics.track_progress().add
+
+    # a pipelined import loads sqlite from the writer thread
+    connection = sqlite3.connect(db_path, check_same_thread=not pipelined)
     cursor = connection.cursor()
     # opens up the sql script to create each table in the sql database
     # corresponding with nodes, nodes_tags, ways, ways_nodes, ways_tags
@@ -300,81 +520,164 @@ def process_map(file_in, validate):
     sql_comm_split = sql_commands.split(';')
     for command in sql_comm_split:
         cursor.execute(command)
+    if spatial_index:
+        spatial.create_tables(cursor)
+    if way_geometries:
+        way_geometry.create_table(cursor)
+    if intern_tags:
+        tag_dictionary.create_tables(cursor)
     connection.commit()
 
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \ #this is code from the problem set
+    loader = bulk_loader.BulkLoader(connection, batch_size=batch_size,
+                                    fast_import=fast_import)
+    loader.add_table('nodes', NODE_FIELDS)
+    loader.add_table('ways', WAY_FIELDS)
+    loader.add_table('ways_nodes', WAY_NODES_FIELDS)
+    interned_tags = None
+    if intern_tags:
+        interned_tags = tag_dictionary.TagDictionary(loader, intern_values, cursor)
+    else:
+        loader.add_table('nodes_tags', NODE_TAGS_FIELDS)
+        loader.add_table('ways_tags', WAY_TAGS_FIELDS)
+    # node id to (lat, lon) for working out way boxes and geometries and
+    # for finding way nodes that point at nodes missing from the file
+    locations = None
+    if spatial_index or way_geometries or node_store_path or shard_dir:
+        locations = node_store.NodeStore()
+    indexer = spatial.SpatialIndexer(loader) if spatial_index else None
+    geometry = way_geometry.GeometryBuilder(loader) if way_geometries else None
+    shard_writer = None
+    if shard_dir:
+        shard_writer = shards.ShardWriter(
+            shard_dir, sql_comm_split, shard_precision,
+            tables={'nodes': NODE_FIELDS, 'nodes_tags': NODE_TAGS_FIELDS,
+                    'ways': WAY_FIELDS, 'ways_tags': WAY_TAGS_FIELDS,
+                    'ways_nodes': WAY_NODES_FIELDS},
+            fast_import=fast_import, optimize=optimize)
+
+    #this is code from the problem set
+    with codecs.open(NODES_PATH, 'w') as nodes_file, \
          codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
          codecs.open(WAYS_PATH, 'w') as ways_file, \
          codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = csv.DictWriter(nodes_file, NODE_FIELDS) #this is code I've updated
-        node_tags_writer = csv.DictWriter(nodes_tags_file, NODE_TAGS_FIELDS) #to work in Python 3
-        ways_writer = csv.DictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = csv.DictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = csv.DictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader() #this is code form the problem set
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
+         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file, \
+         loader:
+
+        # the shaped records are in column order so plain csv writers take
+        # them without a dictionary per row
+        nodes_writer = csv.writer(nodes_file) #this is code I've updated
+        node_tags_writer = csv.writer(nodes_tags_file) #to work in Python 3
+        ways_writer = csv.writer(ways_file)
+        way_nodes_writer = csv.writer(way_nodes_file)
+        way_tags_writer = csv.writer(way_tags_file)
+
+        nodes_writer.writerow(NODE_FIELDS) #this is code form the problem set
+        node_tags_writer.writerow(NODE_TAGS_FIELDS)
+        ways_writer.writerow(WAY_FIELDS)
+        way_nodes_writer.writerow(WAY_NODES_FIELDS)
+        way_tags_writer.writerow(WAY_TAGS_FIELDS)
+        csv_writers = {'nodes': nodes_writer, 'nodes_tags': node_tags_writer,
+                       'ways': ways_writer, 'ways_nodes': way_nodes_writer,
+                       'ways_tags': way_tags_writer}
+
+        validator = fast_validator.CompiledValidator(SCHEMA, records.SCHEMA_RECORDS)
+        rejects = codecs.open(rejects_path, 'w') if rejects_path else None
+        parquet = None
+        if parquet_dir:
+            parquet = columnar.ParquetWriterSet(parquet_dir, {
+                'nodes': NODE_FIELDS, 'nodes_tags': NODE_TAGS_FIELDS,
+                'ways': WAY_FIELDS, 'ways_nodes': WAY_NODES_FIELDS,
+                'ways_tags': WAY_TAGS_FIELDS})
+
+        def parsed_elements():
+            """shaped elements that passed validation"""
+            shaped = shaped_elements(source, parse_workers, parser=parser,
+                                     element_filter=element_filter,
+                                     normalizer_stats=worker_normalizer,
+                                     progress=parse_progress)
+            for tag, el in import_metrics.timed(shaped, 'parse_shape'):
+                import_metrics.tick()
+                if not el:
+                    continue
+                import_metrics.count(tag)
                 if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node': #the first three lines are from the
-                    nodes_writer.writerow(el['node']) #problem set the sql insertion code is mine
-                    node_tags_writer.writerows(el['node_tags'])
-                    nodes_v_list = [el['node']['id'], el['node']['lat'], el['node']['lon'],
-                                    el['node']['user'], el['node']['uid'],
-                                    el['node']['version'], el['node']['changeset'],
-                                    el['node']['timestamp']]
-                    cursor.execute('insert into nodes (id, lat, lon, user, uid,\
-                                   version, changeset, timestamp) values\
-                                   (?,?,?,?,?,?,?,?);',
-                                   nodes_v_list)
-                    nodes_tags_list = el['node_tags']
-                    for dictionary in nodes_tags_list:
-                        tag_list = [dictionary['id'], dictionary['key'], dictionary['value'],
-                                    dictionary['type']]
-                        cursor.execute('insert into nodes_tags(id, key, value, type)\
-                                       values (?, ?, ?, ?);', tag_list)
-                        connection.commit()
-
-                elif element.tag == 'way': #the first three lines are problem set code
-                    ways_writer.writerow(el['way']) #the sql insertions are my code
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
-                    ways_v_list=[el['way']['id'],
-                                 el['way']['user'], el['way']['uid'],
-                                 el['way']['version'], el['way']['changeset'],
-                                 el['way']['timestamp']]
-                    ways_tags_list = el['way_tags']
-                    ways_nodes_list = el['way_nodes']
-
-                    cursor.execute('insert into ways (id, user, uid,\
-                                   version, changeset, timestamp) values\
-                                   (?,?,?,?,?,?);', ways_v_list)
-                    connection.commit()
-                    for tag in ways_tags_list:
-                        tag_list = [tag['id'], tag['key'], tag['value'],
-                                    tag['type']]
-                        cursor.execute('insert into ways_tags(id, key, value, type)\
-                                       values (?, ?, ?, ?);', tag_list)
-                        connection.commit()
-                    for node in ways_nodes_list:
-                        node_list = [node['id'], node['node_id'], node['position']]
-                        cursor.execute('insert into ways_nodes (id, node_id, position)\
-                                       values (?, ?, ?);', node_list)
-                        connection.commit()
+                    import_metrics.start_lap()
+                    valid = validate_element(el, validator, rejects=rejects)
+                    import_metrics.lap('validate')
+                    if not valid:
+                        import_metrics.count('rejected')
+                        continue
+                yield tag, el
+
+        def write_csv(item):
+            import_metrics.start_lap()
+            write_csv_element(csv_writers, item[0], item[1])
+            import_metrics.lap('csv')
+
+        def write_db(item):
+            import_metrics.start_lap()
+            load_element(loader, item[0], item[1], import_metrics, locations,
+                         indexer, geometry, parquet, interned_tags, shard_writer)
+
+        if pipelined:
+            pipeline.run_pipeline(parsed_elements(), [('csv', write_csv),
+                                                      ('sqlite', write_db)])
+        else:
+            for item in parsed_elements():
+                write_csv(item)
+                write_db(item)
+
+        if rejects is not None:
+            rejects.close()
+        if parquet is not None:
+            parquet.close()
+        shard_manifest = None
+        if shard_writer is not None:
+            import_metrics.start_lap()
+            shard_manifest = shard_writer.close()
+            import_metrics.lap('shards')
+        import_metrics.start_lap()
+    import_metrics.lap('sqlite')
+    if source is not file_in:
+        source.close()
+
+    stats = loader.stats()
+    if locations is not None:
+        stats['dangling_way_nodes'] = locations.dangling_report()
+        if node_store_path:
+            locations.save(node_store_path)
+    if interned_tags is not None:
+        stats['tag_dictionary'] = interned_tags.stats()
+    if parquet is not None:
+        stats['parquet_coerce_errors'] = parquet.coerce_errors
+    if shard_manifest is not None:
+        stats['shards'] = {'tiles': len(shard_manifest['tiles']),
+                           'ways': shard_manifest['ways']}
+    if optimize:
+        import_metrics.start_lap()
+        stats['post_load'] = dict(post_load.optimize(connection, analyze=False))
+        import_metrics.lap('post_load')
+    if address_index:
+        import_metrics.start_lap()
+        stats['address_search'] = dict(address_search.build_index(connection))
+        import_metrics.lap('address_search')
+    if optimize:
+        # ANALYZE and VACUUM go last so they take in the address_search tables
+        import_metrics.start_lap()
+        stats['post_load'].update(post_load.finish(connection, vacuum=vacuum))
+        import_metrics.lap('post_load')
+    for table, table_stats in loader.stats().items():
+        import_metrics.count(table + '_rows', table_stats['rows'])
+    stats['normalizer'] = normalize.merge_stats(
+        normalize.stats_since(normalizer_before, NORMALIZER.stats()), worker_normalizer)
+    stats['metrics'] = import_metrics.summary()
+
+    connection.close()
+    return stats
 
 if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
-    process_map(OSM_PATH, validate=False)
+    # Note: validation uses the schema compiled by fast_validator so it is
+    # cheap enough to leave on, failing elements are collected in rejects.jsonl
+    STATS = process_map(OSM_PATH, validate=True, fast_import=True,
+                        rejects_path='rejects.jsonl')
+    pprint.pprint(STATS)
@@ -0,0 +1,154 @@
+'''
+Full text address search over Street_Data.db.  Once process_map has loaded
+the cleaned tags, the addr:* tags (including the street and postcode built
+from TIGER tags) and the name of every node and way with an address are
+gathered into one row per element of an FTS5 table, with the element's
+location.  search runs prefix matching queries against it ranked with bm25,
+so geocoding style lookups like '1200 hillsb' don't need a LIKE scan over
+the tag tables.
+'''
+import re
+import time
+
+ADDRESS_COLUMNS = ['housenumber', 'street', 'city', 'state', 'postcode', 'name']
+
+# bm25 weight of every column in the table, the unindexed ones don't count
+COLUMN_WEIGHTS = {'housenumber': 2.0, 'street': 4.0, 'city': 2.0, 'state': 0.5,
+                  'postcode': 3.0, 'name': 3.0}
+
+ADDRESS_SCHEMA = '''CREATE VIRTUAL TABLE IF NOT EXISTS address_search USING fts5(
+    element_type UNINDEXED, element_id UNINDEXED, lat UNINDEXED, lon UNINDEXED,
+    {0},
+    tokenize = "unicode61 remove_diacritics 2",
+    prefix = '1 2 3'
+)'''.format(', '.join(ADDRESS_COLUMNS))
+
+# the tag each column comes from as (type, key)
+COLUMN_TAGS = {'housenumber': ('addr', 'housenumber'), 'street': ('addr', 'street'),
+               'city': ('addr', 'city'), 'state': ('addr', 'state'),
+               'postcode': ('addr', 'postcode'), 'name': ('regular', 'name')}
+
+# every row's rowid is made from its element's id and type so refresh can
+# find it without scanning the unindexed element_type and element_id columns
+ROWID_TYPES = {'node': 1, 'way': 2}
+ROWID_MULTIPLIER = 4
+
+# one row per element with at least one addr tag, {location} joins in its lat and lon
+ADDRESS_SELECT = '''SELECT t.id * {multiplier} + {type_code}, '{element_type}', t.id,
+       {lat}, {lon}, {columns}
+FROM {table} t {location}
+WHERE (t.type = 'addr' OR (t.type = 'regular' AND t.key = 'name')) {where}
+GROUP BY t.id
+HAVING count(CASE WHEN t.type = 'addr' THEN 1 END) > 0'''
+
+# element type to its tag table and how its location is worked out, the
+# centre of the way's R*Tree box is used when there is one
+LOCATIONS = {'node': ('nodes_tags', 'JOIN nodes n ON n.id = t.id', 'n.lat', 'n.lon'),
+             'way': ('ways_tags', 'LEFT JOIN ways_rtree r ON r.id = t.id',
+                     '(r.min_lat + r.max_lat) / 2', '(r.min_lon + r.max_lon) / 2')}
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def address_rowid(element_type, element_id):
+    '''returns the rowid of an element's row in address_search'''
+    return int(element_id) * ROWID_MULTIPLIER + ROWID_TYPES[element_type]
+
+
+def create_table(cursor):
+    '''creates the address_search table if it isn't there yet'''
+    cursor.execute(ADDRESS_SCHEMA)
+
+
+def address_select(cursor, element_type, where=''):
+    '''returns the select statement that assembles the addresses of one element type'''
+    table, location, lat, lon = LOCATIONS[element_type]
+    if element_type == 'way' and cursor.execute(
+            "select 1 from sqlite_master where name = 'ways_rtree';").fetchone() is None:
+        location, lat, lon = '', 'NULL', 'NULL'
+    columns = ', '.join(
+        "max(CASE WHEN t.type = '{0}' AND t.key = '{1}' THEN t.value END)".format(
+            *COLUMN_TAGS[column]) for column in ADDRESS_COLUMNS)
+    return ADDRESS_SELECT.format(multiplier=ROWID_MULTIPLIER,
+                                 type_code=ROWID_TYPES[element_type],
+                                 element_type=element_type, lat=lat, lon=lon,
+                                 columns=columns, table=table, location=location,
+                                 where=where)
+
+
+def insert_statement(cursor, element_type, where=''):
+    '''returns the insert that adds the addresses of one element type'''
+    return ('INSERT INTO address_search (rowid, element_type, element_id, lat, lon, {0}) '
+            '{1};').format(
+        ', '.join(ADDRESS_COLUMNS), address_select(cursor, element_type, where))
+
+
+def build_index(connection):
+    '''
+    fills address_search from the loaded tags, replacing anything already
+    in it.  returns a list of (step, seconds) like post_load.optimize
+    '''
+    timings = []
+    cursor = connection.cursor()
+    create_table(cursor)
+    cursor.execute('DELETE FROM address_search;')
+    for element_type in ('node', 'way'):
+        begin = time.time()
+        cursor.execute(insert_statement(cursor, element_type))
+        connection.commit()
+        timings.append(('address_search_' + element_type + 's', time.time() - begin))
+    begin = time.time()
+    cursor.execute("INSERT INTO address_search (address_search) VALUES ('optimize');")
+    connection.commit()
+    timings.append(('address_search_optimize', time.time() - begin))
+    return timings
+
+
+def refresh(cursor, element_type, element_id):
+    '''
+    rebuilds the row of one element from its tags, used by osc_update when
+    an element is created, modified or deleted.  the old row is found by
+    its rowid, see address_rowid
+    '''
+    element_id = int(element_id)
+    cursor.execute('DELETE FROM address_search WHERE rowid = ?;',
+                   (address_rowid(element_type, element_id),))
+    cursor.execute(insert_statement(cursor, element_type, 'AND t.id = ?'), (element_id,))
+
+
+def match_expression(query, abbreviations=None):
+    '''
+    turns free text into an FTS5 query, every term is a prefix match.
+    abbreviations maps an abbreviation to its full form (like the MAPPING
+    street types in InsertDatatoSQLandCSV) so 'st' also finds 'Street'
+    '''
+    expanded = {}
+    if abbreviations:
+        for short, full in abbreviations.items():
+            expanded[short.lower().rstrip('.')] = full.lower()
+    parts = []
+    for term in TERM_RE.findall(query.lower()):
+        part = '"{0}"*'.format(term)
+        if term in expanded:
+            part = '({0} OR "{1}")'.format(part, expanded[term])
+        parts.append(part)
+    return ' AND '.join(parts)
+
+
+def search(connection, query, limit=10, abbreviations=None):
+    '''
+    returns up to limit addresses matching every term of query best match
+    first, each a dictionary of the element type, id, lat, lon, the address
+    columns and its bm25 score (lower is better)
+    '''
+    expression = match_expression(query, abbreviations)
+    if not expression:
+        return []
+    weights = ', '.join(['0.0'] * 4 + [str(COLUMN_WEIGHTS[column])
+                                       for column in ADDRESS_COLUMNS])
+    rows = connection.execute(
+        'SELECT element_type, element_id, lat, lon, {0}, bm25(address_search, {1}) AS score '
+        'FROM address_search WHERE address_search MATCH ? ORDER BY score LIMIT ?;'.format(
+            ', '.join(ADDRESS_COLUMNS), weights), (expression, limit))
+    fields = ['element_type', 'id', 'lat', 'lon'] + ADDRESS_COLUMNS + ['score']
+    return [dict(zip(fields, row)) for row in rows]
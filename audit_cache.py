@@ -0,0 +1,206 @@
+'''
+On disk cache of run_audit results so tuning the cleaning rules doesn't
+mean reparsing the same extract every time.  A finished audit is stored
+under a key made from the file (its path, size and mtime, or a hash of its
+contents) and the names and versions of the auditors that were run, so an
+unchanged file gets its report back straight away.
+
+Plain .osm files are also audited in chunks, the byte ranges
+parallel.split_file gives, and each chunk's result is cached under the hash
+of the chunk's bytes.  When a file has been appended to only the chunks
+that changed are parsed again and the chunk results are merged with each
+auditor's merge method.  A list of files (an extract split into pieces) is
+handled the same way one file at a time.  Compressed and .osm.pbf files
+are only cached whole.
+
+    results = audit_cache.cached_audit('RaleighStreetData.osm', cache_dir='.audit_cache')
+'''
+import hashlib
+import multiprocessing
+import os
+import pickle
+
+import Audit
+import compressed
+import parallel
+import pbf_reader
+
+DEFAULT_CACHE_DIR = '.audit_cache'
+# how the whole file is recognised, 'stat' is its path, size and mtime and
+# 'content' a hash of its bytes which also works after a copy or a touch
+KEY_MODES = ('stat', 'content')
+HASH_READ_SIZE = 1024 * 1024
+
+
+def auditor_classes(auditors):
+    '''
+    turns registered names, Auditor classes or Auditor instances into
+    classes, every chunk and merge needs fresh auditors so an instance
+    only stands for its class
+    '''
+    classes = []
+    for auditor in auditors:
+        if isinstance(auditor, str):
+            auditor = Audit.AUDITORS[auditor]
+        elif not isinstance(auditor, type):
+            auditor = type(auditor)
+        classes.append(auditor)
+    return classes
+
+
+def auditor_key(auditors):
+    '''
+    returns a string naming the auditors and their versions, auditors can
+    be names, Auditor classes or instances
+    '''
+    return ','.join(sorted('{0}:{1}'.format(auditor.name, auditor.version)
+                           for auditor in auditor_classes(auditors)))
+
+
+def digest(*parts):
+    '''hex sha256 of the parts joined together'''
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+def file_hash(path, start=0, end=None):
+    '''hex sha256 of the bytes of a file between start and end'''
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as osm_file:
+        osm_file.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            size = HASH_READ_SIZE if remaining is None else min(HASH_READ_SIZE, remaining)
+            data = osm_file.read(size)
+            if not data:
+                break
+            hasher.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return hasher.hexdigest()
+
+
+def file_key(path, auditors, key='stat'):
+    '''returns the cache key of the audit of a whole file'''
+    if key == 'content':
+        return digest('content', file_hash(path), auditor_key(auditors))
+    stat = os.stat(path)
+    return digest('stat', os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                  auditor_key(auditors))
+
+
+class AuditCache(object):
+    '''pickled results in cache_dir, one file per key'''
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, kind, key):
+        return os.path.join(self.cache_dir, kind, key + '.pickle')
+
+    def get(self, kind, key):
+        '''returns the cached results or None'''
+        try:
+            with open(self.path(kind, key), 'rb') as cached:
+                results = pickle.load(cached)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return results
+
+    def put(self, kind, key, results):
+        '''stores results, written to a temporary file first so a crash
+        can't leave half a pickle behind'''
+        path = self.path(kind, key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as cached:
+            pickle.dump(results, cached, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+
+
+def merge_results(auditors, results_list):
+    '''merges a list of run_audit results into one with the auditors' merge'''
+    merged = Audit.make_auditors(auditors)
+    for results in results_list:
+        for auditor in merged:
+            auditor.merge(results[auditor.name])
+    return dict((auditor.name, auditor.result) for auditor in merged)
+
+
+def audit_range(args):
+    '''worker function, audits one byte range of a plain .osm file'''
+    path, start, end, auditors = args
+    return Audit.audit_stream(parallel.read_range(path, start, end),
+                              Audit.make_auditors(auditors))
+
+
+def audit_chunks(path, auditors, cache, chunk_size=parallel.DEFAULT_CHUNK_SIZE,
+                 workers=1):
+    '''
+    audits a plain .osm file chunk by chunk, using the cached result of
+    every chunk whose bytes haven't changed and auditing the rest across
+    workers processes.  returns the merged results
+    '''
+    auditors_id = auditor_key(auditors)
+    ranges = parallel.split_file(path, chunk_size)
+    keys = [digest(file_hash(path, start, end), auditors_id) for start, end in ranges]
+    chunk_results = [cache.get('chunks', key) for key in keys]
+    missing = [index for index, results in enumerate(chunk_results) if results is None]
+    jobs = [(path, ranges[index][0], ranges[index][1], auditors) for index in missing]
+    if workers == 1 or len(jobs) < 2:
+        audited = [audit_range(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            audited = pool.map(audit_range, jobs)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    for index, results in zip(missing, audited):
+        cache.put('chunks', keys[index], results)
+        chunk_results[index] = results
+    return merge_results(auditors, chunk_results)
+
+
+def cached_audit(osmfile, auditors=Audit.DEFAULT_AUDITORS, cache_dir=DEFAULT_CACHE_DIR,
+                 key='stat', workers=1, chunk_size=parallel.DEFAULT_CHUNK_SIZE,
+                 cache=None):
+    '''
+    run_audit with a cache, osmfile can be a path or a list of paths whose
+    results are merged.  auditors are registered names, Auditor classes or
+    instances, fresh ones of the same class are made for every chunk.
+    returns a dictionary of auditor name to result
+    '''
+    if key not in KEY_MODES:
+        raise ValueError('key must be one of {0}'.format(', '.join(KEY_MODES)))
+    auditors = auditor_classes(auditors)
+    cache = cache or AuditCache(cache_dir)
+    if isinstance(osmfile, (list, tuple)):
+        return merge_results(auditors, [
+            cached_audit(path, auditors, cache_dir, key, workers, chunk_size, cache)
+            for path in osmfile])
+
+    whole_key = file_key(osmfile, auditors, key)
+    results = cache.get('files', whole_key)
+    if results is not None:
+        return results
+    if pbf_reader.is_pbf(osmfile) or compressed.is_compressed(osmfile):
+        results = Audit.run_audit(osmfile, auditors, workers=workers)
+    else:
+        try:
+            results = audit_chunks(osmfile, auditors, cache, chunk_size, workers)
+        except Audit.UnmergeableAudit:
+            # an auditor whose chunk results can't be merged, audit it whole
+            results = Audit.run_audit(osmfile, auditors, workers=workers)
+    cache.put('files', whole_key, results)
+    return results
@@ -0,0 +1,304 @@
+'''
+Benchmarks for the audit and import code that don't need the real
+RaleighStreetData file.  make_osm writes a synthetic .osm file of any size
+with a mix of clean and messy addr:* tags, TIGER tags and long ways, then
+each stage is timed in its own fresh process so its peak memory can be read
+from the process's max RSS.  Results are saved as json and compared against
+an earlier run to catch regressions between releases.
+
+    python benchmark.py --nodes 200000 --ways 30000 --baseline old.json
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STREETS = ['Hillsborough', 'Glenwood', 'Six Forks', 'Falls of Neuse', 'Oberlin',
+           'Wade', 'Fayetteville', 'Capital', 'Laurelcherry', 'Western']
+STREET_TYPES = ['St', 'St.', 'Street', 'Ave', 'Ave.', 'Avenue', 'Blvd', 'Rd',
+                'Dr', 'Ct', 'Pkwy', 'Ln', 'Pl', 'Cir', 'Way']
+CITIES = ['Raleigh', 'raleigh', 'Ralegh', ' Raleigh', 'Cary', 'cary',
+          'Wake Forest', 'wake Forest', 'Apex, NC', 'Durham']
+STATES = ['NC', 'nc', 'North Carolina', 'N.C.', 'NC-', 'N. Carolina']
+POSTCODES = ['27606', '27607', '27609-1234', 'NC 27587', '27615', '2612-6401']
+REGULAR_TAGS = [('highway', 'residential'), ('amenity', 'cafe'), ('building', 'yes'),
+                ('name', 'Pullen Park'), ('shop', 'convenience'), ('source', 'survey')]
+
+# stages in the order they are run, see run_stage
+STAGES = ['audit', 'count_tags', 'get_element', 'shape_element', 'validation',
+          'process_map']
+# seconds a stage may run before it is treated as hung
+STAGE_TIMEOUT = 3600
+
+
+def xml_escape(value):
+    '''escapes a value for use inside an xml attribute'''
+    return (value.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+def make_osm(path, nodes=100000, ways=15000, tagged_fraction=0.3,
+             tiger_fraction=0.3, long_way_fraction=0.02, long_way_length=2000,
+             seed=0):
+    '''
+    writes a synthetic .osm file, tagged_fraction of the nodes get an
+    address with messy street, city, state and postcode values,
+    tiger_fraction of the ways get TIGER tags and long_way_fraction of the
+    ways have long_way_length nodes.  returns the number of elements
+    '''
+    rand = random.Random(seed)
+    with open(path, 'w') as osm_file:
+        osm_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<osm version="0.6" generator="benchmark">\n'
+                       ' <bounds minlat="35.7" minlon="-78.8" maxlat="35.9" '
+                       'maxlon="-78.5"/>\n')
+        for node_id in range(1, nodes + 1):
+            attrs = ('id="{0}" lat="{1:.7f}" lon="{2:.7f}" version="{3}" '
+                     'timestamp="2017-03-01T12:00:00Z" changeset="{4}" uid="{5}" '
+                     'user="mapper{5}"').format(
+                         node_id, 35.7 + rand.random() * 0.2,
+                         -78.8 + rand.random() * 0.3, rand.randint(1, 9),
+                         rand.randint(1, 50000000), rand.randint(1, 5000))
+            if rand.random() >= tagged_fraction:
+                osm_file.write('  <node {0}/>\n'.format(attrs))
+                continue
+            osm_file.write('  <node {0}>\n'.format(attrs))
+            tags = [('addr:housenumber', str(rand.randint(1, 9999))),
+                    ('addr:street', '{0} {1}'.format(rand.choice(STREETS),
+                                                     rand.choice(STREET_TYPES))),
+                    ('addr:city', rand.choice(CITIES)),
+                    ('addr:state', rand.choice(STATES)),
+                    ('addr:postcode', rand.choice(POSTCODES))]
+            tags.append(rand.choice(REGULAR_TAGS))
+            for key, value in tags:
+                osm_file.write('    <tag k="{0}" v="{1}"/>\n'.format(
+                    key, xml_escape(value)))
+            osm_file.write('  </node>\n')
+        for way_index in range(ways):
+            osm_file.write('  <way id="{0}" version="1" timestamp="2017-03-01T12:00:00Z" '
+                           'changeset="{1}" uid="{2}" user="mapper{2}">\n'.format(
+                               nodes + way_index + 1, rand.randint(1, 50000000),
+                               rand.randint(1, 5000)))
+            if rand.random() < long_way_fraction:
+                length = long_way_length
+            else:
+                length = rand.randint(2, 20)
+            start = rand.randint(1, max(1, nodes - length))
+            for node_id in range(start, min(nodes, start + length) + 1):
+                osm_file.write('    <nd ref="{0}"/>\n'.format(node_id))
+            osm_file.write('    <tag k="highway" v="residential"/>\n')
+            osm_file.write('    <tag k="name" v="{0} {1}"/>\n'.format(
+                rand.choice(STREETS), rand.choice(STREET_TYPES)))
+            if rand.random() < tiger_fraction:
+                for key, value in (('tiger:county', 'Wake, NC'),
+                                   ('tiger:name_base', rand.choice(STREETS)),
+                                   ('tiger:name_type', rand.choice(STREET_TYPES)),
+                                   ('tiger:name_direction_suffix', 'W'),
+                                   ('tiger:zip_left', rand.choice(POSTCODES)),
+                                   ('tiger:reviewed', 'no')):
+                    osm_file.write('    <tag k="{0}" v="{1}"/>\n'.format(
+                        key, xml_escape(value)))
+            osm_file.write('  </way>\n')
+        osm_file.write('</osm>\n')
+    return nodes + ways
+
+
+# ================================================== #
+#               Stages                               #
+# ================================================== #
+def import_modules():
+    '''imports the modules the stages run, returns (Audit, importer)'''
+    sys.path.insert(0, HERE)
+    import Audit
+    import InsertDatatoSQLandCSV as importer
+    return Audit, importer
+
+
+def run_stage(stage, osm_path, workdir, modules):
+    '''
+    runs one stage against the file, called in a fresh process with the
+    modules import_modules returned
+    '''
+    Audit, importer = modules
+    if stage == 'audit':
+        Audit.audit(osm_path)
+    elif stage == 'count_tags':
+        Audit.count_tags(osm_path)
+    elif stage == 'get_element':
+        for _ in importer.get_element(osm_path, tags=('node', 'way')):
+            pass
+    elif stage == 'shape_element':
+        for element in importer.get_element(osm_path, tags=('node', 'way')):
+            importer.shape_element(element)
+    elif stage == 'validation':
+        validator = importer.fast_validator.CompiledValidator(
+            importer.SCHEMA, importer.records.SCHEMA_RECORDS)
+        for _, shaped in importer.shaped_elements(osm_path):
+            importer.validate_element(shaped, validator)
+    elif stage == 'process_map':
+        os.chdir(workdir)
+        importer.process_map(osm_path, validate=False, db_path='benchmark.db')
+
+
+def max_rss():
+    '''the peak rss of this process so far in bytes'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+def timed_stage(stage, osm_path, workdir, results):
+    '''
+    child process body, puts (seconds, peak rss, rss after imports) in bytes
+    on results.  the modules are imported before the clock starts so their
+    import time isn't counted, ru_maxrss can only give the peak so the rss
+    the imports left is reported alongside it
+    '''
+    modules = import_modules()
+    import_rss = max_rss()
+    begin = time.time()
+    run_stage(stage, osm_path, workdir, modules)
+    seconds = time.time() - begin
+    results.put((seconds, max_rss(), import_rss))
+
+
+def wait_for_stage(stage, process, results, timeout):
+    '''
+    returns what the stage's process put on results, RuntimeError is raised
+    if it exits without reporting or runs for longer than timeout seconds
+    '''
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            # it may have reported just before exiting
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                raise RuntimeError('stage {0} failed with exit code {1}'.format(
+                    stage, process.exitcode))
+        if time.time() > deadline:
+            process.terminate()
+            raise RuntimeError('stage {0} timed out after {1}s'.format(stage, timeout))
+
+
+def benchmark(osm_path, elements, stages=STAGES, timeout=STAGE_TIMEOUT):
+    '''
+    times every stage in a fresh spawned process, returns a dictionary of
+    stage name to seconds, elements per second, peak rss and the rss the
+    stage added over its imports.  RuntimeError is raised when a stage
+    fails or runs for longer than timeout seconds
+    '''
+    context = multiprocessing.get_context('spawn')
+    report = {}
+    for stage in stages:
+        workdir = tempfile.mkdtemp(prefix='osm_benchmark_')
+        try:
+            shutil.copy(os.path.join(HERE, 'data_wrangling_schema.sql'), workdir)
+            results = context.Queue()
+            process = context.Process(target=timed_stage,
+                                      args=(stage, os.path.abspath(osm_path), workdir,
+                                            results))
+            process.start()
+            try:
+                seconds, peak, import_rss = wait_for_stage(stage, process, results,
+                                                           timeout)
+            finally:
+                process.join()
+            if process.exitcode != 0:
+                raise RuntimeError('stage {0} failed with exit code {1}'.format(
+                    stage, process.exitcode))
+        finally:
+            shutil.rmtree(workdir)
+        report[stage] = {'seconds': seconds,
+                         'elements_per_second': elements / seconds if seconds else 0.0,
+                         'peak_rss': peak,
+                         'stage_rss': peak - import_rss}
+    return report
+
+
+def compare(baseline, current, tolerance=0.1):
+    '''
+    returns a list of messages for stages that got slower or used more
+    memory than the baseline by more than tolerance
+    '''
+    regressions = []
+    for stage, stats in current.items():
+        old = baseline.get(stage)
+        if old is None:
+            continue
+        if stats['elements_per_second'] < old['elements_per_second'] * (1 - tolerance):
+            regressions.append('{0}: {1:,.0f} elements/s, was {2:,.0f}'.format(
+                stage, stats['elements_per_second'], old['elements_per_second']))
+        # stage_rss leaves out what the imports use, older results only
+        # have the whole process's peak
+        rss = 'stage_rss' if 'stage_rss' in old else 'peak_rss'
+        if stats[rss] > old[rss] * (1 + tolerance):
+            regressions.append('{0}: {1} {2:,d} bytes, was {3:,d}'.format(
+                stage, rss.replace('_', ' '), stats[rss], old[rss]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--nodes', type=int, default=100000)
+    parser.add_argument('--ways', type=int, default=15000)
+    parser.add_argument('--tagged-fraction', type=float, default=0.3)
+    parser.add_argument('--tiger-fraction', type=float, default=0.3)
+    parser.add_argument('--long-way-fraction', type=float, default=0.02)
+    parser.add_argument('--long-way-length', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--timeout', type=float, default=STAGE_TIMEOUT,
+                        help='seconds a stage may run before the benchmark fails')
+    args = parser.parse_args()
+
+    osm_dir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    try:
+        osm_path = os.path.join(osm_dir, 'synthetic.osm')
+        elements = make_osm(osm_path, args.nodes, args.ways, args.tagged_fraction,
+                            args.tiger_fraction, args.long_way_fraction,
+                            args.long_way_length, args.seed)
+        report = benchmark(osm_path, elements, args.stages, args.timeout)
+    finally:
+        shutil.rmtree(osm_dir)
+
+    for stage, stats in report.items():
+        print('{0:<14} {1:>8.2f}s {2:>12,.0f} elements/s {3:>8.1f} MB peak '
+              '{4:>8.1f} MB over imports'.format(
+                  stage, stats['seconds'], stats['elements_per_second'],
+                  stats['peak_rss'] / 1024.0 / 1024.0,
+                  stats['stage_rss'] / 1024.0 / 1024.0))
+    with open(args.output, 'w') as output:
+        json.dump({'settings': vars(args), 'elements': elements, 'stages': report},
+                  output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(json.load(baseline_file)['stages'], report,
+                                  args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
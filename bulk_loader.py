@@ -0,0 +1,150 @@
+'''
+Batched sqlite3 loader used by process_map.  Instead of running one
+cursor.execute and one commit for every row it buffers the shaped rows for
+each table and writes them with executemany, committing once per batch so
+that a full import only needs a handful of transactions.
+'''
+import time
+
+
+# sqlite3 pragmas used while a fast import is running.  Turning off the
+# journal and the fsync after every transaction is only safe because a failed
+# import is simply rerun from scratch.
+FAST_IMPORT_PRAGMAS = {'journal_mode': 'OFF',
+                       'synchronous': 'OFF',
+                       'temp_store': 'MEMORY',
+                       'cache_size': '-200000'}
+
+DEFAULT_BATCH_SIZE = 50000
+
+
+class BulkLoader(object):
+    '''
+    buffers rows for each table and inserts them with executemany once
+    batch_size rows are waiting, tables are registered with the column
+    order used in the insert statement
+    '''
+
+    def __init__(self, connection, batch_size=DEFAULT_BATCH_SIZE,
+                 fast_import=False):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.fast_import = fast_import
+        self.columns = {}
+        self.statements = {}
+        self.buffers = {}
+        self.row_counts = {}
+        self.insert_time = {}
+        self.pending = 0
+        self.start_time = None
+        self.end_time = None
+        self.saved_pragmas = {}
+
+    def add_table(self, table, columns):
+        '''
+        registers a table and the column order of the rows that will be
+        added to it
+        '''
+        self.columns[table] = list(columns)
+        self.statements[table] = 'insert into {0} ({1}) values ({2});'.format(
+            table, ', '.join(columns), ', '.join('?' * len(columns)))
+        self.buffers[table] = []
+        self.row_counts[table] = 0
+        self.insert_time[table] = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.connection.rollback()
+            self.restore_pragmas()
+        return False
+
+    def start(self):
+        '''
+        switches on the fast import pragmas if asked for and starts the
+        clock used for the rows per second report
+        '''
+        if self.fast_import:
+            cursor = self.connection.cursor()
+            for pragma, value in FAST_IMPORT_PRAGMAS.items():
+                self.saved_pragmas[pragma] = cursor.execute(
+                    'pragma {0};'.format(pragma)).fetchone()[0]
+                cursor.execute('pragma {0} = {1};'.format(pragma, value))
+        self.start_time = time.time()
+
+    def restore_pragmas(self):
+        '''puts back the pragma values that were in place before start'''
+        cursor = self.connection.cursor()
+        for pragma, value in self.saved_pragmas.items():
+            cursor.execute('pragma {0} = {1};'.format(pragma, value))
+        self.saved_pragmas = {}
+
+    def add(self, table, row):
+        '''
+        adds a single row to the buffer for table, row can either be a
+        sequence in column order or a dictionary keyed by column name
+        '''
+        if isinstance(row, dict):
+            row = [row[column] for column in self.columns[table]]
+        self.buffers[table].append(row)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def add_many(self, table, rows):
+        '''adds every row in rows to the buffer for table'''
+        for row in rows:
+            self.add(table, row)
+
+    def flush(self):
+        '''
+        writes every buffered row to the database and commits them as
+        one transaction
+        '''
+        cursor = self.connection.cursor()
+        for table, rows in self.buffers.items():
+            if not rows:
+                continue
+            begin = time.time()
+            cursor.executemany(self.statements[table], rows)
+            self.insert_time[table] += time.time() - begin
+            self.row_counts[table] += len(rows)
+            self.buffers[table] = []
+        self.connection.commit()
+        self.pending = 0
+
+    def finish(self):
+        '''flushes the remaining rows and restores the pragmas'''
+        self.flush()
+        self.end_time = time.time()
+        self.restore_pragmas()
+
+    def stats(self):
+        '''
+        returns a dictionary of rows inserted and rows per second for
+        every table, the rate is based on the time spent inside
+        executemany for that table
+        '''
+        report = {}
+        for table, count in self.row_counts.items():
+            seconds = self.insert_time[table]
+            report[table] = {'rows': count,
+                             'seconds': seconds,
+                             'rows_per_second': count / seconds if seconds else 0.0}
+        return report
+
+    def report(self):
+        '''returns a printable summary of the load'''
+        lines = []
+        for table, table_stats in sorted(self.stats().items()):
+            lines.append('{0:<12} {1:>12,d} rows {2:>14,.0f} rows/s'.format(
+                table, table_stats['rows'], table_stats['rows_per_second']))
+        if self.start_time is not None and self.end_time is not None:
+            lines.append('total load time {0:.2f}s'.format(
+                self.end_time - self.start_time))
+        return '\n'.join(lines)
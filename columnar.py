@@ -0,0 +1,143 @@
+'''
+Parquet output for the five tables process_map writes.  Rows are buffered
+per table and written as row groups while the file is streamed, the column
+types come from schema.py so ids are int64 and lat/lon are float64 instead
+of the untyped text in the csvs.  pyarrow is only needed when this output is
+turned on, it isn't imported until then so importing this module (and the
+importer with it) stays cheap.
+'''
+import os
+
+import schema
+
+# imported by load_pyarrow the first time parquet is written or read
+pyarrow = None
+
+DEFAULT_ROW_GROUP_SIZE = 500000
+DEFAULT_COMPRESSION = 'zstd'
+
+# table name to the record type holding its fields in schema.schema
+TABLE_RECORDS = {'nodes': 'node',
+                 'nodes_tags': 'node_tags',
+                 'ways': 'way',
+                 'ways_nodes': 'way_nodes',
+                 'ways_tags': 'way_tags'}
+
+ARROW_TYPES = {'integer': 'int64', 'float': 'float64', 'string': 'string'}
+
+
+def load_pyarrow(action):
+    '''
+    imports pyarrow and pyarrow.parquet if they haven't been yet, action
+    is what needed them for the ImportError message
+    '''
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            pyarrow = None
+            raise ImportError('pyarrow is needed to {0} parquet output'.format(action))
+    return pyarrow
+
+
+def field_rules(table):
+    '''returns the schema.py rules for each field of a table'''
+    rules = schema.schema[TABLE_RECORDS[table]]
+    if rules['type'] == 'list':
+        rules = rules['schema']
+    return rules['schema']
+
+
+def arrow_schema(table, fields):
+    '''builds the pyarrow schema for a table with its columns in fields order'''
+    rules = field_rules(table)
+    return pyarrow.schema([(field, ARROW_TYPES[rules[field]['type']])
+                           for field in fields])
+
+
+class ParquetWriterSet(object):
+    '''
+    one parquet writer per table, rows are coerced with the schema.py
+    coerce functions and written out every row_group_size rows.  a value
+    its coerce function can't convert, like a lat of 'abc' when validation
+    is off, is written as null so the row still lines up with the csv and
+    sqlite tables, those values are counted per table in coerce_errors
+    '''
+
+    def __init__(self, directory, tables, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                 compression=DEFAULT_COMPRESSION):
+        load_pyarrow('write')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.row_group_size = row_group_size
+        self.fields = {}
+        self.coercers = {}
+        self.schemas = {}
+        self.columns = {}
+        self.writers = {}
+        self.coerce_errors = {}
+        for table, fields in tables.items():
+            rules = field_rules(table)
+            self.fields[table] = list(fields)
+            self.coercers[table] = [rules[field].get('coerce') for field in fields]
+            self.schemas[table] = arrow_schema(table, fields)
+            self.columns[table] = [[] for _ in fields]
+            self.writers[table] = pyarrow.parquet.ParquetWriter(
+                os.path.join(directory, table + '.parquet'),
+                self.schemas[table], compression=compression)
+
+    def add(self, table, row):
+        '''
+        adds one shaped row to the buffer for table, row can either be a
+        sequence in column order, like the records shape_record gives, or a
+        dictionary keyed by column name
+        '''
+        if isinstance(row, dict):
+            row = [row[field] for field in self.fields[table]]
+        columns = self.columns[table]
+        for index, value in enumerate(row):
+            coerce = self.coercers[table][index]
+            if coerce and value is not None:
+                try:
+                    value = coerce(value)
+                except (TypeError, ValueError):
+                    value = None
+                    self.coerce_errors[table] = self.coerce_errors.get(table, 0) + 1
+            columns[index].append(value)
+        if len(columns[0]) >= self.row_group_size:
+            self.write_row_group(table)
+
+    def add_many(self, table, rows):
+        '''adds every row in rows to the buffer for table'''
+        for row in rows:
+            self.add(table, row)
+
+    def write_row_group(self, table):
+        '''writes the buffered rows of a table out as one row group'''
+        columns = self.columns[table]
+        if not columns[0]:
+            return
+        batch = pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type)
+             for column, field in zip(columns, self.schemas[table])],
+            schema=self.schemas[table])
+        self.writers[table].write_table(batch)
+        self.columns[table] = [[] for _ in columns]
+
+    def close(self):
+        '''writes the remaining rows and closes every file'''
+        for table in self.writers:
+            self.write_row_group(table)
+            self.writers[table].close()
+
+
+def read_table(directory, table, columns=None):
+    '''
+    reads a table back from the parquet output, only the columns listed
+    are read from disk
+    '''
+    load_pyarrow('read')
+    return pyarrow.parquet.read_table(os.path.join(directory, table + '.parquet'),
+                                      columns=columns)
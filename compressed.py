@@ -0,0 +1,193 @@
+'''
+Streams .osm.bz2, .osm.gz and .osm.xz extracts straight into the parsers so
+they don't have to be decompressed to disk first.  Multi-stream bz2 files
+(pbzip2 and lbzip2 output, and the planet dumps) are split on the stream
+headers and the streams are decompressed across a process pool, then handed
+back in file order as one readable stream.  Single stream bz2, gzip and xz
+can't be split so they are decompressed in this process.
+
+Every reader keeps count of the compressed bytes it has consumed in
+bytes_read, so import progress can still be worked out from the file size.
+'''
+import bz2
+import collections
+import gzip
+import lzma
+import multiprocessing
+import os
+import re
+
+import metrics
+
+COMPRESSED_OPENERS = {'.bz2': bz2.open, '.gz': gzip.open, '.xz': lzma.open}
+
+# 'BZh', the block size digit, then the magic number every first block starts with
+BZ2_STREAM_RE = re.compile(br'BZh[1-9]\x31\x41\x59\x26\x53\x59')
+# streams are grouped into pieces of about this many compressed bytes
+DEFAULT_PIECE_SIZE = 8 * 1024 * 1024
+SCAN_SIZE = 1024 * 1024
+
+
+def is_compressed(osm_file):
+    '''returns True if osm_file is the path of a .bz2, .gz or .xz file'''
+    return isinstance(osm_file, str) and \
+        os.path.splitext(osm_file)[1].lower() in COMPRESSED_OPENERS
+
+
+class SerialReader(object):
+    '''decompresses a file in this process with bz2, gzip or lzma'''
+
+    def __init__(self, path):
+        opener = COMPRESSED_OPENERS[os.path.splitext(path)[1].lower()]
+        self.counter = metrics.CountingReader(open(path, 'rb'))
+        self.stream = opener(self.counter, 'rb')
+
+    @property
+    def bytes_read(self):
+        return self.counter.bytes_read
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream.close()
+        self.counter.close()
+
+
+# ================================================== #
+#               Parallel bz2                         #
+# ================================================== #
+def find_bz2_streams(path):
+    '''returns the byte offsets of every bz2 stream header in the file'''
+    offsets = []
+    overlap = 9
+    with open(path, 'rb') as bz2_file:
+        position = 0
+        while True:
+            bz2_file.seek(position)
+            window = bz2_file.read(SCAN_SIZE + overlap)
+            for match in BZ2_STREAM_RE.finditer(window):
+                if match.start() < SCAN_SIZE or len(window) <= SCAN_SIZE:
+                    offsets.append(position + match.start())
+            if len(window) <= SCAN_SIZE:
+                return offsets
+            position += SCAN_SIZE
+
+
+def split_bz2(path, piece_size=DEFAULT_PIECE_SIZE):
+    '''
+    returns (start, end) byte ranges that each hold one or more whole bz2
+    streams, or None if the file is a single stream and can't be split
+    '''
+    offsets = find_bz2_streams(path)
+    if len(offsets) < 2 or offsets[0] != 0:
+        return None
+    file_size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    for offset in offsets[1:]:
+        if offset - start >= piece_size:
+            ranges.append((start, offset))
+            start = offset
+    ranges.append((start, file_size))
+    return ranges
+
+
+def decompress_range(args):
+    '''
+    worker function, decompresses the streams in one byte range.  returns
+    None if the range doesn't end on a stream boundary, which happens when
+    compressed data happens to look like a stream header
+    '''
+    path, start, end = args
+    with open(path, 'rb') as bz2_file:
+        bz2_file.seek(start)
+        data = bz2_file.read(end - start)
+    pieces = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        try:
+            pieces.append(decompressor.decompress(data))
+        except (OSError, EOFError):
+            return None
+        if not decompressor.eof:
+            return None
+        data = decompressor.unused_data
+    return b''.join(pieces)
+
+
+class ParallelBz2Reader(object):
+    '''
+    decompresses the ranges from split_bz2 across workers processes, only
+    2 ranges per worker are in flight at a time so memory stays bounded
+    '''
+
+    def __init__(self, path, ranges, workers=None):
+        self.path = path
+        self.ranges = ranges
+        self.workers = workers or multiprocessing.cpu_count()
+        self.bytes_read = 0
+        self.buffer = b''
+        self.position = 0
+        self.pool = multiprocessing.Pool(self.workers)
+        self.in_flight = collections.deque()
+        self.next_range = 0
+        # a range that failed to decompress on its own, joined to the next
+        self.carried = None
+
+    def fill(self):
+        '''decompresses the next range into the buffer, False at the end'''
+        while self.next_range < len(self.ranges) and \
+                len(self.in_flight) < self.workers * 2:
+            start, end = self.ranges[self.next_range]
+            self.in_flight.append(((start, end), self.pool.apply_async(
+                decompress_range, ((self.path, start, end),))))
+            self.next_range += 1
+        if not self.in_flight:
+            if self.carried is not None:
+                raise IOError('{0} ends in the middle of a bz2 stream'.format(self.path))
+            return False
+        (start, end), result = self.in_flight.popleft()
+        if self.carried is not None:
+            start = self.carried
+            data = decompress_range((self.path, start, end))
+        else:
+            data = result.get()
+        if data is None:
+            self.carried = start
+            return self.fill()
+        self.carried = None
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        self.bytes_read = end
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self.fill():
+                pass
+            size = len(self.buffer) - self.position
+        while len(self.buffer) - self.position < size and self.fill():
+            pass
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.buffer = b''
+        self.in_flight.clear()
+
+
+def open_input(path, workers=None, piece_size=DEFAULT_PIECE_SIZE):
+    '''
+    opens a compressed extract for reading as a binary stream of the xml,
+    multi-stream bz2 is decompressed across workers processes (one per
+    core when workers is None, in this process when it is 1)
+    '''
+    if path.lower().endswith('.bz2') and workers != 1:
+        ranges = split_bz2(path, piece_size)
+        if ranges is not None:
+            return ParallelBz2Reader(path, ranges, workers)
+    return SerialReader(path)
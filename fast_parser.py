@@ -0,0 +1,74 @@
+'''
+Expat based fast path for process_map.  Instead of building an Element for
+every node and way and walking it with findall, the start and end callbacks
+collect each element's attributes and its tag and nd children as plain
+dicts and hand them straight to shape_record, the same shaping code
+shape_element uses, so the output is identical.  nd positions are counted as
+the children arrive so long ways cost linear time.
+'''
+import xml.parsers.expat
+
+READ_SIZE = 1024 * 1024
+
+
+class ShapingHandler(object):
+    '''
+    expat callbacks that shape every top level node and way as soon as
+    its end tag is seen, the shaped records wait in shaped until collected
+    '''
+
+    def __init__(self, shape, tags=('node', 'way')):
+        self.shape = shape
+        self.tags = tags
+        self.current = None
+        self.attrib = None
+        self.children = None
+        self.shaped = []
+
+    def start(self, name, attrib):
+        if self.current is not None:
+            self.children.append((name, attrib))
+        elif name in self.tags:
+            self.current = name
+            self.attrib = attrib
+            self.children = []
+
+    def end(self, name):
+        if name == self.current:
+            shaped = self.shape(name, self.attrib, self.children)
+            # a filtered shape returns None for elements that are left out
+            if shaped is not None:
+                self.shaped.append((name, shaped))
+            self.current = None
+            self.attrib = None
+            self.children = None
+
+
+def iter_shaped(osm_file, shape, tags=('node', 'way'), read_size=READ_SIZE):
+    '''
+    yields (tag, shaped element) pairs for every node and way in the file,
+    shape is called with (tag, attributes, children) like shape_attribs.
+    osm_file can be a path or a file object opened in binary mode
+    '''
+    handler = ShapingHandler(shape, tags)
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.buffer_text = True
+
+    opened = isinstance(osm_file, str)
+    if opened:
+        osm_file = open(osm_file, 'rb')
+    try:
+        while True:
+            data = osm_file.read(read_size)
+            parser.Parse(data, not data)
+            if handler.shaped:
+                for shaped in handler.shaped:
+                    yield shaped
+                handler.shaped = []
+            if not data:
+                break
+    finally:
+        if opened:
+            osm_file.close()
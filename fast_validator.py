@@ -0,0 +1,241 @@
+'''
+Compiled replacement for cerberus.Validator covering the rules used in
+schema.py (type, required and coerce on dicts and lists of dicts).  The
+schema is turned into one checking function per record type up front, so
+validating a shaped element is a handful of isinstance checks instead of a
+walk over the schema for every element.
+
+Like cerberus, validate returns True or False and leaves the problems in
+errors and the coerced element in document.
+
+Shaped elements made of the namedtuples in the records module are checked
+by validate_record instead.  For every record type a function is generated
+that unpacks the record and coerces and checks each field in a straight
+line, so a valid element costs one call per record and no dictionaries.
+'''
+
+TYPE_CHECKS = {'integer': lambda value: isinstance(value, int) and not isinstance(value, bool),
+               'float': lambda value: isinstance(value, float),
+               'string': lambda value: isinstance(value, str),
+               'boolean': lambda value: isinstance(value, bool)}
+
+
+# the type checks as expressions for the generated record checks
+TYPE_EXPRESSIONS = {'integer': 'isinstance({0}, int) and not isinstance({0}, bool)',
+                    'float': 'isinstance({0}, float)',
+                    'string': 'isinstance({0}, str)',
+                    'boolean': 'isinstance({0}, bool)'}
+
+# coercions whose result always passes the type check, so it is left out
+EXACT_COERCIONS = {'integer': int, 'float': float}
+
+
+def compile_field(rules):
+    '''
+    returns a function that coerces and type checks one value, it gives
+    back (value, None) or (value, error message)
+    '''
+    coerce = rules.get('coerce')
+    type_name = rules.get('type')
+    type_check = TYPE_CHECKS[type_name] if type_name else None
+
+    def check(value):
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except (TypeError, ValueError) as error:
+                return value, 'field \'{0}\' cannot be coerced: {1}'.format(
+                    value, error)
+        if type_check is not None and not type_check(value):
+            return value, 'must be of {0} type'.format(type_name)
+        return value, None
+    return check
+
+
+def compile_dict(schema):
+    '''
+    returns a function that checks one dictionary against the field rules
+    in schema, it gives back (coerced dict, errors dict)
+    '''
+    fields = [(name, rules.get('required', False), compile_field(rules))
+              for name, rules in schema.items()]
+    known = frozenset(schema)
+
+    def check(document):
+        if not isinstance(document, dict):
+            return document, {'': ['must be of dict type']}
+        coerced = {}
+        errors = {}
+        for name, required, check_field in fields:
+            if name not in document:
+                if required:
+                    errors[name] = ['required field']
+                continue
+            value, error = check_field(document[name])
+            coerced[name] = value
+            if error:
+                errors[name] = [error]
+        for name in document:
+            if name not in known:
+                errors[name] = ['unknown field']
+                coerced[name] = document[name]
+        return coerced, errors
+    return check
+
+
+def compile_rule(rules):
+    '''
+    returns a checking function for one top level schema entry, either a
+    dict of fields or a list of such dicts
+    '''
+    if rules['type'] == 'dict':
+        return compile_dict(rules['schema'])
+    if rules['type'] == 'list':
+        check_item = compile_rule(rules['schema'])
+
+        def check(document):
+            if not isinstance(document, list):
+                return document, {'': ['must be of list type']}
+            coerced = []
+            errors = {}
+            for index, item in enumerate(document):
+                value, item_errors = check_item(item)
+                coerced.append(value)
+                if item_errors:
+                    errors[index] = [item_errors]
+            return coerced, errors
+        return check
+    return compile_scalar(rules)
+
+
+def compile_scalar(rules):
+    '''wraps compile_field so it matches the (value, errors) convention'''
+    check_field = compile_field(rules)
+
+    def check(value):
+        value, error = check_field(value)
+        return value, [error] if error else {}
+    return check
+
+
+def record_source(record_type, schema, many):
+    '''
+    returns the source of a check function for record_type against the
+    field rules in schema and the coercions it needs by name.  with many
+    the function checks a list of records
+    '''
+    names = ['v{0}'.format(index) for index in range(len(record_type._fields))]
+    namespace = {}
+    body = []
+    for field in schema:
+        if field not in record_type._fields and schema[field].get('required', False):
+            # the record can't hold a required field, nothing it holds is valid
+            body.append('return False')
+    for name, field in zip(names, record_type._fields):
+        rules = schema.get(field)
+        if rules is None:
+            # fields the schema doesn't know are only allowed when empty
+            body.append('if {0} is not None: return False'.format(name))
+            continue
+        lines = []
+        coerce = rules.get('coerce')
+        type_name = rules.get('type')
+        if coerce is not None:
+            namespace['coerce_' + name] = coerce
+            lines.append('{0} = coerce_{0}({0})'.format(name))
+        if type_name and (coerce is None or EXACT_COERCIONS.get(type_name) is not coerce):
+            lines.append('if not ({0}): return False'.format(
+                TYPE_EXPRESSIONS[type_name].format(name)))
+        if rules.get('required', False):
+            # None already fails a type check that isn't after a coercion
+            if coerce is not None or not type_name:
+                body.append('if {0} is None: return False'.format(name))
+            body.extend(lines)
+        elif lines:
+            body.append('if {0} is not None:'.format(name))
+            body.extend('    ' + line for line in lines)
+    body.insert(0, '{0}{1} = record'.format(', '.join(names), ',' if len(names) == 1 else ''))
+    if many:
+        source = ['def check(records):',
+                  '    if not isinstance(records, list): return False',
+                  '    try:',
+                  '        for record in records:']
+        source.extend('            ' + line for line in body)
+    else:
+        source = ['def check(record):',
+                  '    try:']
+        source.extend('        ' + line for line in body)
+    source.extend(['    except (TypeError, ValueError):',
+                   '        return False',
+                   '    return True'])
+    return '\n'.join(source), namespace
+
+
+def compile_record(record_type, rules):
+    '''
+    returns a function that checks one record of record_type, or a list of
+    them, against a top level schema entry and gives back True if it is
+    valid.  a field that is None counts as missing like a key a dictionary
+    doesn't have
+    '''
+    many = rules['type'] == 'list'
+    schema = rules['schema']['schema'] if many else rules['schema']
+    source, namespace = record_source(record_type, schema, many)
+    exec(compile(source, '<{0} check>'.format(record_type.__name__), 'exec'), namespace)
+    return namespace['check']
+
+
+class CompiledValidator(object):
+    '''
+    validator built once from a schema with a cerberus style interface,
+    records are checked with the function compiled for their record type.
+    record_types maps schema entries to the namedtuple their rows are
+    shaped into (records.SCHEMA_RECORDS) for validate_record
+    '''
+
+    def __init__(self, schema, record_types=None):
+        self.schema = schema
+        self.checkers = dict((name, compile_rule(rules))
+                             for name, rules in schema.items())
+        self.record_checkers = dict(
+            (name, compile_record(record_type, schema[name]))
+            for name, record_type in (record_types or {}).items())
+        self.errors = {}
+        self.document = None
+
+    def validate_record(self, document):
+        '''
+        checks a shaped element made of records, a namedtuple whose fields
+        are schema entries like records.ShapedNode, and returns True if it
+        is valid.  errors and document aren't filled in, validate the
+        element as dictionaries to find out what is wrong with it
+        '''
+        checkers = self.record_checkers
+        for name, value in zip(document._fields, document):
+            check = checkers.get(name)
+            if check is None or not check(value):
+                return False
+        return True
+
+    def validate(self, document, schema=None):
+        '''
+        checks every record in document, returns True if they are all
+        valid.  schema is accepted so the validator can stand in for
+        cerberus.Validator, it has to be the schema it was built from
+        '''
+        if schema is not None and schema is not self.schema:
+            raise ValueError('CompiledValidator can only validate against '
+                             'the schema it was compiled from')
+        self.errors = {}
+        self.document = {}
+        for name, record in document.items():
+            checker = self.checkers.get(name)
+            if checker is None:
+                self.errors[name] = ['unknown field']
+                self.document[name] = record
+                continue
+            value, errors = checker(record)
+            self.document[name] = value
+            if errors:
+                self.errors[name] = [errors]
+        return not self.errors
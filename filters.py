@@ -0,0 +1,140 @@
+'''
+Filters for importing part of an extract.  An ElementFilter looks at a node
+or way's attributes and its tag and nd children before anything is shaped,
+so elements outside the region or without the wanted tags cost no more than
+the parse.
+
+Nodes are kept when they are inside the bounding box or polygon, ways when
+any of their nodes was kept.  That relies on the nodes coming before the
+ways, as they do in every extract, and the ids of the nodes inside the
+region are remembered for it.  A kept way's nodes outside the region are
+not kept, they show up in process_map's dangling_way_nodes.
+'''
+import fnmatch
+import re
+
+# the same rule shape_tags uses to split a key into its type and key
+from records import LOWER_COLON
+
+
+def tag_type(key):
+    '''the type shape_tags gives a tag with this key'''
+    if LOWER_COLON.search(key):
+        return key.split(':', 1)[0]
+    return 'regular'
+
+
+def point_in_polygon(lat, lon, polygon):
+    '''
+    ray casting test, polygon is a list of (lat, lon) pairs and doesn't
+    need to repeat its first point at the end
+    '''
+    inside = False
+    last_lat, last_lon = polygon[-1]
+    for point_lat, point_lon in polygon:
+        if (point_lat > lat) != (last_lat > lat):
+            crossing = (last_lon - point_lon) * (lat - point_lat) / \
+                (last_lat - point_lat) + point_lon
+            if lon < crossing:
+                inside = not inside
+        last_lat, last_lon = point_lat, point_lon
+    return inside
+
+
+class ElementFilter(object):
+    '''
+    decides which nodes and ways to import.
+    bbox        (min_lat, min_lon, max_lat, max_lon) nodes have to be inside
+    polygon     list of (lat, lon) points nodes have to be inside
+    keys        tag keys an element needs at least one of, shell style
+                patterns like 'addr:*' can be used
+    tag_types   tag types (the type column, 'addr', 'tiger', 'regular')
+                an element needs at least one of
+    when keys and tag_types are both given a tag matching either will do
+    '''
+
+    def __init__(self, bbox=None, polygon=None, keys=None, tag_types=None):
+        self.polygon = [(float(lat), float(lon)) for lat, lon in polygon] \
+            if polygon else None
+        if self.polygon and bbox is None:
+            lats = [lat for lat, lon in self.polygon]
+            lons = [lon for lat, lon in self.polygon]
+            bbox = (min(lats), min(lons), max(lats), max(lons))
+        self.bbox = tuple(float(value) for value in bbox) if bbox else None
+        self.keys = list(keys) if keys else None
+        self.key_patterns = re.compile('|'.join(fnmatch.translate(key)
+                                                for key in keys)) if keys else None
+        self.tag_types = frozenset(tag_types) if tag_types else None
+        # ids of the nodes inside the region
+        self.kept_nodes = set()
+        # set in parallel workers, which can't see the nodes of other ranges,
+        # ways are then only checked against the region by keeps_way
+        self.defer_ways = False
+
+    def __reduce__(self):
+        # workers get a fresh filter without the kept node ids
+        return (ElementFilter, (self.bbox, self.polygon, self.keys, self.tag_types))
+
+    @property
+    def has_region(self):
+        return self.bbox is not None
+
+    @property
+    def has_tags(self):
+        return self.key_patterns is not None or self.tag_types is not None
+
+    def in_region(self, lat, lon):
+        '''returns True if the point is inside the bbox and polygon'''
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        return self.polygon is None or point_in_polygon(lat, lon, self.polygon)
+
+    def matches_tag(self, key):
+        '''returns True if a tag with this key is one being imported'''
+        if self.key_patterns is not None and self.key_patterns.match(key):
+            return True
+        return self.tag_types is not None and tag_type(key) in self.tag_types
+
+    def keeps_way(self, node_ids):
+        '''returns True if any of the node ids is a kept node'''
+        kept_nodes = self.kept_nodes
+        return any(int(node_id) in kept_nodes for node_id in node_ids)
+
+    def accept(self, tag, attrib, children):
+        '''
+        returns True if the element should be imported, children is an
+        iterable of (tag, attributes) pairs like shape_attribs takes
+        '''
+        if tag == 'node' and self.has_region:
+            if not self.in_region(float(attrib['lat']), float(attrib['lon'])):
+                return False
+            # remembered even if its tags don't match, a way may use it
+            self.kept_nodes.add(int(attrib['id']))
+        if not self.has_tags and (tag != 'way' or not self.has_region):
+            return True
+
+        tag_matched = not self.has_tags
+        node_ids = []
+        for child_tag, child_attrib in children:
+            if child_tag == 'tag':
+                if not tag_matched and self.matches_tag(child_attrib['k']):
+                    tag_matched = True
+            elif child_tag == 'nd':
+                node_ids.append(child_attrib['ref'])
+        if not tag_matched:
+            return False
+        if tag == 'way' and self.has_region and not self.defer_ways:
+            return self.keeps_way(node_ids)
+        return True
+
+    def wrap(self, shape):
+        '''
+        returns a shape function that only calls shape for accepted
+        elements and returns None for the rest
+        '''
+        def filtered_shape(tag, attrib, children):
+            if self.accept(tag, attrib, children):
+                return shape(tag, attrib, children)
+            return None
+        return filtered_shape
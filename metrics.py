@@ -0,0 +1,220 @@
+'''
+Instrumentation for long running imports.  ImportMetrics keeps per stage
+timers, element and row counters, how far through the input file the parser
+has read and periodic RSS samples.  Every interval seconds a snapshot is
+written to a stream as one line of json and summary gives the totals at the
+end.  Everything it does per element is a counter bump or a clock read so it
+can stay on for production runs.
+'''
+import collections
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+DEFAULT_INTERVAL = 10.0
+# the clock is only read every CHECK_EVERY ticks to see if a snapshot is due
+CHECK_EVERY = 1000
+
+clock = time.perf_counter
+
+
+def current_rss():
+    '''resident set size of this process in bytes'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class CountingReader(object):
+    '''wraps a binary file and keeps count of the bytes read from it'''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.raw.close()
+
+
+class ProgressCounter(object):
+    '''
+    bytes_read for a source that reports how much of the file it has
+    handed back itself, like the byte ranges of a parallel parse
+    '''
+
+    def __init__(self):
+        self.bytes_read = 0
+
+    def add(self, size):
+        self.bytes_read += size
+
+
+class ImportMetrics(object):
+    '''
+    collects timings, counters, progress and memory for one import,
+    snapshots go to stream as json lines when it is set.  the stages of a
+    pipelined import time themselves from their own threads, so each thread
+    adds to its own stage timers and stage_seconds adds them up
+    '''
+
+    def __init__(self, total_bytes=None, stream=None, interval=DEFAULT_INTERVAL):
+        self.total_bytes = total_bytes
+        self.stream = stream
+        self.interval = interval
+        self.thread_seconds = []
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.reader = None
+        self.rss_samples = []
+        self.peak_rss = 0
+        self.ticks = 0
+        self.start_time = clock()
+        self.last_emit = self.start_time
+        # each thread of a pipelined import keeps its own lap clock and timers
+        self.laps = threading.local()
+        self.sample_rss()
+
+    def track_file(self, path):
+        '''opens the input file so the bytes read can be used for progress'''
+        return self.track_reader(CountingReader(open(path, 'rb')))
+
+    def track_reader(self, reader):
+        '''
+        uses the bytes_read of an open reader for progress, it should count
+        bytes of the file total_bytes is the size of
+        '''
+        self.reader = reader
+        return reader
+
+    def track_progress(self):
+        '''
+        returns a ProgressCounter for a source that reports its own
+        progress, its add should be given the bytes of the file handled
+        '''
+        return self.track_reader(ProgressCounter())
+
+    def timers(self):
+        '''the stage timers of the calling thread'''
+        try:
+            return self.laps.seconds
+        except AttributeError:
+            seconds = self.laps.seconds = collections.defaultdict(float)
+            with self.lock:
+                self.thread_seconds.append(seconds)
+            return seconds
+
+    @property
+    def stage_seconds(self):
+        '''the seconds spent in each stage by every thread'''
+        with self.lock:
+            thread_seconds = list(self.thread_seconds)
+        totals = collections.defaultdict(float)
+        for seconds in thread_seconds:
+            # dict() copies it in one step while its thread may be adding a stage
+            for stage, value in dict(seconds).items():
+                totals[stage] += value
+        return totals
+
+    def add_time(self, stage, seconds):
+        '''adds seconds to the timer of a stage'''
+        self.timers()[stage] += seconds
+
+    def count(self, name, amount=1):
+        '''adds amount to a counter'''
+        self.counters[name] += amount
+
+    def start_lap(self):
+        '''starts the clock for the next call to lap in this thread'''
+        self.timers()
+        self.laps.start = clock()
+
+    def lap(self, stage):
+        '''
+        adds the time since start_lap or the last lap to stage and
+        restarts the clock
+        '''
+        now = clock()
+        self.laps.seconds[stage] += now - self.laps.start
+        self.laps.start = now
+
+    def timed(self, iterable, stage):
+        '''yields from iterable adding the time spent waiting on it to stage'''
+        iterator = iter(iterable)
+        timers = self.timers()
+        while True:
+            begin = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                timers[stage] += clock() - begin
+                return
+            timers[stage] += clock() - begin
+            yield item
+
+    def tick(self):
+        '''
+        called once per element, writes a snapshot when interval seconds
+        have passed since the last one
+        '''
+        self.ticks += 1
+        if self.ticks % CHECK_EVERY:
+            return
+        now = clock()
+        if now - self.last_emit >= self.interval:
+            self.last_emit = now
+            self.sample_rss()
+            self.emit(self.snapshot())
+
+    def sample_rss(self):
+        '''records the current rss'''
+        rss = current_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.rss_samples.append((round(clock() - self.start_time, 3), rss))
+        return rss
+
+    def snapshot(self):
+        '''returns the current state of the import as a dictionary'''
+        elapsed = clock() - self.start_time
+        bytes_read = self.reader.bytes_read if self.reader is not None else None
+        progress = eta = None
+        if bytes_read is not None and self.total_bytes:
+            progress = bytes_read / float(self.total_bytes)
+            if progress > 0:
+                eta = elapsed / progress - elapsed
+        return {'elapsed': elapsed,
+                'elements': self.ticks,
+                'bytes_read': bytes_read,
+                'total_bytes': self.total_bytes,
+                'progress': progress,
+                'eta_seconds': eta,
+                'elements_per_second': self.ticks / elapsed if elapsed else 0.0,
+                'counters': dict(self.counters),
+                'stage_seconds': dict(self.stage_seconds),
+                'rss': self.rss_samples[-1][1]}
+
+    def emit(self, record):
+        '''writes a record to the stream as a line of json'''
+        if self.stream is not None:
+            self.stream.write(json.dumps(record) + '\n')
+            self.stream.flush()
+
+    def summary(self):
+        '''final snapshot with the peak rss and every rss sample'''
+        self.sample_rss()
+        record = self.snapshot()
+        record['final'] = True
+        record['peak_rss'] = self.peak_rss
+        record['rss_samples'] = list(self.rss_samples)
+        self.emit(record)
+        return record
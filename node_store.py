@@ -0,0 +1,176 @@
+'''
+Compact node id to location store.  Resolving way geometry or checking that
+every ways_nodes.node_id exists needs every node's location, and a dict of
+tens of millions of (lat, lon) tuples takes gigabytes.  NodeStore keeps the
+ids in a sorted array of int64 and the coordinates as int32 fixed point
+(1e-7 degrees, the precision OSM stores), 16 bytes a node.  It is filled
+during the same streaming pass as the import, can be saved and reopened
+memory mapped, and keeps count of way node references it can't resolve.
+'''
+import array
+import bisect
+import mmap
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COORDINATE_SCALE = 10000000
+FILE_MAGIC = b'OSMNODES'
+HEADER = struct.Struct('<8sQ')
+MAX_DANGLING_EXAMPLES = 100
+
+
+class NodeStore(object):
+    '''
+    sorted arrays of node ids and fixed point coordinates.  it behaves
+    like a read only mapping of node id to (lat, lon) once filled, nodes
+    are added in file order and the rare id that arrives out of order is
+    kept aside until finish merges it in.  a node added twice keeps the
+    coordinates it was added with last, before and after finish
+    '''
+
+    def __init__(self):
+        self.ids = array.array('q')
+        self.lats = array.array('i')
+        self.lons = array.array('i')
+        self.out_of_order = {}
+        self.missing_coordinates = 0
+        self.dangling_count = 0
+        self.dangling_examples = []
+        self.mapped = None
+
+    def __len__(self):
+        return len(self.ids) + len(self.out_of_order)
+
+    def __setitem__(self, node_id, location):
+        self.add(node_id, location[0], location[1])
+
+    def __contains__(self, node_id):
+        return self.get(node_id) is not None
+
+    def add(self, node_id, lat, lon):
+        '''
+        adds a node, ids are expected to mostly arrive in increasing order.
+        a node without a lat or lon (a deleted node in a history extract)
+        isn't stored, it is counted in missing_coordinates and the ways
+        using it see it as dangling
+        '''
+        if lat is None or lon is None:
+            self.missing_coordinates += 1
+            return
+        node_id = int(node_id)
+        lat = int(round(float(lat) * COORDINATE_SCALE))
+        lon = int(round(float(lon) * COORDINATE_SCALE))
+        if self.ids and node_id <= self.ids[-1]:
+            self.out_of_order[node_id] = (lat, lon)
+            return
+        self.ids.append(node_id)
+        self.lats.append(lat)
+        self.lons.append(lon)
+
+    def finish(self):
+        '''merges any out of order nodes into the sorted arrays'''
+        if not self.out_of_order:
+            return
+        merged = dict(zip(self.ids, zip(self.lats, self.lons)))
+        merged.update(self.out_of_order)
+        self.ids = array.array('q', sorted(merged))
+        self.lats = array.array('i', (merged[node_id][0] for node_id in self.ids))
+        self.lons = array.array('i', (merged[node_id][1] for node_id in self.ids))
+        self.out_of_order = {}
+
+    def get(self, node_id, default=None):
+        '''returns the (lat, lon) of a node or default if it isn't stored'''
+        node_id = int(node_id)
+        # an id added again after the arrays have it is only in out_of_order
+        # until finish, and that later location is the one to return
+        if self.out_of_order:
+            fixed = self.out_of_order.get(node_id)
+            if fixed is not None:
+                return fixed[0] / COORDINATE_SCALE, fixed[1] / COORDINATE_SCALE
+        index = bisect.bisect_left(self.ids, node_id)
+        if index < len(self.ids) and self.ids[index] == node_id:
+            return (self.lats[index] / COORDINATE_SCALE,
+                    self.lons[index] / COORDINATE_SCALE)
+        return default
+
+    def lookup(self, node_ids):
+        '''
+        batch lookup, returns (found, lats, lons) lists lined up with
+        node_ids.  with numpy available the ids are found with one
+        vectorised search and numpy arrays are returned
+        '''
+        self.finish()
+        if numpy is None or not len(self.ids):
+            locations = [self.get(node_id) for node_id in node_ids]
+            return ([location is not None for location in locations],
+                    [location[0] if location else None for location in locations],
+                    [location[1] if location else None for location in locations])
+        ids = numpy.frombuffer(self.ids, dtype=numpy.int64)
+        wanted = numpy.asarray(node_ids, dtype=numpy.int64)
+        indexes = numpy.minimum(numpy.searchsorted(ids, wanted), len(ids) - 1)
+        found = ids[indexes] == wanted
+        lats = numpy.frombuffer(self.lats, dtype=numpy.int32)[indexes] / COORDINATE_SCALE
+        lons = numpy.frombuffer(self.lons, dtype=numpy.int32)[indexes] / COORDINATE_SCALE
+        lats[~found] = numpy.nan
+        lons[~found] = numpy.nan
+        return found, lats, lons
+
+    def resolve_way(self, way_id, node_ids):
+        '''
+        returns the (lat, lon) of every node of a way that is stored and
+        records the references that couldn't be resolved
+        '''
+        coords = []
+        for node_id in node_ids:
+            location = self.get(node_id)
+            if location is None:
+                self.dangling_count += 1
+                if len(self.dangling_examples) < MAX_DANGLING_EXAMPLES:
+                    self.dangling_examples.append((int(way_id), int(node_id)))
+                continue
+            coords.append(location)
+        return coords
+
+    def dangling_report(self):
+        '''
+        returns the count and some examples of unresolved way nodes, and
+        how many nodes had no coordinates to store
+        '''
+        return {'count': self.dangling_count,
+                'examples': list(self.dangling_examples),
+                'nodes_without_coordinates': self.missing_coordinates}
+
+    def save(self, path):
+        '''writes the store to a file that open can memory map'''
+        self.finish()
+        with open(path, 'wb') as store_file:
+            store_file.write(HEADER.pack(FILE_MAGIC, len(self.ids)))
+            self.ids.tofile(store_file)
+            self.lats.tofile(store_file)
+            self.lons.tofile(store_file)
+
+    @classmethod
+    def open(cls, path):
+        '''
+        memory maps a saved store, only the pages that are looked at are
+        read from disk
+        '''
+        store = cls()
+        with open(path, 'rb') as store_file:
+            mapped = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(mapped)
+        if magic != FILE_MAGIC:
+            raise ValueError('{0} is not a saved NodeStore'.format(path))
+        view = memoryview(mapped)
+        start = HEADER.size
+        store.ids = view[start:start + 8 * count].cast('q')
+        start += 8 * count
+        store.lats = view[start:start + 4 * count].cast('i')
+        start += 4 * count
+        store.lons = view[start:start + 4 * count].cast('i')
+        store.mapped = mapped
+        return store
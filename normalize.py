@@ -0,0 +1,122 @@
+'''
+Tag normalization rules used by shape_dict.  The city, state, zipcode and
+street mappings are compiled into a dispatch table keyed by (type, key) so a
+tag only needs one dictionary lookup to find its cleaning rule, and each rule
+keeps a bounded LRU cache of the values it has already cleaned since real
+data repeats the same few thousand addresses millions of times.
+'''
+import functools
+
+DEFAULT_CACHE_SIZE = 100000
+
+
+def lookup_rule(mapping):
+    '''returns a rule that swaps a value for its entry in mapping'''
+    def rule(value):
+        return mapping.get(value, value)
+    return rule
+
+
+def zipcode_rule(mapping):
+    '''
+    returns a rule that swaps a zipcode for its entry in mapping or
+    otherwise cuts it down to the first five digits
+    '''
+    def rule(value):
+        try:
+            return mapping[value]
+        except KeyError:
+            return value[0:5]
+    return rule
+
+
+def street_rule(mapping):
+    '''
+    returns a rule that swaps each word of a street name for its entry in
+    mapping, i.e. St. becomes Street
+    '''
+    def rule(value):
+        return ' '.join([mapping.get(word, word) for word in value.split()])
+    return rule
+
+
+def with_hit_rates(report):
+    '''fills in the hit rate of every rule in a stats report'''
+    for entry in report.values():
+        lookups = entry['hits'] + entry['misses']
+        entry['hit_rate'] = entry['hits'] / lookups if lookups else 0.0
+    return report
+
+
+def stats_since(before, after):
+    '''
+    returns the hits and misses counted between two TagNormalizer.stats
+    reports, with the cached values of the later one
+    '''
+    report = {}
+    for name, entry in after.items():
+        old = before.get(name, {'hits': 0, 'misses': 0})
+        report[name] = {'hits': entry['hits'] - old['hits'],
+                        'misses': entry['misses'] - old['misses'],
+                        'cached': entry['cached']}
+    return with_hit_rates(report)
+
+
+def merge_stats(total, report):
+    '''
+    adds the counts of a stats report, such as one from a worker process,
+    to total and returns it
+    '''
+    for name, entry in report.items():
+        merged = total.setdefault(name, {'hits': 0, 'misses': 0, 'cached': 0})
+        for field in ('hits', 'misses', 'cached'):
+            merged[field] += entry[field]
+    return with_hit_rates(total)
+
+
+class TagNormalizer(object):
+    '''
+    dispatch table of cleaning rules keyed by (type, key), every rule is
+    wrapped in an LRU cache of cache_size values
+    '''
+
+    def __init__(self, city_mappings, state_mappings, zipcode_mappings,
+                 street_mappings, cache_size=DEFAULT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.rules = {}
+        self.add_rule('addr', 'city', lookup_rule(city_mappings))
+        self.add_rule('addr', 'state', lookup_rule(state_mappings))
+        self.add_rule('addr', 'postcode', zipcode_rule(zipcode_mappings))
+        self.add_rule('addr', 'street', street_rule(street_mappings))
+
+    def add_rule(self, tag_type, key, rule):
+        '''adds or replaces the cleaning rule for tags of type and key'''
+        self.rules[(tag_type, key)] = functools.lru_cache(maxsize=self.cache_size)(rule)
+
+    def normalize(self, tag_type, key, value):
+        '''returns the cleaned value for a tag'''
+        rule = self.rules.get((tag_type, key))
+        if rule is None:
+            return value
+        return rule(value)
+
+    def clear_cache(self):
+        '''empties the cache of every rule'''
+        for rule in self.rules.values():
+            rule.cache_clear()
+
+    def stats(self):
+        '''
+        returns a dictionary of hits, misses, hit rate and cached values
+        for every rule keyed by type:key
+        '''
+        report = {}
+        for (tag_type, key), rule in sorted(self.rules.items()):
+            info = rule.cache_info()
+            lookups = info.hits + info.misses
+            report['{0}:{1}'.format(tag_type, key)] = {
+                'hits': info.hits,
+                'misses': info.misses,
+                'hit_rate': info.hits / lookups if lookups else 0.0,
+                'cached': info.currsize}
+        return report
@@ -0,0 +1,192 @@
+'''
+Applies osmChange (.osc) diffs to a database built by process_map so it can
+be kept up to date from the minutely or daily diffs instead of reimporting
+the whole extract.  Created and modified nodes and ways go through the same
+shape_element and shape_dict cleaning as the full import, deleted ones are
+removed along with their tags and way nodes.  The R*Tree spatial index, the
+way geometries and the address search index are kept in step when the
+database has them, including for ways whose nodes were moved.
+'''
+import sqlite3
+import sys
+
+import InsertDatatoSQLandCSV as importer
+import address_search
+import compressed
+import post_load
+import way_geometry
+
+ACTIONS = ('create', 'modify', 'delete')
+
+# the lookups by element id the updates rely on
+UPDATE_INDEXES = ['idx_nodes_tags_id', 'idx_ways_tags_id', 'idx_ways_nodes_id',
+                  'idx_ways_nodes_node_id', 'idx_nodes_tag_ids_id',
+                  'idx_ways_tag_ids_id']
+
+
+def iter_changes(osc_file):
+    '''
+    yields (action, element) for every node and way in the diff in file
+    order, each element is cleared once it has been handed back.  the
+    replication diffs come as .osc.gz and are read without unpacking them
+    '''
+    source = osc_file
+    if compressed.is_compressed(osc_file):
+        source = compressed.open_input(osc_file, workers=1)
+    try:
+        context = importer.ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        action = None
+        action_elem = None
+        for event, elem in context:
+            if event == 'start':
+                if elem.tag in ACTIONS:
+                    action = elem.tag
+                    action_elem = elem
+            elif elem.tag in ('node', 'way') and action is not None:
+                yield action, elem
+                action_elem.clear()
+            elif elem.tag in ACTIONS:
+                action = None
+                root.clear()
+    finally:
+        if source is not osc_file:
+            source.close()
+
+
+def has_table(cursor, table):
+    '''returns True if the database has a table of that name'''
+    return cursor.execute('select 1 from sqlite_master where name = ?;',
+                          (table,)).fetchone() is not None
+
+
+def delete_node(cursor, node_id):
+    '''removes a node and its tags'''
+    cursor.execute('delete from nodes_tags where id = ?;', (node_id,))
+    cursor.execute('delete from nodes where id = ?;', (node_id,))
+    if has_table(cursor, 'nodes_rtree'):
+        cursor.execute('delete from nodes_rtree where id = ?;', (node_id,))
+
+
+def delete_way(cursor, way_id):
+    '''removes a way, its tags and its way nodes'''
+    cursor.execute('delete from ways_tags where id = ?;', (way_id,))
+    cursor.execute('delete from ways_nodes where id = ?;', (way_id,))
+    cursor.execute('delete from ways where id = ?;', (way_id,))
+    if has_table(cursor, 'ways_rtree'):
+        cursor.execute('delete from ways_rtree where id = ?;', (way_id,))
+    if has_table(cursor, 'way_geometry'):
+        cursor.execute('delete from way_geometry where id = ?;', (way_id,))
+
+
+def insert_rows(cursor, table, fields, rows):
+    '''
+    inserts shaped row dictionaries into table, a field missing from a row
+    (shape_element leaves out the attributes an element doesn't have) is
+    inserted as NULL
+    '''
+    statement = 'insert or replace into {0} ({1}) values ({2});'.format(
+        table, ', '.join(fields), ', '.join('?' * len(fields)))
+    cursor.executemany(statement, [[row.get(field) for field in fields]
+                                   for row in rows])
+
+
+def upsert_node(cursor, shaped):
+    '''writes a created or modified node over whatever was stored before'''
+    delete_node(cursor, shaped['node']['id'])
+    insert_rows(cursor, 'nodes', importer.NODE_FIELDS, [shaped['node']])
+    insert_rows(cursor, 'nodes_tags', importer.NODE_TAGS_FIELDS,
+                shaped['node_tags'])
+    if has_table(cursor, 'nodes_rtree'):
+        node = shaped['node']
+        cursor.execute('insert into nodes_rtree values (?, ?, ?, ?, ?);',
+                       (node['id'], node['lat'], node['lat'],
+                        node['lon'], node['lon']))
+
+
+def upsert_way(cursor, shaped):
+    '''writes a created or modified way over whatever was stored before'''
+    delete_way(cursor, shaped['way']['id'])
+    insert_rows(cursor, 'ways', importer.WAY_FIELDS, [shaped['way']])
+    insert_rows(cursor, 'ways_tags', importer.WAY_TAGS_FIELDS,
+                shaped['way_tags'])
+    insert_rows(cursor, 'ways_nodes', importer.WAY_NODES_FIELDS,
+                shaped['way_nodes'])
+    refresh_way(cursor, shaped['way']['id'])
+
+
+def refresh_way(cursor, way_id):
+    '''
+    rebuilds the R*Tree box and geometry of a way from the nodes stored
+    in the database
+    '''
+    coords = cursor.execute('select n.lat, n.lon from ways_nodes wn join nodes n '
+                            'on n.id = wn.node_id where wn.id = ? '
+                            'order by wn.position;', (way_id,)).fetchall()
+    if not coords:
+        return
+    row = way_geometry.geometry_row(way_id, coords)
+    if has_table(cursor, 'ways_rtree'):
+        cursor.execute('insert or replace into ways_rtree values (?, ?, ?, ?, ?);',
+                       (way_id,) + row[3:])
+    if has_table(cursor, 'way_geometry'):
+        cursor.execute('insert or replace into way_geometry ({0}) values '
+                       '(?, ?, ?, ?, ?, ?, ?);'.format(
+                           ', '.join(way_geometry.GEOMETRY_FIELDS)), row)
+
+
+def refresh_ways_using(cursor, node_id):
+    '''
+    rebuilds the box and geometry of every way that uses a node, and its
+    address search row since that is placed at the centre of the box
+    '''
+    way_ids = cursor.execute('select distinct id from ways_nodes where node_id = ?;',
+                             (node_id,)).fetchall()
+    search_index = has_table(cursor, 'address_search')
+    for (way_id,) in way_ids:
+        refresh_way(cursor, way_id)
+        if search_index:
+            address_search.refresh(cursor, 'way', way_id)
+
+
+def apply_changes(osc_file, db_path=importer.DB_PATH):
+    '''
+    applies every change in the diff to the database in one transaction
+    and returns the number of nodes and ways handled for each action
+    '''
+    counts = dict((action, {'node': 0, 'way': 0}) for action in ACTIONS)
+    connection = sqlite3.connect(db_path)
+    try:
+        cursor = connection.cursor()
+        for name in UPDATE_INDEXES:
+            post_load.create_index(cursor, name)
+        search_index = has_table(cursor, 'address_search')
+        for action, element in iter_changes(osc_file):
+            if action == 'delete':
+                if element.tag == 'node':
+                    delete_node(cursor, element.attrib['id'])
+                else:
+                    delete_way(cursor, element.attrib['id'])
+            else:
+                shaped = importer.shape_element(element)
+                if element.tag == 'node':
+                    upsert_node(cursor, shaped)
+                    if action == 'modify':
+                        refresh_ways_using(cursor, shaped['node']['id'])
+                else:
+                    upsert_way(cursor, shaped)
+            if search_index:
+                address_search.refresh(cursor, element.tag, element.attrib['id'])
+            counts[action][element.tag] += 1
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return counts
+
+
+if __name__ == '__main__':
+    for change_file in sys.argv[1:]:
+        print(change_file, apply_changes(change_file))
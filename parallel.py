@@ -0,0 +1,144 @@
+'''
+Splits an .osm file into byte ranges that start on a <node>, <way> or
+<relation> tag and shapes each range in a separate process.  The ranges are
+handed back in file order so the csv and sqlite outputs come out exactly the
+same as a serial run of process_map.  Each range comes back as one batch
+from records.encode_batch rather than a pickled list of records.
+'''
+import collections
+import io
+import multiprocessing
+import os
+import re
+
+import normalize
+import records
+
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+
+ELEMENT_START_RE = re.compile(br'<(?:node|way|relation)[\s/>]')
+OSM_END = b'</osm>'
+SCAN_SIZE = 1024 * 1024
+
+
+def find_boundary(osm_file, offset, limit):
+    '''
+    returns the byte offset of the first element start tag at or after
+    offset, or limit if there isn't one before it
+    '''
+    position = offset
+    while position < limit:
+        osm_file.seek(position)
+        window = osm_file.read(min(SCAN_SIZE, limit - position) + 16)
+        match = ELEMENT_START_RE.search(window)
+        if match and position + match.start() < limit:
+            return position + match.start()
+        position += SCAN_SIZE
+    return limit
+
+
+def find_end(osm_file, file_size):
+    '''returns the byte offset of the closing </osm> tag'''
+    position = file_size
+    while position > 0:
+        start = max(0, position - SCAN_SIZE)
+        osm_file.seek(start)
+        window = osm_file.read(position - start + len(OSM_END))
+        index = window.rfind(OSM_END)
+        if index != -1:
+            return start + index
+        position = start
+    return file_size
+
+
+def split_file(file_in, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    returns a list of (start, end) byte ranges covering every element
+    in the file, each range starts on an element start tag so it can be
+    parsed on its own once wrapped in an <osm> tag
+    '''
+    file_size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as osm_file:
+        end = find_end(osm_file, file_size)
+        start = find_boundary(osm_file, 0, end)
+        ranges = []
+        while start < end:
+            next_start = find_boundary(osm_file, min(start + chunk_size, end), end)
+            ranges.append((start, next_start))
+            start = next_start
+    return ranges
+
+
+def read_range(file_in, start, end):
+    '''reads a byte range and wraps it so it is a complete osm document'''
+    with open(file_in, 'rb') as osm_file:
+        osm_file.seek(start)
+        data = osm_file.read(end - start)
+    return io.BytesIO(b'<osm>' + data + b'</osm>')
+
+
+def shape_range(args):
+    '''
+    worker function, parses one byte range and returns its (tag, shaped
+    element) pairs in file order packed by records.encode_batch, the node
+    ids the filter kept and the normalizer cache stats of the range
+    '''
+    import InsertDatatoSQLandCSV
+    file_in, start, end, parser, element_filter = args
+    if element_filter is not None:
+        element_filter.defer_ways = True
+    before = InsertDatatoSQLandCSV.NORMALIZER.stats()
+    shaped = records.encode_batch(InsertDatatoSQLandCSV.shaped_elements(
+        read_range(file_in, start, end), workers=1, parser=parser,
+        element_filter=element_filter))
+    kept_nodes = element_filter.kept_nodes if element_filter is not None else None
+    normalizer_stats = normalize.stats_since(before, InsertDatatoSQLandCSV.NORMALIZER.stats())
+    return shaped, kept_nodes, normalizer_stats
+
+
+def shape_file(file_in, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+               parser='expat', element_filter=None, normalizer_stats=None,
+               progress=None):
+    '''
+    yields (tag, shaped element) pairs for every node and way in the file
+    in the same order as the serial parser, only 2 ranges per worker are
+    in flight at a time so memory stays bounded however large the file is.
+    parser is the parser each worker uses, see shaped_elements.  with a
+    region filter the workers can't tell which ways use nodes from other
+    ranges, so the kept node ids come back with each range and the ways
+    are checked against them here.  the workers' normalizer cache stats are
+    added to normalizer_stats when it is a dictionary.  progress, when
+    given, is called with the size in bytes of each range once all of its
+    elements have been yielded
+    '''
+    workers = workers or multiprocessing.cpu_count()
+    check_ways = element_filter is not None and element_filter.has_region
+    ranges = [(file_in, start, end, parser, element_filter)
+              for start, end in split_file(file_in, chunk_size)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        in_flight = collections.deque()
+        next_range = 0
+        done = 0
+        while next_range < len(ranges) or in_flight:
+            while next_range < len(ranges) and len(in_flight) < workers * 2:
+                in_flight.append(pool.apply_async(shape_range, (ranges[next_range],)))
+                next_range += 1
+            batch, kept_nodes, range_stats = in_flight.popleft().get()
+            if normalizer_stats is not None:
+                normalize.merge_stats(normalizer_stats, range_stats)
+            if check_ways:
+                element_filter.kept_nodes.update(kept_nodes)
+            for tag, shaped in records.decode_batch(batch):
+                if check_ways and tag == 'way' and not element_filter.keeps_way(
+                        [node_id for _, node_id, _ in shaped.way_nodes]):
+                    continue
+                yield tag, shaped
+            if progress is not None:
+                _, start, end, _, _ = ranges[done]
+                progress(end - start)
+            done += 1
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,384 @@
+'''
+Reader for .osm.pbf files.  The file is a sequence of independent zlib
+compressed blobs, so the blobs are decoded in a process pool and turned back
+into the same node, way and relation elements get_element yields for xml
+input.  shape_element and the auditors can then use them unchanged.
+
+Only the parts of the protocol buffer format used by OSM are decoded, so no
+protobuf library is needed.
+'''
+import collections
+import datetime
+import multiprocessing
+import struct
+import zlib
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+PBF_EXTENSIONS = ('.pbf',)
+MEMBER_TYPES = ('node', 'way', 'relation')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def is_pbf(osm_file):
+    '''returns True if osm_file is the path of a .osm.pbf file'''
+    return isinstance(osm_file, str) and osm_file.lower().endswith(PBF_EXTENSIONS)
+
+
+# ================================================== #
+#               Protocol buffer decoding             #
+# ================================================== #
+def read_varint(data, position):
+    '''decodes the varint starting at position, returns (value, new position)'''
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def zigzag(value):
+    '''decodes a zigzag encoded signed integer'''
+    return (value >> 1) ^ -(value & 1)
+
+
+def signed(value):
+    '''turns a two's complement 64 bit varint into a signed integer'''
+    if value & (1 << 63):
+        return value - (1 << 64)
+    return value
+
+
+def iter_fields(data):
+    '''
+    yields (field number, wire type, value) for every field in a message,
+    length delimited values are returned as bytes and varints as integers
+    '''
+    position = 0
+    end = len(data)
+    while position < end:
+        key, position = read_varint(data, position)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 2:
+            length, position = read_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 5:
+            value = data[position:position + 4]
+            position += 4
+        else:
+            raise ValueError('unsupported wire type {0}'.format(wire_type))
+        yield field, wire_type, value
+
+
+def packed_varints(data):
+    '''decodes a packed repeated varint field'''
+    values = []
+    position = 0
+    end = len(data)
+    while position < end:
+        value, position = read_varint(data, position)
+        values.append(value)
+    return values
+
+
+def packed_zigzag(data):
+    '''decodes a packed repeated sint field'''
+    return [zigzag(value) for value in packed_varints(data)]
+
+
+def delta_decode(values):
+    '''turns a list of deltas into running totals'''
+    total = 0
+    decoded = []
+    for value in values:
+        total += value
+        decoded.append(total)
+    return decoded
+
+
+# ================================================== #
+#               OSM blocks                           #
+# ================================================== #
+def read_blobs(pbf_path):
+    '''yields (blob type, raw blob message) for every blob in the file'''
+    with open(pbf_path, 'rb') as pbf_file:
+        while True:
+            size_bytes = pbf_file.read(4)
+            if len(size_bytes) < 4:
+                return
+            header_size = struct.unpack('!I', size_bytes)[0]
+            blob_type = None
+            data_size = 0
+            for field, _, value in iter_fields(pbf_file.read(header_size)):
+                if field == 1:
+                    blob_type = value.decode('utf-8')
+                elif field == 3:
+                    data_size = value
+            yield blob_type, pbf_file.read(data_size)
+
+
+def blob_data(blob):
+    '''returns the uncompressed contents of a Blob message'''
+    for field, _, value in iter_fields(blob):
+        if field == 1:
+            return value
+        if field == 3:
+            return zlib.decompress(value)
+        if field in (4, 5, 6, 7):
+            raise ValueError('only raw and zlib compressed blobs are supported')
+    return b''
+
+
+def format_timestamp(milliseconds):
+    '''formats a timestamp the way it appears in the xml files'''
+    moment = EPOCH + datetime.timedelta(milliseconds=milliseconds)
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def info_attribs(info, strings, date_granularity):
+    '''decodes an Info message into element attributes'''
+    attribs = {}
+    for field, _, value in iter_fields(info):
+        if field == 1:
+            attribs['version'] = str(value)
+        elif field == 2:
+            attribs['timestamp'] = format_timestamp(signed(value) * date_granularity)
+        elif field == 3:
+            attribs['changeset'] = str(signed(value))
+        elif field == 4:
+            attribs['uid'] = str(signed(value))
+        elif field == 5:
+            attribs['user'] = strings[value]
+    return attribs
+
+
+def key_value_tags(keys, values, strings):
+    '''pairs up the key and value string ids of a node, way or relation'''
+    return [(strings[key], strings[value]) for key, value in zip(keys, values)]
+
+
+def decode_dense(dense, strings, block):
+    '''decodes a DenseNodes message into node records'''
+    ids = lats = lons = keys_vals = []
+    info = {}
+    for field, _, value in iter_fields(dense):
+        if field == 1:
+            ids = delta_decode(packed_zigzag(value))
+        elif field == 5:
+            for info_field, _, info_value in iter_fields(value):
+                if info_field == 1:
+                    info['version'] = packed_varints(info_value)
+                elif info_field in (2, 3, 4, 5):
+                    info[info_field] = delta_decode(packed_zigzag(info_value))
+        elif field == 8:
+            lats = delta_decode(packed_zigzag(value))
+        elif field == 9:
+            lons = delta_decode(packed_zigzag(value))
+        elif field == 10:
+            keys_vals = packed_varints(value)
+    records = []
+    tag_index = 0
+    for index, node_id in enumerate(ids):
+        attribs = {'id': str(node_id)}
+        attribs.update(block.coordinates(lats[index], lons[index]))
+        if info:
+            attribs['version'] = str(info['version'][index])
+            attribs['timestamp'] = format_timestamp(info[2][index] * block.date_granularity)
+            attribs['changeset'] = str(info[3][index])
+            attribs['uid'] = str(info[4][index])
+            attribs['user'] = strings[info[5][index]]
+        tags = []
+        while tag_index < len(keys_vals) and keys_vals[tag_index] != 0:
+            tags.append((strings[keys_vals[tag_index]],
+                         strings[keys_vals[tag_index + 1]]))
+            tag_index += 2
+        tag_index += 1
+        records.append(('node', attribs, tags, None))
+    return records
+
+
+def decode_node(node, strings, block):
+    '''decodes a Node message into a node record'''
+    attribs = {}
+    keys = values = []
+    lat = lon = 0
+    for field, _, value in iter_fields(node):
+        if field == 1:
+            attribs['id'] = str(zigzag(value))
+        elif field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            values = packed_varints(value)
+        elif field == 4:
+            attribs.update(info_attribs(value, strings, block.date_granularity))
+        elif field == 8:
+            lat = zigzag(value)
+        elif field == 9:
+            lon = zigzag(value)
+    attribs.update(block.coordinates(lat, lon))
+    return ('node', attribs, key_value_tags(keys, values, strings), None)
+
+
+def decode_way(way, strings, block):
+    '''decodes a Way message into a way record'''
+    attribs = {}
+    keys = values = refs = []
+    for field, _, value in iter_fields(way):
+        if field == 1:
+            attribs['id'] = str(value)
+        elif field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            values = packed_varints(value)
+        elif field == 4:
+            attribs.update(info_attribs(value, strings, block.date_granularity))
+        elif field == 8:
+            refs = delta_decode(packed_zigzag(value))
+    return ('way', attribs, key_value_tags(keys, values, strings), refs)
+
+
+def decode_relation(relation, strings, block):
+    '''decodes a Relation message into a relation record'''
+    attribs = {}
+    keys = values = roles = member_ids = member_types = []
+    for field, _, value in iter_fields(relation):
+        if field == 1:
+            attribs['id'] = str(value)
+        elif field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            values = packed_varints(value)
+        elif field == 4:
+            attribs.update(info_attribs(value, strings, block.date_granularity))
+        elif field == 8:
+            roles = packed_varints(value)
+        elif field == 9:
+            member_ids = delta_decode(packed_zigzag(value))
+        elif field == 10:
+            member_types = packed_varints(value)
+    members = [(MEMBER_TYPES[member_type], member_id, strings[role])
+               for member_type, member_id, role in zip(member_types, member_ids, roles)]
+    return ('relation', attribs, key_value_tags(keys, values, strings), members)
+
+
+class BlockSettings(object):
+    '''the coordinate and date scaling stored on each PrimitiveBlock'''
+
+    def __init__(self):
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+
+    def coordinates(self, lat, lon):
+        '''turns stored lat and lon values into xml style attributes'''
+        return {'lat': '{0:.7f}'.format(
+                    1e-9 * (self.lat_offset + self.granularity * lat)),
+                'lon': '{0:.7f}'.format(
+                    1e-9 * (self.lon_offset + self.granularity * lon))}
+
+
+def decode_block(blob):
+    '''
+    worker function, decompresses one OSMData blob and returns a list of
+    (tag, attributes, tags, refs or members) records in file order
+    '''
+    data = blob_data(blob)
+    strings = []
+    groups = []
+    block = BlockSettings()
+    for field, _, value in iter_fields(data):
+        if field == 1:
+            strings = [string.decode('utf-8') for _, _, string in iter_fields(value)]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            block.granularity = value
+        elif field == 18:
+            block.date_granularity = value
+        elif field == 19:
+            block.lat_offset = signed(value)
+        elif field == 20:
+            block.lon_offset = signed(value)
+    records = []
+    for group in groups:
+        for field, _, value in iter_fields(group):
+            if field == 1:
+                records.append(decode_node(value, strings, block))
+            elif field == 2:
+                records.extend(decode_dense(value, strings, block))
+            elif field == 3:
+                records.append(decode_way(value, strings, block))
+            elif field == 4:
+                records.append(decode_relation(value, strings, block))
+    return records
+
+
+def iter_records(pbf_path, workers=None):
+    '''
+    yields decoded records for every element in the file in file order,
+    the blobs are decoded across workers processes (one per core when
+    workers is None, in this process when it is 1).  only 2 blobs per
+    worker are read ahead so memory stays bounded however large the file is
+    '''
+    blobs = (blob for blob_type, blob in read_blobs(pbf_path)
+             if blob_type == 'OSMData')
+    if workers == 1:
+        for blob in blobs:
+            for record in decode_block(blob):
+                yield record
+        return
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers)
+    try:
+        in_flight = collections.deque()
+        for blob in blobs:
+            in_flight.append(pool.apply_async(decode_block, (blob,)))
+            if len(in_flight) < workers * 2:
+                continue
+            for record in in_flight.popleft().get():
+                yield record
+        while in_flight:
+            for record in in_flight.popleft().get():
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def build_element(record):
+    '''turns a decoded record into the Element the xml parser would give'''
+    tag, attribs, tags, refs = record
+    element = ET.Element(tag, attribs)
+    if tag == 'way':
+        for ref in refs:
+            ET.SubElement(element, 'nd', {'ref': str(ref)})
+    elif tag == 'relation':
+        for member_type, member_id, role in refs:
+            ET.SubElement(element, 'member', {'type': member_type,
+                                              'ref': str(member_id),
+                                              'role': role})
+    for key, value in tags:
+        ET.SubElement(element, 'tag', {'k': key, 'v': value})
+    return element
+
+
+def iter_elements(pbf_path, tags=('node', 'way', 'relation'), workers=None):
+    '''yields an Element for every node, way and relation whose tag is in tags'''
+    for record in iter_records(pbf_path, workers):
+        if record[0] in tags:
+            yield build_element(record)
@@ -0,0 +1,102 @@
+'''
+Staged pipeline for process_map.  The parser stage runs in the calling
+thread and hands batches of shaped elements to each writer stage (csv,
+sqlite) through its own bounded queue, so file writes and sqlite inserts
+overlap with parsing and the import takes about as long as its slowest
+stage.  A full queue blocks the parser (backpressure) and the first error in
+any stage stops every other stage and is raised again in the caller.
+'''
+import queue
+import threading
+
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_BATCH_SIZE = 1000
+# how often blocked stages wake up to check whether another stage failed
+POLL_SECONDS = 0.1
+
+FINISHED = object()
+
+
+class PipelineError(Exception):
+    '''raised in the caller when a stage failed, the stage error is the cause'''
+    pass
+
+
+class Stage(threading.Thread):
+    '''a writer stage, calls handler on every item it is handed'''
+
+    def __init__(self, name, handler, queue_size, failed):
+        threading.Thread.__init__(self, name='pipeline-' + name)
+        self.daemon = True
+        self.stage_name = name
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.failed = failed
+        self.error = None
+
+    def run(self):
+        try:
+            while not self.failed.is_set():
+                try:
+                    batch = self.queue.get(timeout=POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if batch is FINISHED:
+                    return
+                for item in batch:
+                    self.handler(item)
+        except Exception as error:
+            self.error = error
+            self.failed.set()
+
+    def put(self, batch):
+        '''
+        hands a batch to the stage, blocking while its queue is full,
+        returns False if the pipeline failed while waiting
+        '''
+        while not self.failed.is_set():
+            try:
+                self.queue.put(batch, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+def run_pipeline(items, stages, queue_size=DEFAULT_QUEUE_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    feeds every item from the items iterable to each of the stages, a
+    list of (name, handler) pairs whose handlers run in their own threads.
+    returns once every stage has handled every item
+    '''
+    failed = threading.Event()
+    threads = [Stage(name, handler, queue_size, failed) for name, handler in stages]
+    for thread in threads:
+        thread.start()
+    parser_error = None
+    try:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                if not all([thread.put(batch) for thread in threads]):
+                    break
+                batch = []
+        else:
+            if batch:
+                for thread in threads:
+                    thread.put(batch)
+            for thread in threads:
+                thread.put(FINISHED)
+    except BaseException as error:
+        parser_error = error
+        failed.set()
+    for thread in threads:
+        thread.join()
+    if parser_error is not None:
+        raise parser_error
+    for thread in threads:
+        if thread.error is not None:
+            raise PipelineError('{0} stage failed: {1!r}'.format(
+                thread.stage_name, thread.error)) from thread.error
@@ -0,0 +1,84 @@
+'''
+Post load stage for Street_Data.db.  The secondary indexes are left off
+while process_map bulk inserts the rows since keeping them up to date row by
+row slows the load down, once the data is in they are built in one go and
+the query planner statistics are refreshed with ANALYZE.
+'''
+import time
+
+# index name to (table, columns)
+INDEXES = {'idx_nodes_tags_id': ('nodes_tags', ('id',)),
+           'idx_nodes_tags_key_value': ('nodes_tags', ('key', 'value')),
+           'idx_ways_tags_id': ('ways_tags', ('id',)),
+           'idx_ways_tags_key_value': ('ways_tags', ('key', 'value')),
+           'idx_ways_nodes_id': ('ways_nodes', ('id', 'position')),
+           'idx_ways_nodes_node_id': ('ways_nodes', ('node_id',)),
+           # the tables behind the views when tags are interned, see tag_dictionary
+           'idx_nodes_tag_ids_id': ('nodes_tag_ids', ('id',)),
+           'idx_nodes_tag_ids_key_value': ('nodes_tag_ids', ('key_id', 'value_id')),
+           'idx_ways_tag_ids_id': ('ways_tag_ids', ('id',)),
+           'idx_ways_tag_ids_key_value': ('ways_tag_ids', ('key_id', 'value_id'))}
+
+# sorting a large index spills to temp files unless it has memory to use
+INDEX_BUILD_PRAGMAS = {'temp_store': 'MEMORY', 'cache_size': '-500000'}
+
+
+def create_index(cursor, name):
+    '''
+    creates one of the indexes in INDEXES if it isn't there yet, returns
+    False without doing anything when its table isn't in the database
+    (nodes_tags and ways_tags are views when tags are interned)
+    '''
+    table, columns = INDEXES[name]
+    if cursor.execute("select 1 from sqlite_master where type = 'table' and name = ?;",
+                      (table,)).fetchone() is None:
+        return False
+    cursor.execute('CREATE INDEX IF NOT EXISTS {0} ON {1}({2});'.format(
+        name, table, ', '.join(columns)))
+    return True
+
+
+def optimize(connection, indexes=None, analyze=True, vacuum=False):
+    '''
+    builds the indexes (every one in INDEXES whose table is in the
+    database by default), then runs
+    ANALYZE and optionally VACUUM.  returns a list of (step, seconds)
+    '''
+    timings = []
+    cursor = connection.cursor()
+    for pragma, value in INDEX_BUILD_PRAGMAS.items():
+        cursor.execute('pragma {0} = {1};'.format(pragma, value))
+    for name in sorted(INDEXES) if indexes is None else indexes:
+        begin = time.time()
+        if create_index(cursor, name):
+            connection.commit()
+            timings.append((name, time.time() - begin))
+    return timings + finish(connection, analyze, vacuum)
+
+
+def finish(connection, analyze=True, vacuum=False):
+    '''
+    runs ANALYZE and optionally VACUUM, the last steps of optimize.  call
+    it separately when more tables are built after the indexes so they are
+    covered too.  returns a list of (step, seconds)
+    '''
+    timings = []
+    cursor = connection.cursor()
+    if analyze:
+        begin = time.time()
+        cursor.execute('ANALYZE;')
+        connection.commit()
+        timings.append(('analyze', time.time() - begin))
+    if vacuum:
+        begin = time.time()
+        cursor.execute('VACUUM;')
+        timings.append(('vacuum', time.time() - begin))
+    return timings
+
+
+def report(timings):
+    '''returns a printable summary of the post load timings'''
+    lines = ['{0:<26} {1:>8.2f}s'.format(step, seconds) for step, seconds in timings]
+    lines.append('{0:<26} {1:>8.2f}s'.format(
+        'total', sum(seconds for _, seconds in timings)))
+    return '\n'.join(lines)
@@ -0,0 +1,371 @@
+'''
+Read side query layer over the Street_Data.db process_map builds.  A
+QueryService hands out read only connections from a fixed size pool, every
+lookup runs one of the fixed statements below so sqlite3's per connection
+statement cache keeps them prepared, and results are kept in a bounded LRU
+cache shared by every thread.  The cache is emptied when the database
+changes (osc_update applying a diff, say), which is noticed through sqlite's
+data_version at most every refresh_interval seconds, or by calling
+clear_cache.
+
+The same lookups are served as json over HTTP by a threading server for
+local services:
+
+    python query_service.py Street_Data.db --port 8080
+
+    GET /node/<id>            node with its location and tags
+    GET /way/<id>             way with its tags
+    GET /way/<id>/nodes       way with its tags and its nodes in order
+    GET /search?key=addr:street&value=Hillsborough Street&type=node&limit=100
+    GET /address?q=1200 hillsb&limit=10
+    GET /stats                pool and cache statistics
+    POST /cache/clear         empty the result cache
+'''
+import argparse
+import collections
+import contextlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import address_search
+import spatial
+from records import split_key
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_CACHE_SIZE = 10000
+# prepared statements each connection keeps, more than the service uses
+STATEMENT_CACHE_SIZE = 64
+DEFAULT_SEARCH_LIMIT = 100
+# seconds between checks of whether the database has changed
+DEFAULT_REFRESH_INTERVAL = 1.0
+
+NODE_SQL = ('select id, lat, lon, user, uid, version, changeset, timestamp '
+            'from nodes where id = ?;')
+WAY_SQL = 'select id, user, uid, version, changeset, timestamp from ways where id = ?;'
+NODE_TAGS_SQL = 'select key, value, type from nodes_tags where id = ?;'
+WAY_TAGS_SQL = 'select key, value, type from ways_tags where id = ?;'
+WAY_NODES_SQL = ('select wn.node_id, n.lat, n.lon from ways_nodes wn '
+                 'left join nodes n on n.id = wn.node_id '
+                 'where wn.id = ? order by wn.position;')
+# the tag tables store 'addr:street' as type 'addr' and key 'street'
+SEARCH_SQL = {
+    ('node', False): 'select id from nodes_tags where key = ? and type = ? '
+                     'group by id order by id limit ?;',
+    ('node', True): 'select id from nodes_tags where key = ? and type = ? and value = ? '
+                    'group by id order by id limit ?;',
+    ('way', False): 'select id from ways_tags where key = ? and type = ? '
+                    'group by id order by id limit ?;',
+    ('way', True): 'select id from ways_tags where key = ? and type = ? and value = ? '
+                   'group by id order by id limit ?;'}
+
+NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
+WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+
+
+def check_limit(limit):
+    '''
+    returns limit as an int, ValueError is raised if it is negative since
+    sqlite treats a negative LIMIT as no limit
+    '''
+    limit = int(limit)
+    if limit < 0:
+        raise ValueError('limit must be 0 or more')
+    return limit
+
+
+class ConnectionPool(object):
+    '''
+    a fixed number of read only connections shared between threads, a
+    thread borrows one with the connection context manager
+    '''
+
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self.idle = queue.Queue()
+        # connection to the data_version it last saw
+        self.data_versions = {}
+        for _ in range(size):
+            connection = sqlite3.connect(
+                'file:{0}?mode=ro'.format(db_path), uri=True,
+                check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+            self.data_versions[connection] = self.data_version(connection)
+            self.idle.put(connection)
+
+    @staticmethod
+    def data_version(connection):
+        return connection.execute('pragma data_version;').fetchone()[0]
+
+    def changed(self):
+        '''
+        returns True if another connection has written to the database since
+        the connection this borrows last looked
+        '''
+        with self.connection() as connection:
+            version = self.data_version(connection)
+            changed = version != self.data_versions[connection]
+            self.data_versions[connection] = version
+        return changed
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''borrows a connection, waiting for one to be handed back if none are free'''
+        connection = self.idle.get()
+        try:
+            yield connection
+        finally:
+            self.idle.put(connection)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().close()
+
+
+class ResultCache(object):
+    '''thread safe LRU cache holding at most size results'''
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        '''returns the cached result for key, calling compute() on a miss'''
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        # run the query outside the lock, two threads missing on the same
+        # key at once both run it and the second result wins
+        result = compute()
+        if self.size:
+            with self.lock:
+                self.entries[key] = result
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'size': self.size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / float(lookups) if lookups else 0.0}
+
+
+class QueryService(object):
+    '''
+    ready made lookups over Street_Data.db, results are plain dictionaries
+    that are shared through the cache so callers shouldn't change them
+    '''
+
+    def __init__(self, db_path, pool_size=DEFAULT_POOL_SIZE, cache_size=DEFAULT_CACHE_SIZE,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.pool = ConnectionPool(db_path, pool_size)
+        self.cache = ResultCache(cache_size)
+        self.refresh_interval = refresh_interval
+        self.last_refresh = time.time()
+        self.refresh_lock = threading.Lock()
+        with self.pool.connection() as connection:
+            self.has_address_search = connection.execute(
+                "select 1 from sqlite_master where name = 'address_search';").fetchone() \
+                is not None
+
+    def close(self):
+        self.pool.close()
+
+    def clear_cache(self):
+        '''empties the result cache, call it after changing the database'''
+        self.cache.clear()
+
+    def refresh(self):
+        '''
+        empties the result cache if the database has changed, checked at
+        most every refresh_interval seconds (every lookup when it is 0)
+        '''
+        with self.refresh_lock:
+            now = time.time()
+            if now - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = now
+        if self.pool.changed():
+            self.cache.clear()
+
+    @staticmethod
+    def tags(connection, statement, element_id):
+        return dict((spatial.full_key(key, tag_type), value) for key, value, tag_type
+                    in connection.execute(statement, (element_id,)))
+
+    def node(self, node_id):
+        '''returns a node with its location and tags, or None'''
+        def compute():
+            with self.pool.connection() as connection:
+                row = connection.execute(NODE_SQL, (node_id,)).fetchone()
+                if row is None:
+                    return None
+                node = dict(zip(NODE_FIELDS, row))
+                node['tags'] = self.tags(connection, NODE_TAGS_SQL, node_id)
+                return node
+        self.refresh()
+        return self.cache.get(('node', int(node_id)), compute)
+
+    def way(self, way_id, with_nodes=False):
+        '''
+        returns a way with its tags, or None.  with_nodes adds its nodes in
+        order as dictionaries of id, lat and lon (None for nodes missing
+        from the database)
+        '''
+        def compute():
+            with self.pool.connection() as connection:
+                row = connection.execute(WAY_SQL, (way_id,)).fetchone()
+                if row is None:
+                    return None
+                way = dict(zip(WAY_FIELDS, row))
+                way['tags'] = self.tags(connection, WAY_TAGS_SQL, way_id)
+                if with_nodes:
+                    way['nodes'] = [{'id': node_id, 'lat': lat, 'lon': lon}
+                                    for node_id, lat, lon
+                                    in connection.execute(WAY_NODES_SQL, (way_id,))]
+                return way
+        self.refresh()
+        return self.cache.get(('way', int(way_id), bool(with_nodes)), compute)
+
+    def search(self, key, value=None, element_type='node', limit=DEFAULT_SEARCH_LIMIT):
+        '''
+        returns the elements of element_type ('node' or 'way') that have a
+        tag with this key, and this value when one is given, with their tags.
+        ValueError is raised for a negative limit, see check_limit
+        '''
+        if element_type not in ('node', 'way'):
+            raise ValueError("element_type must be 'node' or 'way'")
+        limit = check_limit(limit)
+        def compute():
+            tag_key, tag_type = split_key(key)
+            params = [tag_key, tag_type] + ([value] if value is not None else []) + [limit]
+            with self.pool.connection() as connection:
+                ids = [element_id for (element_id,) in connection.execute(
+                    SEARCH_SQL[(element_type, value is not None)], params)]
+            lookup = self.node if element_type == 'node' else self.way
+            return [lookup(element_id) for element_id in ids]
+        self.refresh()
+        return self.cache.get(('search', key, value, element_type, limit), compute)
+
+    def address(self, query, limit=10):
+        '''ranked address search, see address_search.search'''
+        limit = check_limit(limit)
+        if not self.has_address_search:
+            return []
+        def compute():
+            with self.pool.connection() as connection:
+                return address_search.search(connection, query, limit)
+        self.refresh()
+        return self.cache.get(('address', query, limit), compute)
+
+    def stats(self):
+        return {'pool_size': self.pool.size, 'idle_connections': self.pool.idle.qsize(),
+                'cache': self.cache.stats()}
+
+
+# ================================================== #
+#               HTTP endpoint                        #
+# ================================================== #
+class QueryHandler(BaseHTTPRequestHandler):
+    '''routes GET requests to the QueryService on the server'''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        params = dict((name, values[0]) for name, values in parse_qs(url.query).items())
+        service = self.server.service
+        try:
+            if len(parts) == 2 and parts[0] == 'node':
+                result = service.node(int(parts[1]))
+            elif len(parts) == 2 and parts[0] == 'way':
+                result = service.way(int(parts[1]))
+            elif len(parts) == 3 and parts[0] == 'way' and parts[2] == 'nodes':
+                result = service.way(int(parts[1]), with_nodes=True)
+            elif parts == ['search'] and 'key' in params:
+                result = service.search(params['key'], params.get('value'),
+                                        params.get('type', 'node'),
+                                        int(params.get('limit', DEFAULT_SEARCH_LIMIT)))
+            elif parts == ['address'] and 'q' in params:
+                result = service.address(params['q'], int(params.get('limit', 10)))
+            elif parts == ['stats']:
+                result = service.stats()
+            else:
+                return self.send_json(404, {'error': 'unknown request'})
+        except ValueError as error:
+            return self.send_json(400, {'error': str(error)})
+        except sqlite3.Error as error:
+            # a locked, missing or corrupt database, the handler thread
+            # carries on serving the other requests
+            return self.send_json(500, {'error': 'database error: {0}'.format(error)})
+        if result is None:
+            return self.send_json(404, {'error': 'not found'})
+        self.send_json(200, result)
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') == '/cache/clear':
+            self.server.service.clear_cache()
+            return self.send_json(200, {'cleared': True})
+        self.send_json(404, {'error': 'unknown request'})
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # one line per request would swamp the console under load
+        pass
+
+
+def make_server(service, host='127.0.0.1', port=8080):
+    '''returns a ThreadingHTTPServer serving the service, call serve_forever on it'''
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='serve Street_Data.db lookups as json')
+    parser.add_argument('db_path', nargs='?', default='Street_Data.db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE)
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE)
+    parser.add_argument('--refresh-interval', type=float, default=DEFAULT_REFRESH_INTERVAL,
+                        help='seconds between checks for changes to the database')
+    args = parser.parse_args()
+    service = QueryService(args.db_path, args.pool_size, args.cache_size,
+                           args.refresh_interval)
+    server = make_server(service, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+'''
+Compact row types for shaped elements.  shape_attribs used to build a dict
+for every node, way, tag and way node, which is most of the memory and a
+good part of the time of an import.  Each row is now a namedtuple, so it has
+no per row __dict__ and its fields are in the column order of the tables in
+data_wrangling_schema.sql, which means csv.writer and BulkLoader can take
+it as it is.
+
+A shaped node is a ShapedNode of its Node and a list of Tag rows, a shaped
+way a ShapedWay of its Way and lists of WayNode and Tag rows.  as_dict turns
+either back into the dictionaries shape_element has always returned for
+code (the validator, osc_update, the rejects file) that still wants them.
+
+Shaped elements cross from the parallel workers to the importer as a batch
+from encode_batch, the rows as plain tuples marshalled one table after
+another.  Unpickling a list of namedtuples costs more than shaping it did,
+decode_batch only makes the Node and Way records again and leaves the tag
+and way node rows as plain tuples in the same column order, which is how
+every consumer of them reads them.
+
+split_key, the rule that splits a tag's k into its key and type, is kept
+here too so code that reads the tables, like query_service, can split keys
+the same way without importing the importer.
+'''
+import collections
+import functools
+import marshal
+import re
+
+LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
+PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+# distinct tag keys split_key remembers
+KEY_CACHE_SIZE = 65536
+
+Node = collections.namedtuple('Node', ['id', 'lat', 'lon', 'user', 'uid', 'version',
+                                       'changeset', 'timestamp'])
+Way = collections.namedtuple('Way', ['id', 'user', 'uid', 'version', 'changeset',
+                                     'timestamp'])
+Tag = collections.namedtuple('Tag', ['id', 'key', 'value', 'type'])
+WayNode = collections.namedtuple('WayNode', ['id', 'node_id', 'position'])
+
+ShapedNode = collections.namedtuple('ShapedNode', ['node', 'node_tags'])
+ShapedWay = collections.namedtuple('ShapedWay', ['way', 'way_nodes', 'way_tags'])
+
+# the record type the rows of each schema.py entry are shaped into
+SCHEMA_RECORDS = {'node': Node, 'node_tags': Tag, 'way': Way, 'way_nodes': WayNode,
+                  'way_tags': Tag}
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def split_key(k):
+    '''
+    returns the (key, type) a tag's k attribute is split into.  'addr:street'
+    gives ('street', 'addr') and keys without a lower case prefix are type
+    'regular', the key is 'PASS' for prefixed keys with problem characters
+    which means the tag is dropped.  memoized per distinct k since an
+    extract only has a few thousand of them and every tag is split
+    '''
+    if LOWER_COLON.search(k):
+        tag_type, key = k.split(':', 1)
+        if PROBLEMCHARS.search(k):
+            key = 'PASS'
+        return key, tag_type
+    return k, 'regular'
+
+
+def from_attribs(record_type, attrib, fields=None):
+    '''
+    builds a Node or Way from an element's attributes, the ones it doesn't
+    have are None (written as an empty csv field like csv.DictWriter did).
+    when fields is given the attributes not in it are left out as well
+    '''
+    if fields is None:
+        return record_type._make([attrib.get(field) for field in record_type._fields])
+    return record_type._make([attrib.get(field) if field in fields else None
+                              for field in record_type._fields])
+
+
+def row_dict(record, record_type=None):
+    '''
+    a row as a dictionary, fields that are None are left out since the old
+    dictionaries only had keys for the attributes the element had.  a plain
+    tuple row needs the record_type whose fields it has
+    '''
+    fields = (record_type or record)._fields
+    return dict((field, value) for field, value in zip(fields, record)
+                if value is not None)
+
+
+def as_dict(shaped):
+    '''
+    turns a ShapedNode or ShapedWay into the dictionary of row dictionaries
+    shape_element returns, anything else is passed back unchanged
+    '''
+    if isinstance(shaped, ShapedNode):
+        return {'node': row_dict(shaped.node, Node),
+                'node_tags': [row_dict(tag, Tag) for tag in shaped.node_tags]}
+    if isinstance(shaped, ShapedWay):
+        return {'way': row_dict(shaped.way, Way),
+                'way_nodes': [row_dict(way_node, WayNode) for way_node in shaped.way_nodes],
+                'way_tags': [row_dict(tag, Tag) for tag in shaped.way_tags]}
+    return shaped
+
+
+def encode_batch(shaped):
+    '''
+    packs a list of (tag, shaped element) pairs into bytes for decode_batch.
+    each table's rows go in one list of plain tuples, with the tags and way
+    nodes each element has counted so they can be split up again
+    '''
+    kinds = []
+    nodes = []
+    ways = []
+    tags = []
+    tag_counts = []
+    way_nodes = []
+    way_node_counts = []
+    for tag, el in shaped:
+        if tag == 'node':
+            kinds.append('n')
+            nodes.append(tuple(el.node))
+            element_tags = el.node_tags
+        elif tag == 'way':
+            kinds.append('w')
+            ways.append(tuple(el.way))
+            way_nodes.extend(map(tuple, el.way_nodes))
+            way_node_counts.append(len(el.way_nodes))
+            element_tags = el.way_tags
+        else:
+            continue
+        tags.extend(map(tuple, element_tags))
+        tag_counts.append(len(element_tags))
+    return marshal.dumps((''.join(kinds), nodes, ways, tags, tag_counts, way_nodes,
+                          way_node_counts))
+
+
+def decode_batch(data):
+    '''
+    returns the (tag, shaped element) pairs encode_batch packed, in the
+    same order.  the tag and way node rows are plain tuples
+    '''
+    kinds, nodes, ways, tags, tag_counts, way_nodes, way_node_counts = marshal.loads(data)
+    make = tuple.__new__
+    shaped = []
+    append = shaped.append
+    node_index = way_index = tag_index = way_node_index = 0
+    for kind, tag_count in zip(kinds, tag_counts):
+        tag_end = tag_index + tag_count
+        if kind == 'n':
+            append(('node', make(ShapedNode, (make(Node, nodes[node_index]),
+                                              tags[tag_index:tag_end]))))
+            node_index += 1
+        else:
+            way_node_end = way_node_index + way_node_counts[way_index]
+            append(('way', make(ShapedWay, (make(Way, ways[way_index]),
+                                            way_nodes[way_node_index:way_node_end],
+                                            tags[tag_index:tag_end]))))
+            way_index += 1
+            way_node_index = way_node_end
+        tag_index = tag_end
+    return shaped
@@ -0,0 +1,196 @@
+'''
+Geohash tiled output.  Alongside the normal outputs process_map can split
+the nodes, ways, tags and way nodes into one SQLite database per geohash
+tile, with the same tables as Street_Data.db, so regions can be loaded and
+queried in parallel by separate processes or machines.
+
+A node goes to the tile its location is in.  A way goes to the tile of its
+first node that has a location, so a way crossing tiles always lands in the
+same one whatever order the tiles are processed in, and its way nodes and
+tags go with it.  Ways with no located nodes go to the UNPLACED shard.
+manifest.json lists every shard with its tile bounds and row counts.
+'''
+import json
+import os
+import sqlite3
+
+import bulk_loader
+import post_load
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+DEFAULT_PRECISION = 4
+# rows buffered across every tile before they are written out, one
+# database open at a time, so fine tiles don't run out of file handles
+SHARD_BATCH_SIZE = 200000
+UNPLACED = 'unplaced'
+MANIFEST_NAME = 'manifest.json'
+
+
+def geohash(lat, lon, precision=DEFAULT_PRECISION):
+    '''returns the geohash of a point with precision characters'''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value, value_range = (lon, lon_range) if even else (lat, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def geohash_bbox(tile):
+    '''returns (min_lat, min_lon, max_lat, max_lon) of a geohash tile'''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in tile:
+        bits = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lon_range if even else lat_range
+            middle = (value_range[0] + value_range[1]) / 2
+            if bits >> shift & 1:
+                value_range[0] = middle
+            else:
+                value_range[1] = middle
+            even = not even
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+class ShardWriter(object):
+    '''
+    writes shaped nodes and ways to one database per tile in directory,
+    the databases are created with schema_commands (the statements of
+    data_wrangling_schema.sql) the first time a tile is used.  rows are
+    buffered per tile and written batch_size at a time, tile by tile
+    '''
+
+    def __init__(self, directory, schema_commands, precision=DEFAULT_PRECISION,
+                 tables=None, batch_size=SHARD_BATCH_SIZE, fast_import=False,
+                 optimize=True):
+        self.directory = directory
+        self.schema_commands = schema_commands
+        self.precision = precision
+        # table name to columns, the same tables process_map loads
+        self.tables = tables
+        self.batch_size = batch_size
+        self.fast_import = fast_import
+        self.optimize = optimize
+        # tile to table to the rows waiting to be written
+        self.buffers = {}
+        self.pending = 0
+        # every tile written so far to its row counts
+        self.rows = {}
+        self.way_tiles = {'first_node': 0, 'unplaced': 0}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, tile):
+        return os.path.join(self.directory, tile + '.db')
+
+    def buffer(self, tile, table, rows):
+        '''queues rows for a tile's table'''
+        tables = self.buffers.get(tile)
+        if tables is None:
+            tables = self.buffers[tile] = dict((name, []) for name in self.tables)
+        tables[table].extend(rows)
+        self.pending += len(rows)
+
+    def write_tile(self, tile, tables):
+        '''
+        writes a tile's buffered rows to its database, creating the
+        database the first time
+        '''
+        new = tile not in self.rows
+        if new and os.path.exists(self.path(tile)):
+            os.remove(self.path(tile))
+        connection = sqlite3.connect(self.path(tile))
+        if new:
+            cursor = connection.cursor()
+            for command in self.schema_commands:
+                cursor.execute(command)
+            connection.commit()
+            self.rows[tile] = dict((table, 0) for table in self.tables)
+        shard = bulk_loader.BulkLoader(connection, batch_size=self.batch_size,
+                                       fast_import=self.fast_import)
+        for table, columns in self.tables.items():
+            shard.add_table(table, columns)
+        shard.start()
+        for table, rows in tables.items():
+            shard.add_many(table, rows)
+        shard.finish()
+        connection.close()
+        for table, stats in shard.stats().items():
+            self.rows[tile][table] += stats['rows']
+
+    def flush(self):
+        '''writes out every buffered row'''
+        for tile, tables in sorted(self.buffers.items()):
+            self.write_tile(tile, tables)
+        self.buffers = {}
+        self.pending = 0
+
+    def add_node(self, el):
+        '''adds a shaped node to the tile it is in'''
+        node = el.node
+        tile = geohash(float(node.lat), float(node.lon), self.precision)
+        self.buffer(tile, 'nodes', [node])
+        self.buffer(tile, 'nodes_tags', el.node_tags)
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def add_way(self, el, coords):
+        '''
+        adds a shaped way to the tile of its first located node, coords are
+        the (lat, lon) of its nodes that could be resolved in order
+        '''
+        if coords:
+            tile = geohash(coords[0][0], coords[0][1], self.precision)
+            self.way_tiles['first_node'] += 1
+        else:
+            tile = UNPLACED
+            self.way_tiles['unplaced'] += 1
+        self.buffer(tile, 'ways', [el.way])
+        self.buffer(tile, 'ways_tags', el.way_tags)
+        self.buffer(tile, 'ways_nodes', el.way_nodes)
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def close(self):
+        '''
+        flushes every shard, builds its indexes and writes the manifest,
+        which is also returned
+        '''
+        self.flush()
+        tiles = {}
+        for tile, rows in sorted(self.rows.items()):
+            if self.optimize:
+                connection = sqlite3.connect(self.path(tile))
+                post_load.optimize(connection)
+                connection.close()
+            entry = {'path': os.path.basename(self.path(tile)),
+                     'rows': dict(rows)}
+            if tile != UNPLACED:
+                entry['bbox'] = geohash_bbox(tile)
+            tiles[tile] = entry
+        manifest = {'precision': self.precision,
+                    'way_assignment': 'first_node',
+                    'ways': dict(self.way_tiles),
+                    'tiles': tiles}
+        with open(os.path.join(self.directory, MANIFEST_NAME), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+        return manifest
+
@@ -0,0 +1,164 @@
+'''
+R*Tree spatial index over the nodes and ways in Street_Data.db and a small
+query API for bounding box and radius lookups.  Node points and way bounding
+boxes are added to the index while process_map loads the file, the way boxes
+come from the node locations kept in a NodeStore earlier in the same pass
+since an .osm file lists every node before the ways that use it.
+'''
+import math
+import sqlite3
+
+RTREE_FIELDS = ['id', 'min_lat', 'max_lat', 'min_lon', 'max_lon']
+
+SPATIAL_SCHEMA = ['CREATE VIRTUAL TABLE IF NOT EXISTS nodes_rtree USING rtree('
+                  'id, min_lat, max_lat, min_lon, max_lon)',
+                  'CREATE VIRTUAL TABLE IF NOT EXISTS ways_rtree USING rtree('
+                  'id, min_lat, max_lat, min_lon, max_lon)']
+
+EARTH_RADIUS = 6371008.8
+
+
+def create_tables(cursor):
+    '''creates the R*Tree tables if they aren't there yet'''
+    for command in SPATIAL_SCHEMA:
+        cursor.execute(command)
+
+
+class SpatialIndexer(object):
+    '''
+    feeds node points and way bounding boxes to a BulkLoader as the file
+    is processed
+    '''
+
+    def __init__(self, loader):
+        self.loader = loader
+        loader.add_table('nodes_rtree', RTREE_FIELDS)
+        loader.add_table('ways_rtree', RTREE_FIELDS)
+
+    def add_node(self, node):
+        '''adds a shaped node record to the index'''
+        lat = float(node.lat)
+        lon = float(node.lon)
+        self.loader.add('nodes_rtree', (node.id, lat, lat, lon, lon))
+
+    def add_way(self, way, coords):
+        '''
+        adds the bounding box of a shaped way record, coords are the
+        (lat, lon) of the way's nodes that could be resolved
+        '''
+        if coords:
+            lats = [lat for lat, _ in coords]
+            lons = [lon for _, lon in coords]
+            self.loader.add('ways_rtree', (way.id, min(lats), max(lats),
+                                           min(lons), max(lons)))
+
+
+# ================================================== #
+#               Query API                            #
+# ================================================== #
+def connect(db_path):
+    '''opens the database read only'''
+    return sqlite3.connect('file:{0}?mode=ro'.format(db_path), uri=True)
+
+
+def full_key(key, tag_type):
+    '''puts a tag key back together the way it appears in the osm file'''
+    if tag_type == 'regular':
+        return key
+    return '{0}:{1}'.format(tag_type, key)
+
+
+def fetch_tags(connection, table, ids):
+    '''returns a dictionary of element id to its tags'''
+    tags = dict((element_id, {}) for element_id in ids)
+    ids = list(ids)
+    # stay under sqlite's limit on bound parameters
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        rows = connection.execute(
+            'select id, key, value, type from {0} where id in ({1});'.format(
+                table, ', '.join('?' * len(chunk))), chunk)
+        for element_id, key, value, tag_type in rows:
+            tags[element_id][full_key(key, tag_type)] = value
+    return tags
+
+
+def nodes_in_bbox(connection, min_lat, min_lon, max_lat, max_lon, with_tags=True):
+    '''returns every node inside the box with its location and tags'''
+    rows = connection.execute(
+        'select n.id, n.lat, n.lon from nodes_rtree r join nodes n on n.id = r.id '
+        'where r.max_lat >= ? and r.min_lat <= ? and r.max_lon >= ? and r.min_lon <= ?;',
+        (min_lat, max_lat, min_lon, max_lon)).fetchall()
+    # the R*Tree stores 32 bit floats rounded outwards so the exact check is
+    # made against the coordinates in nodes
+    nodes = [{'id': node_id, 'lat': lat, 'lon': lon} for node_id, lat, lon in rows
+             if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon]
+    if with_tags:
+        tags = fetch_tags(connection, 'nodes_tags', [node['id'] for node in nodes])
+        for node in nodes:
+            node['tags'] = tags[node['id']]
+    return nodes
+
+
+def ways_in_bbox(connection, min_lat, min_lon, max_lat, max_lon, with_tags=True):
+    '''returns every way whose bounding box overlaps the box'''
+    rows = connection.execute(
+        'select id, min_lat, max_lat, min_lon, max_lon from ways_rtree '
+        'where max_lat >= ? and min_lat <= ? and max_lon >= ? and min_lon <= ?;',
+        (min_lat, max_lat, min_lon, max_lon)).fetchall()
+    ways = [{'id': way_id, 'min_lat': way_min_lat, 'max_lat': way_max_lat,
+             'min_lon': way_min_lon, 'max_lon': way_max_lon}
+            for way_id, way_min_lat, way_max_lat, way_min_lon, way_max_lon in rows]
+    if with_tags:
+        tags = fetch_tags(connection, 'ways_tags', [way['id'] for way in ways])
+        for way in ways:
+            way['tags'] = tags[way['id']]
+    return ways
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''great circle distance in metres between two points'''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat, lon, radius):
+    '''returns (min_lat, min_lon, max_lat, max_lon) of a box around a circle'''
+    lat_delta = math.degrees(radius / EARTH_RADIUS)
+    lon_delta = math.degrees(radius / (EARTH_RADIUS *
+                                       max(math.cos(math.radians(lat)), 1e-12)))
+    return lat - lat_delta, lon - lon_delta, lat + lat_delta, lon + lon_delta
+
+
+def nodes_within_radius(connection, lat, lon, radius, with_tags=True):
+    '''
+    returns every node within radius metres of the point sorted by
+    distance, each node has its distance in metres under 'distance'
+    '''
+    nodes = []
+    for node in nodes_in_bbox(connection, *radius_bbox(lat, lon, radius),
+                              with_tags=with_tags):
+        node['distance'] = haversine(lat, lon, node['lat'], node['lon'])
+        if node['distance'] <= radius:
+            nodes.append(node)
+    nodes.sort(key=lambda node: node['distance'])
+    return nodes
+
+
+def ways_within_radius(connection, lat, lon, radius, with_tags=True):
+    '''
+    returns every way whose bounding box comes within radius metres of
+    the point sorted by that distance
+    '''
+    ways = []
+    for way in ways_in_bbox(connection, *radius_bbox(lat, lon, radius),
+                            with_tags=with_tags):
+        nearest_lat = min(max(lat, way['min_lat']), way['max_lat'])
+        nearest_lon = min(max(lon, way['min_lon']), way['max_lon'])
+        way['distance'] = haversine(lat, lon, nearest_lat, nearest_lon)
+        if way['distance'] <= radius:
+            ways.append(way)
+    ways.sort(key=lambda way: way['distance'])
+    return ways
@@ -0,0 +1,215 @@
+'''
+Interned tag storage for Street_Data.db.  Nearly every row of nodes_tags
+and ways_tags repeats one of a few hundred keys and types, so in this mode
+the keys and types are stored once in the tag_keys and tag_types tables and
+the tag rows in nodes_tag_ids and ways_tag_ids only hold their integer ids.
+Values that come up often enough can be interned into tag_values as well,
+the rest stay as text on the tag row.
+
+nodes_tags and ways_tags become views that join the text back in, so
+queries written against the plain tables keep working, and INSTEAD OF
+triggers let inserts and deletes through the views (osc_update relies on
+that).  Filtering on a key looks up one tag_keys row and then walks the
+(key_id, value_id) index, which is much smaller than the text one.
+'''
+TAG_ID_FIELDS = ['id', 'key_id', 'value_id', 'value', 'type_id']
+
+# the view the tag rows are read through to the table they are stored in
+TAG_TABLES = {'nodes_tags': 'nodes_tag_ids', 'ways_tags': 'ways_tag_ids'}
+ELEMENT_TABLES = {'nodes_tags': 'nodes', 'ways_tags': 'ways'}
+
+# dictionary table to its text column
+DICTIONARY_TABLES = {'tag_keys': 'key', 'tag_types': 'type', 'tag_values': 'value'}
+
+# longer values hardly ever repeat, so they aren't counted for interning
+MAX_INTERNED_VALUE_LENGTH = 64
+# distinct values counted at once, names and streets would otherwise keep
+# a count for nearly every row
+MAX_COUNTED_VALUES = 100000
+
+DICTIONARY_SCHEMA = ['''CREATE TABLE IF NOT EXISTS tag_keys (
+    id INTEGER PRIMARY KEY NOT NULL,
+    key TEXT NOT NULL UNIQUE
+)''', '''CREATE TABLE IF NOT EXISTS tag_types (
+    id INTEGER PRIMARY KEY NOT NULL,
+    type TEXT NOT NULL UNIQUE
+)''', '''CREATE TABLE IF NOT EXISTS tag_values (
+    id INTEGER PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL UNIQUE
+)''']
+
+TAG_ID_SCHEMA = '''CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    value_id INTEGER,
+    value TEXT,
+    type_id INTEGER,
+    FOREIGN KEY (id) REFERENCES {elements}(id),
+    FOREIGN KEY (key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY (value_id) REFERENCES tag_values(id),
+    FOREIGN KEY (type_id) REFERENCES tag_types(id)
+)'''
+
+TAG_VIEW = '''CREATE VIEW IF NOT EXISTS {view} AS
+SELECT t.id AS id, k.key AS key, coalesce(v.value, t.value) AS value,
+       y.type AS type
+FROM {table} t
+JOIN tag_keys k ON k.id = t.key_id
+LEFT JOIN tag_values v ON v.id = t.value_id
+LEFT JOIN tag_types y ON y.id = t.type_id'''
+
+# new keys and types are added to the dictionary, values are only looked up.
+# the NOT EXISTS checks keep an INSERT OR REPLACE on the view from replacing
+# dictionary rows other tags already point at
+TAG_INSERT_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS {view}_insert
+INSTEAD OF INSERT ON {view}
+BEGIN
+    INSERT INTO tag_keys (key) SELECT NEW.key
+        WHERE NOT EXISTS (SELECT 1 FROM tag_keys WHERE key = NEW.key);
+    INSERT INTO tag_types (type) SELECT NEW.type
+        WHERE NEW.type IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM tag_types WHERE type = NEW.type);
+    INSERT INTO {table} (id, key_id, value_id, value, type_id) VALUES (
+        NEW.id,
+        (SELECT id FROM tag_keys WHERE key = NEW.key),
+        (SELECT id FROM tag_values WHERE value = NEW.value),
+        CASE WHEN EXISTS (SELECT 1 FROM tag_values WHERE value = NEW.value)
+             THEN NULL ELSE NEW.value END,
+        (SELECT id FROM tag_types WHERE type = NEW.type));
+END'''
+
+TAG_DELETE_TRIGGER = '''CREATE TRIGGER IF NOT EXISTS {view}_delete
+INSTEAD OF DELETE ON {view}
+BEGIN
+    DELETE FROM {table}
+    WHERE id = OLD.id
+    AND key_id = (SELECT id FROM tag_keys WHERE key = OLD.key)
+    AND type_id IS (SELECT id FROM tag_types WHERE type = OLD.type)
+    AND coalesce((SELECT value FROM tag_values WHERE id = value_id), value) = OLD.value;
+END'''
+
+
+def table_type(cursor, name):
+    '''returns 'table', 'view' or None for a name in the database'''
+    row = cursor.execute('select type from sqlite_master where name = ?;',
+                         (name,)).fetchone()
+    return row[0] if row else None
+
+
+def create_tables(cursor):
+    '''
+    creates the dictionary tables, the tag id tables and the nodes_tags and
+    ways_tags views over them.  empty nodes_tags and ways_tags tables left
+    by the schema script are dropped first, ValueError is raised if they
+    already hold text rows
+    '''
+    for command in DICTIONARY_SCHEMA:
+        cursor.execute(command)
+    for view, table in sorted(TAG_TABLES.items()):
+        if table_type(cursor, view) == 'table':
+            if cursor.execute('select 1 from {0} limit 1;'.format(view)).fetchone():
+                raise ValueError('{0} already holds tags stored as text'.format(view))
+            cursor.execute('DROP TABLE {0};'.format(view))
+        cursor.execute(TAG_ID_SCHEMA.format(table=table, elements=ELEMENT_TABLES[view]))
+        for template in (TAG_VIEW, TAG_INSERT_TRIGGER, TAG_DELETE_TRIGGER):
+            cursor.execute(template.format(view=view, table=table))
+
+
+def is_interned(cursor):
+    '''returns True if the database stores its tags in this mode'''
+    return table_type(cursor, 'nodes_tags') == 'view'
+
+
+class TagDictionary(object):
+    '''
+    turns shaped tag rows into tag id rows for a BulkLoader, new keys,
+    types and values are given the next id and added to the loader as they
+    turn up.  with intern_values a value is interned once it has been seen
+    that many times, earlier rows keep it as text.  at most
+    max_counted_values values are counted, see prune_counts
+    '''
+
+    def __init__(self, loader, intern_values=None, cursor=None,
+                 max_counted_values=MAX_COUNTED_VALUES):
+        self.loader = loader
+        self.intern_values = intern_values
+        self.max_counted_values = max_counted_values
+        self.ids = dict((table, {}) for table in DICTIONARY_TABLES)
+        self.next_ids = dict((table, 1) for table in DICTIONARY_TABLES)
+        self.value_counts = {}
+        for table, column in DICTIONARY_TABLES.items():
+            loader.add_table(table, ['id', column])
+        for table in TAG_TABLES.values():
+            loader.add_table(table, TAG_ID_FIELDS)
+        # carry on from the ids already in the database
+        if cursor is not None:
+            for table, column in DICTIONARY_TABLES.items():
+                self.ids[table].update(
+                    (text, text_id) for text_id, text in
+                    cursor.execute('select id, {0} from {1};'.format(column, table)))
+                self.next_ids[table] = max(self.ids[table].values() or [0]) + 1
+
+    def intern(self, table, text):
+        '''returns the id of text in a dictionary table, adding it if it is new'''
+        ids = self.ids[table]
+        text_id = ids.get(text)
+        if text_id is None:
+            text_id = ids[text] = self.next_ids[table]
+            self.next_ids[table] += 1
+            self.loader.add(table, (text_id, text))
+        return text_id
+
+    def value_id(self, value):
+        '''
+        returns the id of an interned value or None to keep it as text, a
+        tag without a v attribute has no value and keeps its NULL
+        '''
+        if value is None:
+            return None
+        text_id = self.ids['tag_values'].get(value)
+        if text_id is not None or self.intern_values is None \
+                or len(value) > MAX_INTERNED_VALUE_LENGTH:
+            return text_id
+        count = self.value_counts.get(value, 0) + 1
+        if count < self.intern_values:
+            self.value_counts[value] = count
+            if len(self.value_counts) > self.max_counted_values:
+                self.prune_counts()
+            return None
+        self.value_counts.pop(value, None)
+        return self.intern('tag_values', value)
+
+    def prune_counts(self):
+        '''
+        takes one off every count and drops the values that reach zero until
+        at most half of max_counted_values are left, so values seen once in
+        a long run of distinct names are forgotten while the ones that keep
+        coming up hold on to most of their count
+        '''
+        while len(self.value_counts) > self.max_counted_values // 2:
+            self.value_counts = dict((value, count - 1) for value, count
+                                     in self.value_counts.items() if count > 1)
+
+    def add(self, view, tag):
+        '''
+        adds a shaped tag row for the nodes_tags or ways_tags view, a Tag
+        record or a plain tuple in the same order
+        '''
+        tag_id, key, value, tag_type = tag
+        value_id = self.value_id(value)
+        type_id = None
+        if tag_type is not None:
+            type_id = self.intern('tag_types', tag_type)
+        self.loader.add(TAG_TABLES[view], (
+            tag_id, self.intern('tag_keys', key), value_id,
+            value if value_id is None else None, type_id))
+
+    def add_many(self, view, tags):
+        '''adds every shaped tag row in tags'''
+        for tag in tags:
+            self.add(view, tag)
+
+    def stats(self):
+        '''returns the number of keys, types and values interned'''
+        return dict((table, len(ids)) for table, ids in self.ids.items())
+
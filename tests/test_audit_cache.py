@@ -0,0 +1,132 @@
+'''
+Tests for audit_cache, mostly that a cached audit is used exactly when the
+file, its chunks and the auditors are unchanged.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import Audit
+import audit_cache
+
+NODE = ('  <node id="{0}" lat="35.78" lon="-78.64" version="1" timestamp="2016-01-01T00:00:00Z" '
+        'changeset="1" uid="1" user="alice">\n'
+        '    <tag k="addr:street" v="{1}"/>\n'
+        '    <tag k="addr:postcode" v="{2}"/>\n'
+        '  </node>\n')
+STREETS = ['Hillsborough St', 'Glenwood Avenue', 'Oberlin Rd.', 'Wade Ave', 'Six Forks Road']
+AUDITORS = ('street', 'zip', 'tag_count')
+# small enough for the test files to be split into several chunks
+CHUNK_SIZE = 1024
+
+
+def osm_text(count, first_id=1):
+    nodes = ''.join(NODE.format(first_id + index, STREETS[index % len(STREETS)],
+                                '2760{0}'.format(index % 10))
+                    for index in range(count))
+    return '<osm>\n' + nodes + '</osm>\n'
+
+
+class LastStreetAuditor(Audit.Auditor):
+    '''keeps only the last street name it sees, which can't be merged'''
+    name = 'last_street'
+
+    def matches(self, key):
+        return key == 'addr:street'
+
+    def update(self, key, value):
+        self.result = value
+
+
+class StreetAuditorV2(Audit.StreetAuditor):
+    version = Audit.StreetAuditor.version + 1
+
+
+class AuditCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.osm')
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.write(osm_text(40))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, text):
+        with open(self.path, 'w') as osm_file:
+            osm_file.write(text)
+
+    def audit(self, auditors=AUDITORS, key='stat'):
+        cache = audit_cache.AuditCache(self.cache_dir)
+        results = audit_cache.cached_audit(self.path, auditors, key=key, chunk_size=CHUNK_SIZE,
+                                           cache=cache)
+        return results, cache
+
+    def test_chunked_audit_matches_run_audit(self):
+        results, _ = self.audit()
+        self.assertGreater(len(audit_cache.parallel.split_file(self.path, CHUNK_SIZE)), 2)
+        self.assertEqual(results, Audit.run_audit(self.path, AUDITORS, workers=1))
+
+    def test_unchanged_file_is_a_hit(self):
+        first, _ = self.audit()
+        second, cache = self.audit()
+        self.assertEqual(second, first)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_changed_file_reaudits_changed_chunks_only(self):
+        self.audit()
+        old_ranges = audit_cache.parallel.split_file(self.path, CHUNK_SIZE)
+        text = osm_text(40)
+        self.write(text.replace('</osm>\n', NODE.format(1000, 'Brand New Pike', '27699') +
+                                '</osm>\n'))
+        results, cache = self.audit()
+        self.assertEqual(results['street']['Pike'], set(['Brand New Pike']))
+        self.assertEqual(results, Audit.run_audit(self.path, AUDITORS, workers=1))
+        # the bytes before the new node are the same, so only the whole file
+        # and the chunks from the last old one on are audited again
+        new_ranges = audit_cache.parallel.split_file(self.path, CHUNK_SIZE)
+        unchanged = len(set(old_ranges[:-1]) & set(new_ranges))
+        self.assertEqual(unchanged, len(old_ranges) - 1)
+        self.assertEqual(cache.hits, unchanged)
+        self.assertEqual(cache.misses, 1 + len(new_ranges) - unchanged)
+
+    def test_new_auditor_version_is_a_miss(self):
+        self.audit(auditors=(Audit.StreetAuditor,))
+        results, cache = self.audit(auditors=(StreetAuditorV2,))
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(results, Audit.run_audit(self.path, (Audit.StreetAuditor,),
+                                                  workers=1))
+
+    def test_content_key_survives_touch(self):
+        self.audit(key='content')
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        _, cache = self.audit(key='content')
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        _, cache = self.audit(key='stat')
+        self.assertEqual(cache.misses, 1)
+
+    def test_corrupt_cache_entry_is_a_miss(self):
+        first, _ = self.audit()
+        whole_key = audit_cache.file_key(self.path, audit_cache.auditor_classes(AUDITORS))
+        with open(audit_cache.AuditCache(self.cache_dir).path('files', whole_key), 'wb') as cached:
+            cached.write(b'not a pickle')
+        results, cache = self.audit()
+        self.assertEqual(results, first)
+        self.assertEqual(cache.misses, 1)
+
+    def test_unmergeable_auditor_is_audited_whole(self):
+        with self.assertRaises(Audit.UnmergeableAudit):
+            Audit.merge_values('Wade Ave', 'Oberlin Rd.')
+        results, _ = self.audit(auditors=(LastStreetAuditor,))
+        self.assertEqual(results, {'last_street': STREETS[39 % len(STREETS)]})
+
+    def test_unknown_key_mode(self):
+        with self.assertRaises(ValueError):
+            self.audit(key='mtime')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+'''
+Tests that the generated record checks of fast_validator accept and reject
+exactly the elements the dictionary validation in validate_element does.
+'''
+import io
+import json
+import unittest
+
+import xml.etree.ElementTree as ET
+
+import InsertDatatoSQLandCSV as importer
+import fast_validator
+import records
+
+try:
+    import cerberus
+except ImportError:
+    cerberus = None
+
+NODE = ('<node id="1" lat="35.78" lon="-78.64" version="1" timestamp="2016-01-01T00:00:00Z" '
+        'changeset="5" uid="7" user="alice">{0}</node>')
+WAY = ('<way id="10" version="1" timestamp="2016-01-01T00:00:00Z" changeset="5" uid="7" '
+       'user="alice">{0}</way>')
+
+ELEMENTS = {
+    'valid node': NODE.format('<tag k="amenity" v="cafe"/><tag k="addr:street" v="Oberlin Rd"/>'),
+    'valid untagged node': NODE.format(''),
+    'valid way': WAY.format('<nd ref="1"/><nd ref="2"/><tag k="highway" v="residential"/>'),
+    'node without user': NODE.replace(' user="alice"', '').format(''),
+    'node without lat': NODE.replace(' lat="35.78"', '').format(''),
+    'node with text lat': NODE.replace('35.78', 'north').format(''),
+    'node with text uid': NODE.replace('uid="7"', 'uid="seven"').format(''),
+    'node with float id': NODE.replace('id="1"', 'id="1.5"').format(''),
+    'tag without value': NODE.format('<tag k="amenity"/>'),
+    'way without changeset': WAY.replace(' changeset="5"', '').format('<nd ref="1"/>'),
+    'way with text ref': WAY.format('<nd ref="1"/><nd ref="two"/>'),
+    'way tag without value': WAY.format('<nd ref="1"/><tag k="name"/>'),
+}
+
+
+def shaped(xml):
+    return importer.shape_element_record(ET.fromstring(xml))
+
+
+class FastValidatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.validator = fast_validator.CompiledValidator(importer.SCHEMA,
+                                                          records.SCHEMA_RECORDS)
+
+    def dictionary_result(self, element):
+        return fast_validator.CompiledValidator(importer.SCHEMA).validate(
+            records.as_dict(element), importer.SCHEMA) is True
+
+    def test_expected_results(self):
+        for name, xml in ELEMENTS.items():
+            self.assertEqual(self.validator.validate_record(shaped(xml)),
+                             name.startswith('valid'), name)
+
+    def test_records_match_dictionaries(self):
+        for name, xml in ELEMENTS.items():
+            element = shaped(xml)
+            self.assertEqual(self.validator.validate_record(element),
+                             self.dictionary_result(element), name)
+
+    def test_plain_tuple_rows_match(self):
+        # the rows the parallel workers hand back are plain tuples
+        batch = [(ET.fromstring(xml).tag, shaped(xml)) for xml in ELEMENTS.values()]
+        for (_, element), (_, decoded) in zip(batch, records.decode_batch(
+                records.encode_batch(batch))):
+            self.assertEqual(self.validator.validate_record(decoded),
+                             self.validator.validate_record(element))
+
+    def test_validate_element_rejects(self):
+        for name, xml in ELEMENTS.items():
+            rejects = io.StringIO()
+            valid = importer.validate_element(shaped(xml), self.validator, rejects=rejects)
+            self.assertEqual(valid, name.startswith('valid'), name)
+            if valid:
+                self.assertEqual(rejects.getvalue(), '')
+            else:
+                line = json.loads(rejects.getvalue())
+                self.assertEqual(line['element'], records.as_dict(shaped(xml)))
+                self.assertTrue(line['errors'], name)
+
+    def test_validate_element_raises_without_rejects(self):
+        self.assertTrue(importer.validate_element(shaped(ELEMENTS['valid way']),
+                                                  self.validator))
+        with self.assertRaises(Exception):
+            importer.validate_element(shaped(ELEMENTS['node with text lat']), self.validator)
+
+    @unittest.skipIf(cerberus is None, 'cerberus is not installed')
+    def test_matches_cerberus(self):
+        for name, xml in ELEMENTS.items():
+            element = shaped(xml)
+            self.assertEqual(self.validator.validate_record(element),
+                             cerberus.Validator().validate(records.as_dict(element),
+                                                           importer.SCHEMA), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
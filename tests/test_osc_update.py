@@ -0,0 +1,150 @@
+'''
+Tests for osc_update, each test imports a small extract with process_map
+and applies an osmChange diff to it.
+'''
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import InsertDatatoSQLandCSV as importer
+import address_search
+import osc_update
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASE_OSM = '''<osm>
+  <node id="1" lat="35.7800000" lon="-78.6400000" version="1" timestamp="2016-01-01T00:00:00Z" changeset="1" uid="1" user="alice">
+    <tag k="amenity" v="cafe"/>
+  </node>
+  <node id="2" lat="35.7810000" lon="-78.6410000" version="1" timestamp="2016-01-01T00:00:00Z" changeset="1" uid="1" user="alice"/>
+  <node id="3" lat="35.7820000" lon="-78.6420000" version="1" timestamp="2016-01-01T00:00:00Z" changeset="1" uid="1" user="alice"/>
+  <way id="10" version="1" timestamp="2016-01-01T00:00:00Z" changeset="1" uid="1" user="alice">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <tag k="highway" v="residential"/>
+  </way>
+</osm>'''
+
+CHANGES = '''<osmChange version="0.6">
+  <create>
+    <node id="4" lat="35.7900000" lon="-78.6500000" version="1">
+      <tag k="addr:street" v="Hillsborough St."/>
+      <tag k="addr:housenumber" v="1200"/>
+    </node>
+  </create>
+  <modify>
+    <node id="2" lat="35.7000000" lon="-78.7000000" version="2" timestamp="2016-02-01T00:00:00Z" changeset="2" uid="2" user="bob">
+      <tag k="name" v="Moved"/>
+    </node>
+  </modify>
+  <delete>
+    <node id="3" version="2"/>
+  </delete>
+</osmChange>'''
+
+DELETE_WAY = '''<osmChange version="0.6">
+  <delete>
+    <way id="10" version="2"/>
+  </delete>
+</osmChange>'''
+
+
+class OscUpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(os.path.join(HERE, 'data_wrangling_schema.sql'), self.directory)
+        os.chdir(self.directory)
+        with open('base.osm', 'w') as osm_file:
+            osm_file.write(BASE_OSM)
+        self.db_path = os.path.join(self.directory, 'test.db')
+        importer.process_map('base.osm', validate=True, db_path=self.db_path)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as osc_file:
+            osc_file.write(text)
+        return path
+
+    def query(self, statement, params=()):
+        connection = sqlite3.connect(self.db_path)
+        try:
+            return connection.execute(statement, params).fetchall()
+        finally:
+            connection.close()
+
+    def test_counts(self):
+        counts = osc_update.apply_changes(self.write('changes.osc', CHANGES), self.db_path)
+        self.assertEqual(counts, {'create': {'node': 1, 'way': 0},
+                                  'modify': {'node': 1, 'way': 0},
+                                  'delete': {'node': 1, 'way': 0}})
+
+    def test_create_without_optional_attributes(self):
+        osc_update.apply_changes(self.write('changes.osc', CHANGES), self.db_path)
+        self.assertEqual(self.query('select id, lat, lon, user, uid, version from nodes '
+                                    'where id = 4;'),
+                         [(4, 35.79, -78.65, None, None, 1)])
+        self.assertEqual(self.query('select key, value, type from nodes_tags where id = 4 '
+                                    'order by key;'),
+                         [('housenumber', '1200', 'addr'),
+                          ('street', 'Hillsborough Street', 'addr')])
+        self.assertEqual(self.query('select id from nodes_rtree where id = 4;'), [(4,)])
+
+    def test_create_is_searchable(self):
+        osc_update.apply_changes(self.write('changes.osc', CHANGES), self.db_path)
+        connection = sqlite3.connect(self.db_path)
+        try:
+            results = address_search.search(connection, '1200 hillsborough')
+        finally:
+            connection.close()
+        self.assertEqual([(result['element_type'], result['id'])
+                          for result in results], [('node', 4)])
+
+    def test_modify_replaces_node_and_refreshes_ways(self):
+        osc_update.apply_changes(self.write('changes.osc', CHANGES), self.db_path)
+        self.assertEqual(self.query('select lat, lon, user from nodes where id = 2;'),
+                         [(35.7, -78.7, 'bob')])
+        self.assertEqual(self.query('select key, value from nodes_tags where id = 2;'),
+                         [('name', 'Moved')])
+        # the R*Tree stores 32 bit floats
+        (min_lat, min_lon), = self.query('select min_lat, min_lon from ways_rtree '
+                                         'where id = 10;')
+        self.assertAlmostEqual(min_lat, 35.7, places=4)
+        self.assertAlmostEqual(min_lon, -78.7, places=4)
+
+    def test_delete_node(self):
+        osc_update.apply_changes(self.write('changes.osc', CHANGES), self.db_path)
+        self.assertEqual(self.query('select id from nodes where id = 3;'), [])
+        self.assertEqual(self.query('select id from nodes_rtree where id = 3;'), [])
+
+    def test_delete_way(self):
+        osc_update.apply_changes(self.write('delete.osc', DELETE_WAY), self.db_path)
+        for table in ('ways', 'ways_nodes', 'ways_tags', 'ways_rtree', 'way_geometry'):
+            self.assertEqual(self.query('select id from {0};'.format(table)), [], table)
+        self.assertEqual(self.query('select count(*) from nodes;'), [(3,)])
+
+    def test_gzipped_diff(self):
+        path = os.path.join(self.directory, 'delete.osc.gz')
+        with gzip.open(path, 'wt') as osc_file:
+            osc_file.write(DELETE_WAY)
+        counts = osc_update.apply_changes(path, self.db_path)
+        self.assertEqual(counts['delete']['way'], 1)
+        self.assertEqual(self.query('select id from ways;'), [])
+
+    def test_failed_diff_is_rolled_back(self):
+        path = self.write('broken.osc', CHANGES.replace('</osmChange>', ''))
+        with self.assertRaises(Exception):
+            osc_update.apply_changes(path, self.db_path)
+        self.assertEqual(self.query('select id from nodes order by id;'), [(1,), (2,), (3,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
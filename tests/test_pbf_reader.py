@@ -0,0 +1,189 @@
+'''
+Tests for pbf_reader.  The .osm.pbf files are written here with a few
+lines of protocol buffer encoding, so the tests don't need a real extract.
+'''
+import calendar
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+import zlib
+
+import xml.etree.ElementTree as ET
+
+import InsertDatatoSQLandCSV as importer
+import pbf_reader
+
+OSM_XML = '''<osm>
+  <node id="100" lat="35.7796000" lon="-78.6382000" version="2" timestamp="2016-01-02T03:04:05Z" changeset="11" uid="7" user="alice">
+    <tag k="amenity" v="cafe"/>
+    <tag k="addr:street" v="Hillsborough St."/>
+  </node>
+  <node id="103" lat="35.7801000" lon="-78.6390000" version="1" timestamp="2016-01-02T03:04:09Z" changeset="12" uid="8" user="bob"/>
+  <way id="500" version="3" timestamp="2016-02-01T00:00:00Z" changeset="20" uid="7" user="alice">
+    <nd ref="100"/>
+    <nd ref="103"/>
+    <tag k="highway" v="residential"/>
+  </way>
+</osm>'''
+
+
+# ================================================== #
+#               Encoding                             #
+# ================================================== #
+def varint(value):
+    data = bytearray()
+    while True:
+        low = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(low | 0x80)
+        else:
+            data.append(low)
+            return bytes(data)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, wire_type, payload):
+    key = varint((number << 3) | wire_type)
+    if wire_type == 0:
+        return key + varint(payload)
+    return key + varint(len(payload)) + payload
+
+
+def packed(values):
+    return b''.join(varint(value) for value in values)
+
+
+def packed_deltas(values):
+    deltas = [value - previous for previous, value in zip([0] + values, values)]
+    return packed([zigzag(delta) for delta in deltas])
+
+
+def blob(blob_type, data):
+    body = field(2, 0, len(data)) + field(3, 2, zlib.compress(data))
+    header = field(1, 2, blob_type.encode('utf-8')) + field(3, 0, len(body))
+    return struct.pack('!I', len(header)) + header + body
+
+
+def seconds(timestamp):
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def encode_block(elements):
+    '''a PrimitiveBlock with the nodes as DenseNodes and the ways after them'''
+    strings = ['']
+
+    def string_id(text):
+        if text not in strings:
+            strings.append(text)
+        return strings.index(text)
+
+    nodes = [element for element in elements if element.tag == 'node']
+    ways = [element for element in elements if element.tag == 'way']
+    keys_vals = []
+    for node in nodes:
+        for tag in node.findall('tag'):
+            keys_vals += [string_id(tag.get('k')), string_id(tag.get('v'))]
+        keys_vals.append(0)
+    info = (field(1, 2, packed([int(node.get('version')) for node in nodes])) +
+            field(2, 2, packed_deltas([seconds(node.get('timestamp')) for node in nodes])) +
+            field(3, 2, packed_deltas([int(node.get('changeset')) for node in nodes])) +
+            field(4, 2, packed_deltas([int(node.get('uid')) for node in nodes])) +
+            field(5, 2, packed_deltas([string_id(node.get('user')) for node in nodes])))
+    dense = (field(1, 2, packed_deltas([int(node.get('id')) for node in nodes])) +
+             field(5, 2, info) +
+             field(8, 2, packed_deltas([round(float(node.get('lat')) * 1e7) for node in nodes])) +
+             field(9, 2, packed_deltas([round(float(node.get('lon')) * 1e7) for node in nodes])) +
+             field(10, 2, packed(keys_vals)))
+    way_group = b''
+    for way in ways:
+        tags = way.findall('tag')
+        way_info = (field(1, 0, int(way.get('version'))) +
+                    field(2, 0, seconds(way.get('timestamp'))) +
+                    field(3, 0, int(way.get('changeset'))) +
+                    field(4, 0, int(way.get('uid'))) +
+                    field(5, 0, string_id(way.get('user'))))
+        way_group += field(3, 2, field(1, 0, int(way.get('id'))) +
+                           field(2, 2, packed([string_id(tag.get('k')) for tag in tags])) +
+                           field(3, 2, packed([string_id(tag.get('v')) for tag in tags])) +
+                           field(4, 2, way_info) +
+                           field(8, 2, packed_deltas([int(nd.get('ref'))
+                                                      for nd in way.findall('nd')])))
+    groups = field(2, 2, field(2, 2, dense)) + field(2, 2, way_group)
+    string_table = b''.join(field(1, 2, text.encode('utf-8')) for text in strings)
+    return field(1, 2, string_table) + groups
+
+
+def write_pbf(path, elements, per_block):
+    with open(path, 'wb') as pbf_file:
+        pbf_file.write(blob('OSMHeader', field(4, 2, b'OsmSchema-V0.6') +
+                            field(4, 2, b'DenseNodes')))
+        for start in range(0, len(elements), per_block):
+            pbf_file.write(blob('OSMData', encode_block(elements[start:start + per_block])))
+
+
+# ================================================== #
+#               Tests                                #
+# ================================================== #
+class VarintTest(unittest.TestCase):
+
+    def test_read_varint(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 40):
+            self.assertEqual(pbf_reader.read_varint(varint(value) + b'\x00', 0),
+                             (value, len(varint(value))))
+
+    def test_zigzag_round_trip(self):
+        for value in (0, -1, 1, -64, 2 ** 33, -2 ** 33):
+            self.assertEqual(pbf_reader.zigzag(zigzag(value)), value)
+
+    def test_delta_decode(self):
+        self.assertEqual(pbf_reader.delta_decode([100, 3, -1]), [100, 103, 102])
+
+
+class PbfReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.elements = list(ET.fromstring(OSM_XML))
+        self.path = os.path.join(self.directory, 'test.osm.pbf')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def shaped(self, elements):
+        return [importer.shape_element(element) for element in elements]
+
+    def test_is_pbf(self):
+        self.assertTrue(pbf_reader.is_pbf(self.path))
+        self.assertFalse(pbf_reader.is_pbf('map.osm'))
+
+    def test_elements_shape_like_xml(self):
+        write_pbf(self.path, self.elements, per_block=10)
+        decoded = list(pbf_reader.iter_elements(self.path, workers=1))
+        self.assertEqual([element.tag for element in decoded], ['node', 'node', 'way'])
+        self.assertEqual(decoded[0].attrib['timestamp'], '2016-01-02T03:04:05Z')
+        self.assertEqual([nd.get('ref') for nd in decoded[2].findall('nd')], ['100', '103'])
+        self.assertEqual(self.shaped(decoded), self.shaped(self.elements))
+
+    def test_tags_filter(self):
+        write_pbf(self.path, self.elements, per_block=10)
+        decoded = list(pbf_reader.iter_elements(self.path, tags=('way',), workers=1))
+        self.assertEqual([element.get('id') for element in decoded], ['500'])
+
+    def test_workers_keep_file_order(self):
+        # one element per blob so the pool hands back several blobs
+        write_pbf(self.path, self.elements, per_block=1)
+        serial = list(pbf_reader.iter_records(self.path, workers=1))
+        pooled = list(pbf_reader.iter_records(self.path, workers=2))
+        self.assertEqual(pooled, serial)
+        self.assertEqual([record[1]['id'] for record in serial], ['100', '103', '500'])
+
+
+if __name__ == '__main__':
+    unittest.main()
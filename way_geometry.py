@@ -0,0 +1,173 @@
+'''
+Precomputed way geometries.  While process_map loads the file each way's
+ordered node coordinates are packed into a blob of little endian float64
+(lat, lon) pairs and stored in the way_geometry table with the way's length
+in metres and its bounding box, so drawing or measuring a way no longer
+needs a join of ways_nodes to nodes sorted by position.
+
+load_geometries reads every blob into one NumPy array so lengths, areas and
+centroids can be worked out for all ways at once.  numpy is only needed for
+that accessor.
+'''
+import array
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import spatial
+
+GEOMETRY_FIELDS = ['id', 'coords', 'length', 'min_lat', 'max_lat',
+                   'min_lon', 'max_lon']
+
+GEOMETRY_SCHEMA = '''CREATE TABLE IF NOT EXISTS way_geometry (
+    id INTEGER PRIMARY KEY NOT NULL,
+    coords BLOB NOT NULL,
+    length REAL,
+    min_lat REAL,
+    max_lat REAL,
+    min_lon REAL,
+    max_lon REAL,
+    FOREIGN KEY (id) REFERENCES ways(id)
+)'''
+
+EARTH_RADIUS = spatial.EARTH_RADIUS
+
+
+def create_table(cursor):
+    '''creates the way_geometry table if it isn't there yet'''
+    cursor.execute(GEOMETRY_SCHEMA)
+
+
+def pack_coords(coords):
+    '''packs a list of (lat, lon) pairs into little endian float64 bytes'''
+    packed = array.array('d')
+    for lat, lon in coords:
+        packed.append(lat)
+        packed.append(lon)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_coords(blob):
+    '''turns a coords blob back into a list of (lat, lon) pairs'''
+    packed = array.array('d')
+    packed.frombytes(blob)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return list(zip(packed[0::2], packed[1::2]))
+
+
+def geometry_row(way_id, coords):
+    '''builds the way_geometry row for a way from its ordered coordinates'''
+    length = 0.0
+    for index in range(1, len(coords)):
+        length += spatial.haversine(coords[index - 1][0], coords[index - 1][1],
+                                    coords[index][0], coords[index][1])
+    lats = [lat for lat, _ in coords]
+    lons = [lon for _, lon in coords]
+    return (way_id, pack_coords(coords), length,
+            min(lats), max(lats), min(lons), max(lons))
+
+
+class GeometryBuilder(object):
+    '''feeds way_geometry rows to a BulkLoader as the ways are processed'''
+
+    def __init__(self, loader):
+        self.loader = loader
+        loader.add_table('way_geometry', GEOMETRY_FIELDS)
+
+    def add_way(self, way, coords):
+        '''
+        adds the geometry of a shaped way record, coords are the (lat, lon)
+        of the way's nodes in position order
+        '''
+        if coords:
+            self.loader.add('way_geometry', geometry_row(way.id, coords))
+
+
+# ================================================== #
+#               NumPy accessor                       #
+# ================================================== #
+class WayGeometries(object):
+    '''
+    every stored way geometry in one array, coords is an (n, 2) array of
+    lat, lon and the points of ids[i] are coords[offsets[i]:offsets[i + 1]]
+    '''
+
+    def __init__(self, ids, offsets, coords):
+        self.ids = ids
+        self.offsets = offsets
+        self.coords = coords
+
+    def __len__(self):
+        return len(self.ids)
+
+    def way(self, index):
+        '''returns the (n, 2) coordinate view for the way at index'''
+        return self.coords[self.offsets[index]:self.offsets[index + 1]]
+
+    def segment_sums(self, values):
+        '''
+        sums values[i], which belongs to the segment from point i to point
+        i + 1, over the segments inside each way
+        '''
+        totals = numpy.concatenate(([0.0], numpy.cumsum(values)))
+        starts = self.offsets[:-1]
+        ends = numpy.maximum(self.offsets[1:] - 1, starts)
+        return totals[ends] - totals[starts]
+
+    def lengths(self):
+        '''length of every way in metres'''
+        radians = numpy.radians(self.coords)
+        lat1, lon1 = radians[:-1, 0], radians[:-1, 1]
+        lat2, lon2 = radians[1:, 0], radians[1:, 1]
+        a = (numpy.sin((lat2 - lat1) / 2) ** 2 +
+             numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2)
+        distances = 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+        return self.segment_sums(distances)
+
+    def centroids(self):
+        '''mean (lat, lon) of the points of every way as an (n, 2) array'''
+        totals = numpy.vstack((numpy.zeros((1, 2)), numpy.cumsum(self.coords, axis=0)))
+        counts = (self.offsets[1:] - self.offsets[:-1])[:, None]
+        return (totals[self.offsets[1:]] - totals[self.offsets[:-1]]) / counts
+
+    def areas(self):
+        '''
+        area in square metres enclosed by every way using a local flat
+        projection, ways that aren't closed are treated as if they were
+        '''
+        counts = self.offsets[1:] - self.offsets[:-1]
+        origin = numpy.repeat(self.coords[self.offsets[:-1]], counts, axis=0)
+        scale = numpy.cos(numpy.radians(origin[:, 0]))
+        y = numpy.radians(self.coords[:, 0] - origin[:, 0]) * EARTH_RADIUS
+        x = numpy.radians(self.coords[:, 1] - origin[:, 1]) * EARTH_RADIUS * scale
+        cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+        totals = self.segment_sums(cross)
+        first = self.offsets[:-1]
+        last = self.offsets[1:] - 1
+        totals += x[last] * y[first] - x[first] * y[last]
+        return numpy.abs(totals) / 2
+
+
+def load_geometries(connection):
+    '''
+    reads every row of way_geometry into a WayGeometries, the blobs are
+    joined once and viewed as float64 without any further copies
+    '''
+    if numpy is None:
+        raise ImportError('numpy is needed to load way geometries')
+    ids = []
+    blobs = []
+    for way_id, blob in connection.execute('select id, coords from way_geometry '
+                                           'order by id;'):
+        ids.append(way_id)
+        blobs.append(blob)
+    counts = numpy.array([len(blob) // 16 for blob in blobs], dtype=numpy.int64)
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.int64)
+    coords = numpy.frombuffer(b''.join(blobs), dtype='<f8').reshape(-1, 2)
+    return WayGeometries(numpy.array(ids, dtype=numpy.int64), offsets, coords)